@@ -2,48 +2,327 @@
 #   Role- and Attribute Based Access Control System
 #
 
-from collections import defaultdict
-from hashlib import sha1
-from json import dumps
+import hmac
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from hashlib import sha1, sha256
+from json import dumps, loads
+from os import urandom
+from time import time
+
+_MISSING = object()     # placeholder for absent attributes, never equal to anything
+
+def _freeze(value):
+    """Hashable representation of a descriptor value (used for grouping)"""
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+def _intern(value):
+    """Shares one copy of names and values parsed from role descriptions"""
+    if isinstance(value, basestring):
+        try:
+            return intern(str(value))
+        except UnicodeError:
+            return value
+    if isinstance(value, list):
+        return tuple(_intern(item) if isinstance(item, basestring) else item for item in value)
+    return value
+
+_assign = object.__setattr__    # initializes fields of immutable objects
+
+
+class Immutable(object):
+    """Base of the slotted, read-only objects of the role model. They are
+    shared by all subjects (and interned by the AccessControlDomain)."""
+
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is immutable" % type(self).__name__)
+
+    def __delattr__(self, name):
+        raise AttributeError("%s is immutable" % type(self).__name__)
+
+
+class DecisionCache(object):
+    """Size-bounded cache with optional expiry (in seconds). Eviction approximates
+       least-recently-used order with two segments: hits in the old segment are
+       promoted to the young one, and when the young segment is full, the old one
+       is dropped. Counts hits, misses and evictions."""
+
+    __slots__ = ('segment', 'ttl', 'clock', 'young', 'old', 'hits', 'misses', 'evictions')
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time):
+        self.segment = max(1, maxsize // 2)
+        self.ttl = ttl
+        self.clock = clock
+        self.young = {}
+        self.old = {}
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        entry = self.young.get(key)
+        if entry is None:
+            entry = self.old.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._insert(key, entry)
+        value, expires = entry
+        if expires is not None and expires < self.clock():
+            self.discard(key)
+            self.misses += 1
+            self.evictions += 1
+            return default
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.old.pop(key, None)
+        self._insert(key, (value, self.clock() + self.ttl if self.ttl else None))
+
+    def _insert(self, key, entry):
+        self.young[key] = entry
+        if len(self.young) >= self.segment:
+            self.evictions += len(self.old)
+            self.old, self.young = self.young, {}
+
+    def discard(self, key):
+        self.young.pop(key, None)
+        self.old.pop(key, None)
+
+    def clear(self):
+        self.young, self.old = {}, {}
+
+    def stats(self):
+        return {'size': len(self), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+    def __len__(self):
+        return len(self.young) + len(self.old)
+
+
+class PermissionTable(object):
+    """Decision table compiled from a permission closure.
+       Entries are indexed by (operation, resource_class) and hold whether the
+       operation is granted unconditionally, and otherwise the attribute targets
+       which remain to be checked. Targets without a resource class apply to all."""
+
+    DENY = (False, ())
+
+    __slots__ = ('roles', 'permissions', 'entries')
+
+    def __init__(self, permissions, roles=()):
+        self.roles = tuple(roles)
+        by_operation = {}
+        grants = set()
+        predicates = {}
+
+        for permission in permissions:
+            target = permission.target
+            key = (permission.operation, target.resource)
+            by_operation.setdefault(permission.operation, []).append(permission)
+            if target.conditional:
+                predicates.setdefault(key, []).append(target)
+            else:
+                grants.add(key)
+
+        # merge wildcard entries into the class-specific ones
+        self.entries = {}
+        for key in grants.union(predicates):
+            operation, resource_class = key
+            wildcard = (operation, None)
+            if key in grants or wildcard in grants:
+                self.entries[key] = (True, ())
+            else:
+                conditions = predicates.get(key, [])
+                if resource_class is not None:
+                    conditions = conditions + predicates.get(wildcard, [])
+                self.entries[key] = (False, tuple(conditions))
+
+        # by operation, for debugging
+        self.permissions = dict((operation, tuple(permissions))
+                                for operation, permissions in by_operation.iteritems())
+
+    @classmethod
+    def from_roles(cls, roles, ops_closure):
+        """Compile the permission closure of the given roles. Ancestors shared
+        by several roles are resolved only once."""
+        permissions = set()
+        seen = set()
+        for role in roles:
+            while role is not None and role not in seen:
+                seen.add(role)
+                permissions.update(JointPermission.resolve(role, ops_closure))
+                role = role.parent
+        return cls(permissions, roles)
+
+    def lookup(self, operation, resource_class):
+        """Returns a (granted, predicates) pair for the operation on the resource class"""
+        entries = self.entries
+        return entries.get((operation, resource_class)) or \
+               entries.get((operation, None), self.DENY)
+
 
 class Subject(object):
     """Represents an active entity. Obtains permissions from roles.
        Descriptor-field can contain a dictionary with the subjects's attributes
        to support attribute-based access control"""
 
-    def __init__(self, id, roles, ops_hierarchy, cache_id_field, descriptor=None):
-        self.permissions = defaultdict(lambda: [])
+    __slots__ = ('id', 'roles', 'descriptor', 'cache', 'cache_id_field', 'domain', 'generation',
+                 'table', 'expires')
+
+    def __init__(self, id, roles, ops_closure, cache_id_field, descriptor=None, table=None,
+                 cache=None, domain=None):
         self.roles = roles
         self.descriptor = descriptor or dict()
-        self.cache = set()
+        self.cache = cache if cache is not None else DecisionCache()
         self.cache_id_field = cache_id_field
+        self.domain = domain
+        self.generation = domain.generation if domain else None
+        self.expires = None
         self.id = id
 
-        # optimization: compute permission closures sorted by operation
-        for role in self.roles:
-            for permission in role.resolve(ops_hierarchy):
-                self.permissions[permission.operation].append(permission)
-    
+        # optimization: permission closures compiled into a decision table
+        self.table = table or PermissionTable.from_roles(roles, ops_closure)
+
+    def refresh(self):
+        """Picks up changes of the role model. Called lazily before checks, it costs
+        a dictionary lookup unless the subject's roles were actually changed."""
+        domain = self.domain
+        generation = domain.generation
+        try:
+            table = domain.closure(self.descriptor['roles'])
+        except KeyError:
+            table = PermissionTable(())     # a role was removed
+        if table is not self.table:
+            self.table = table
+            self.roles = table.roles
+            self.cache.clear()
+        elif self.generation < domain.decisions_generation:
+            self.cache.clear()      # resources were changed
+        self.generation = generation
+
+    @property
+    def permissions(self):
+        """Permission closure sorted by operation"""
+        return self.table.permissions
+
     def can(self, operation, resource_class=None, resource_descriptor=None):
         """Checks whether the given operation is allowed on the resource"""
-        cache_key = None
+        if self.domain is not None and self.generation != self.domain.generation:
+            self.refresh()
+        granted, predicates = self.table.lookup(operation, resource_class)
+        if granted:
+            return True
+        if not predicates:
+            return False
 
+        # only attribute-based decisions are worth caching
         try:
-            if resource_descriptor:
-                cache_key = (operation, resource_class, resource_descriptor[self.cache_id_field])
+            cache_key = (operation, resource_class, resource_descriptor[self.cache_id_field])
+        except (KeyError, TypeError):
+            return self._check_all(predicates, operation, resource_class, resource_descriptor)
+
+        cache = self.cache
+        decision = cache.get(cache_key)
+        if decision is None:
+            decision = self._check_all(predicates, operation, resource_class, resource_descriptor)
+            cache.put(cache_key, decision)
+        return decision
+
+    def ifilter(self, operation, resource_class, descriptors):
+        """Yields the resource descriptors on which the operation is allowed.
+           Descriptors are grouped by the attributes the predicates inspect,
+           so each predicate runs once per distinct combination of values."""
+        if self.domain is not None and self.generation != self.domain.generation:
+            self.refresh()
+        granted, predicates = self.table.lookup(operation, resource_class)
+        if granted:
+            for descriptor in descriptors:
+                yield descriptor
+            return
+        if not predicates:
+            return
+
+        attributes = tuple(set(target.attribute for target in predicates))
+        if None in attributes:
+            # user-defined logic may inspect anything, check one by one
+            for descriptor in descriptors:
+                if self._check_all(predicates, operation, resource_class, descriptor):
+                    yield descriptor
+            return
+
+        decisions = {}
+        for descriptor in descriptors:
+            try:
+                key = tuple(_freeze(descriptor.get(attribute, _MISSING))
+                            for attribute in attributes)
+                allowed = decisions[key]
+            except KeyError:
+                allowed = decisions[key] = \
+                    self._check_all(predicates, operation, resource_class, descriptor)
+            except (AttributeError, TypeError):
+                # no dict or unhashable values: cannot be grouped
+                allowed = self._check_all(predicates, operation, resource_class, descriptor)
+            if allowed:
+                yield descriptor
+
+    def filter(self, operation, resource_class, descriptors):
+        """Returns the list of resource descriptors on which the operation is allowed"""
+        return list(self.ifilter(operation, resource_class, descriptors))
+
+    def query(self, operation, resource_class):
+        """Translates the permissions into a MongoDB filter document.
+           Returns a (spec, exact) pair. The spec is None if nothing is permitted
+           and empty if everything is. If exact is False, some targets could not
+           be expressed and matching documents must still pass through ifilter."""
+        if self.domain is not None and self.generation != self.domain.generation:
+            self.refresh()
+        granted, predicates = self.table.lookup(operation, resource_class)
+        if granted:
+            return {}, True
+        if not predicates:
+            return None, True
+
+        values = {}     # accepted values by attribute and whether elements match
+        for target in predicates:
+            clause = target.as_query(self.descriptor)
+            if clause is None:
+                return {}, False
+            attribute, value = clause
+            if value is _MISSING:
+                continue            # can never match
+            accepted = values.setdefault((attribute, target.contains), [])
+            if value not in accepted:
+                accepted.append(value)
+
+        clauses = []
+        for (attribute, contains), accepted in sorted(values.iteritems()):
+            if contains:
+                condition = accepted[0] if len(accepted) == 1 else {'$in': sorted(accepted)}
             else:
-                cache_key = (operation, resource_class)
-            if cache_key in self.cache:
+                # equality, whereas MongoDB also matches arrays containing the value
+                condition = {'$eq': accepted[0]} if len(accepted) == 1 else {'$in': sorted(accepted)}
+                condition['$not'] = {'$type': 'array'}
+            clauses.append({attribute: condition})
+        if not clauses:
+            return None, True
+        return (clauses[0] if len(clauses) == 1 else {'$or': clauses}), True
+
+    def attributes(self, operation, resource_class):
+        """Resource attributes which the permission checks inspect, None if
+           user-defined targets may inspect any of them"""
+        if self.domain is not None and self.generation != self.domain.generation:
+            self.refresh()
+        granted, predicates = self.table.lookup(operation, resource_class)
+        attributes = set(target.attribute for target in predicates)
+        return None if None in attributes else attributes
+
+    def _check_all(self, predicates, operation, resource_class, descriptor):
+        for target in predicates:
+            if target.check(self.descriptor, resource_class, descriptor, operation):
                 return True
-        except KeyError:
-            pass
-
-        if operation in self.permissions:
-            for permission in self.permissions[operation]:
-                if permission.check(self.descriptor, resource_class, resource_descriptor):
-                    if cache_key:
-                        self.cache.add(cache_key)
-                    return True
         return False
 
     def be_admin(self):
@@ -60,39 +339,59 @@ class Subject(object):
 
 class Admin(Subject):
     """Represents a superuser. Grants all permissions."""
+
+    __slots__ = ()      # same layout as Subject, for be_admin
+
     def can(self, operation, resource_class=None, resource_descriptor=None):
         return True
 
+    def ifilter(self, operation, resource_class, descriptors):
+        return iter(descriptors)
+
+    def query(self, operation, resource_class):
+        return {}, True
+
 class NullSubjectClass(Subject):
     """Represents an unauthorized subject"""
+
+    __slots__ = ()
+
     def __init__(self):
         Subject.__init__(self, '', [], {}, '')
 
     def can(self, operation, resource_class=None, resource_descriptor=None):
         return False
 
+    def ifilter(self, operation, resource_class, descriptors):
+        return iter(())
+
+    def query(self, operation, resource_class):
+        return None, True
+
     def debug(self):
         return "<Unauthorized User>"
 
 NullSubject = NullSubjectClass()     # Singleton!
 
-class Permission(object):
+class Permission(Immutable):
     """Permission to perform the said operation on a target"""
 
+    __slots__ = ('operation', 'target', 'role')
+
     def __init__(self, operation, target, role):
-        self.operation = operation
-        self.target = target
-        self.role = role
+        _assign(self, 'operation', operation)
+        _assign(self, 'target', target)
+        _assign(self, 'role', role)     # name of the granting role, for display
 
     def check(self, subject, resource_class, resource_descriptor):
         return self.target.check(subject, resource_class, resource_descriptor, self.operation)
 
-    def resolve(self, hierarchy):
-        """Compute the closure of the given operation (all sub-operations)"""
-        if self.operation in hierarchy:
-            subsets = [Permission(sub_op, self.target, self.role).resolve(hierarchy)
-                        for sub_op in hierarchy[self.operation]]
-            return reduce(set.union, subsets, set())        
+    def resolve(self, ops_closure):
+        """Compute the closure of the given operation (all sub-operations),
+        looked up in a table made by operations_closure()"""
+        if self.operation in ops_closure:
+            return set(Permission(sub_op, self.target, self.role)
+                       for sub_op in ops_closure[self.operation])
         else:
             return { self }
 
@@ -107,22 +406,28 @@ class Permission(object):
         return "<Permission %s on %s given by %s>" % (self.operation, self.target, self.role)
     __str__ = __repr__
 
-class JointPermission(object):
+class JointPermission(Immutable):
+
+    __slots__ = ('permissions',)
 
     def __init__(self, permissions):
-        self.permissions = permissions
+        _assign(self, 'permissions', tuple(permissions))
     
-    def resolve(self, hierarchy):
+    def resolve(self, ops_closure):
         """Resolve to a set of child permissions (Permissison Closure)"""
-        subsets = [permission.resolve(hierarchy)
+        subsets = [permission.resolve(ops_closure)
                    for permission in self.permissions]
         return reduce(set.union, subsets, set())
 
-class ResourceTarget(object):
+class ResourceTarget(Immutable):
     """Target identified if the resource names match or are None"""
 
+    __slots__ = ('resource',)
+
+    conditional = False     # decided by resource class alone
+
     def __init__(self, resource_name=None):
-        self.resource = resource_name
+        _assign(self, 'resource', resource_name)
 
     def check(self, subject, resource_class, resource_descriptor, op):
         return self.resource == resource_class if self.resource else True
@@ -138,16 +443,25 @@ class ResourceTarget(object):
 class AttributeTarget(ResourceTarget):
     """Matches if some resource's attribute has the (constant) value"""
 
+    __slots__ = ('attribute', 'value')
+
+    conditional = True      # requires a resource descriptor
+    contains = False        # compares the whole value, never array elements
+
     def __init__(self, resource, attribute, value):
         ResourceTarget.__init__(self, resource)
-        self.attribute = attribute
-        self.value = value
+        _assign(self, 'attribute', attribute)
+        _assign(self, 'value', value)
 
     def check(self, subject, resource_class, resource_descriptor, op):
-        assert hasattr(resource_descriptor, '__getitem__'), \
-               'Attribute-based permission check requires a dict object!'
-        ResourceTarget.check(self, subject, resource_class, resource_descriptor, op)
-        return self.value == resource_descriptor[self.attribute]
+        if not hasattr(resource_descriptor, 'get'):
+            return False
+        return ResourceTarget.check(self, subject, resource_class, resource_descriptor, op) and \
+               self.value == resource_descriptor.get(self.attribute, _MISSING)
+
+    def as_query(self, subject):
+        """(attribute, value) pair a matching document contains"""
+        return self.attribute, self.value
 
     def as_dict(self):
         return ['if-const', self.attribute, self.value]
@@ -161,12 +475,18 @@ class AttributeInclusionTarget(AttributeTarget):
     """Matches if the resource's attribute contains the specified value.
        This may be useful for additional simple ACLs on resource side."""
 
+    __slots__ = ()
+
+    contains = True         # a query on the attribute matches array elements
+
     def __init__(self,  resource, attribute, value):
         AttributeTarget.__init__(self,  resource, attribute, value)
 
     def check(self, subject, resource_class, resource_descriptor, op):
-        ResourceTarget.check(self, subject, resource_class, resource_descriptor, op)
-        return self.value in resource_descriptor[self.attribute]
+        if not hasattr(resource_descriptor, 'get'):
+            return False
+        return ResourceTarget.check(self, subject, resource_class, resource_descriptor, op) and \
+               self.value in resource_descriptor.get(self.attribute, ())
 
     def as_dict(self):
         return ['if-contains', self.attribute, self.value]
@@ -180,14 +500,19 @@ class AttributeEqualityTarget(AttributeTarget):
     """Matches if the resource's attribute contains the specified value.
        This may be useful for additional simple ACLs on resource side."""
 
+    __slots__ = ()
+
     def __init__(self, resource_class, resource_attr, subject_attr):
         AttributeTarget.__init__(self, resource_class, resource_attr, subject_attr)
 
     def check(self, subject, resource_class, resource_descriptor, op):
-        if not hasattr(resource_descriptor, '__getitem__'):
+        if not hasattr(resource_descriptor, 'get'):
             return False
-        ResourceTarget.check(self, subject, resource_class, resource_descriptor, op)
-        return subject[self.value] == resource_descriptor[self.attribute]
+        return ResourceTarget.check(self, subject, resource_class, resource_descriptor, op) and \
+               subject.get(self.value, _MISSING) == resource_descriptor.get(self.attribute)
+
+    def as_query(self, subject):
+        return self.attribute, subject.get(self.value, _MISSING)
 
     def as_dict(self):
         return ['if-equals', self.attribute, self.value]
@@ -207,15 +532,24 @@ class UserDefinedTargetClass(object):
     def __call__(self, *args):
         return UserDefinedTarget(self, args)
 
-class UserDefinedTarget(object):
+class UserDefinedTarget(Immutable):
     """An instance of user-defined target logic"""
 
+    __slots__ = ('cls', 'args')
+
+    conditional = True      # opaque, always evaluated
+    resource = None         # the check method decides on the resource class
+    attribute = None        # may inspect any attribute
+
     def __init__(self, cls, args):
-        self.cls = cls
-        self.args = args
+        _assign(self, 'cls', cls)
+        _assign(self, 'args', args)
 
     def check(self, subject, resource_class, resource_descriptor, op):
-        self.cls.check_method(subject, resource_class, resource_descriptor, op, *self.args)
+        return self.cls.check_method(subject, resource_class, resource_descriptor, op, *self.args)
+
+    def as_query(self, subject):
+        return None     # not expressible as a query
 
     def as_dict(self):
         return [self.cls.name] + list(self.args)
@@ -226,19 +560,17 @@ class UserDefinedTarget(object):
 
 class Role(JointPermission):
     """A Role organizes a set of permissions. Roles inherit permissions."""
-    
+
+    __slots__ = ('name', 'parent')
+
     def __init__(self, name, parent, permissions):
         JointPermission.__init__(self, permissions)
-        self.name = name
-        self.parent = parent
-
-        # backward reference for displaying which permission was given by which role
-        for permission in self.permissions:
-            permission.role = self
+        _assign(self, 'name', name)
+        _assign(self, 'parent', parent)
 
-    def resolve(self, hierarchy):
-        return JointPermission.resolve(self, hierarchy).union(
-            self.parent.resolve(hierarchy) if self.parent else set())
+    def resolve(self, ops_closure):
+        return JointPermission.resolve(self, ops_closure).union(
+            self.parent.resolve(ops_closure) if self.parent else set())
 
     def __repr__(self):
         return "<Role %s>" % self.name
@@ -250,18 +582,84 @@ DEFAULT_OPS_HIERARCHY = {
     'crud' : ['read', 'write']
     }
 
+def transitive_closure(graph):
+    """Maps every node of a directed graph { node: [successors], .. } to the
+    frozenset of all nodes reachable from it. Raises ValueError on cycles."""
+    closure = {}
+
+    def reach(node, path):
+        if node in closure:
+            return closure[node]
+        if node in path:
+            raise ValueError("Cycle: %s" % ' > '.join(path[path.index(node):] + (node,)))
+        result = set()
+        for successor in graph[node]:
+            result.add(successor)
+            if successor in graph:
+                result.update(reach(successor, path + (node,)))
+        closure[node] = frozenset(result)
+        return closure[node]
+
+    for node in graph:
+        reach(node, ())
+    return closure
+
+def operations_closure(hierarchy):
+    """Maps every operation hypernym to the basic operations it stands for"""
+    return dict((operation, frozenset(op for op in reachable if op not in hierarchy))
+                for operation, reachable in transitive_closure(hierarchy).iteritems())
+
+def role_order(d_roles):
+    """Orders role descriptions so that parents precede their children.
+    Raises ValueError for unknown parents and cyclic inheritance."""
+    names = set(d_role['name'] for d_role in d_roles)
+    order = []
+    children = {}
+    for d_role in d_roles:
+        if 'parent' not in d_role:
+            order.append(d_role)
+        elif d_role['parent'] in names:
+            children.setdefault(d_role['parent'], []).append(d_role)
+        else:
+            raise ValueError("Role %s has an unknown parent %s" % (d_role['name'], d_role['parent']))
+    i = 0
+    while i < len(order):
+        order.extend(children.pop(order[i]['name'], ()))
+        i += 1
+    if children:
+        raise ValueError("Cyclic inheritance of roles: %s" %
+                         ', '.join(sorted(d_role['name'] for pending in children.values()
+                                          for d_role in pending)))
+    return order
+
 class AccessControlDomain(object):
     """Manages permissions for a set of roles"""       
 
     def __init__(self):
         self.roles = {}             # unique roles
-        self.targets = {}           # unique target constraints
-        self.permissions = {}       # unique permissions
+        self.targets = {}           # unique target constraints (hash-consed)
+        self.permissions = {}       # unique permissions by operation, target and role
         self.cache_id_field = '_id' # unique resource identifier to cache permissions
-        self.subject_cache = {}
-
-        # hierarchy of operation hypernyms
+        self.generation = 0         # bumped whenever the role model changes
+        self.decisions_generation = 0   # generation from which cached decisions are valid
+        self.version = None         # digest of the role model, equal across processes
+        self.role_descriptions = {}
+        self.closures = {}          # compiled permissions by role set, for this generation
+        # factory for per-subject caches; the expiry bounds how long decisions
+        # survive changes of resources made by other processes
+        self.decision_cache = lambda: DecisionCache(ttl=60)
+
+        # hierarchy of operation hypernyms, and the basic operations of each
         self.ops_hierarchy = DEFAULT_OPS_HIERARCHY
+        self.ops_closure = operations_closure(DEFAULT_OPS_HIERARCHY)
+        self.role_order = ()        # role names, parents first
+
+        # signed access tokens
+        self.secret = urandom(32)           # use the same key in all processes
+        self.token_lifetime = 14 * 24 * 3600
+        self.token_exclude = ('password',)  # descriptor fields never put into tokens
+        self.token_codec = (dumps, loads)
+        self.subject_cache = DecisionCache(maxsize=10000, ttl=600)  # subjects by token
         
         self.special_targets = {
             'if-const': AttributeTarget,
@@ -273,6 +671,10 @@ class AccessControlDomain(object):
         """Set the field by which a resource will be identified. Used for caching."""
         self.cache_id_field = field_name
 
+    def use_decision_cache(self, factory=DecisionCache, **options):
+        """Set the cache type and options (e.g. maxsize, ttl) for new subjects"""
+        self.decision_cache = lambda: factory(**options)
+
     def permission(self, name):
         """Yields a decorator for user-defined permission checks"""
         def permission_decorator(func):
@@ -281,44 +683,52 @@ class AccessControlDomain(object):
             return cls
         return permission_decorator
 
-    def parse_role(self, d_role):
+    def parse_role(self, d_role, roles=None, descriptions=None):
+        """Parses a role into the given (by default: the current) role dictionaries"""
+        roles = self.roles if roles is None else roles
+        descriptions = self.role_descriptions if descriptions is None else descriptions
+        name = _intern(d_role['name'])
         perms = []
         for op in d_role['can']:
-            perms.extend(self.parse_operation(op))
-        parent = self.roles[d_role['parent']] if 'parent' in d_role else None
-        role = Role(d_role['name'], parent, perms)
-        self.roles[role.name] = role
+            perms.extend(self.parse_operation(op, name))
+        parent = roles[d_role['parent']] if 'parent' in d_role else None
+        role = Role(name, parent, perms)
+        roles[role.name] = role
+        descriptions[role.name] = d_role
         return role
 
-    def parse_operation(self, d_op):
+    def parse_operation(self, d_op, role=None):
         operation, d_targets = d_op
-        return [self.parse_permission(operation, t)
+        return [self.parse_permission(operation, t, role)
                 for t in d_targets]
 
-    def parse_permission(self, op, d_target):
+    def parse_permission(self, op, d_target, role=None):
         # cache permissions
-        key = (op, tuple(d_target) if isinstance(d_target, list) else d_target)
+        op = _intern(op)
+        target = self.parse_target(d_target)
+        key = (op, id(target), role)        # targets are unique
         if key in self.permissions:
             return self.permissions[key]
         else:
-            result = Permission(op, self.parse_target(d_target), None)
+            result = Permission(op, target, role)
             self.permissions[key] = result
             return result
 
     def parse_target(self, d_target):
-        # cache common sub-expressions
-        key = tuple(d_target) if isinstance(d_target, list) else d_target
+        # cache common sub-expressions: equal descriptions share one target
+        key = _intern(d_target)
         if key in self.targets:
             return self.targets[key]
-        
+        d_target = key
+
         if isinstance(d_target, str) or isinstance(d_target, unicode):
-            result = ResourceTarget(str(d_target))
+            result = ResourceTarget(d_target)
         elif isinstance(d_target, bool):
             if d_target:
                 result = ResourceTarget(None)
             else:
                 raise ValueError("Negative permission! Leave them out.")
-        elif isinstance(d_target, list):
+        elif isinstance(d_target, tuple):
             keyword = d_target[0]
             if keyword in self.special_targets:
                 result = self.special_targets[keyword](*d_target[1:])
@@ -331,54 +741,196 @@ class AccessControlDomain(object):
         return result
         
     def init_role_model(self, d_roles):
-        """(Re-)Initialize role model with a description of all roles"""
-        self.roles = {}
-        self.targets = {}
-        self.permissions = {}
-        resolved = 0
-        d_roles_pending = list(d_roles) # copy (will be modified!)
-        
-        # multi-pass role parsing, as a role can only be parsed if its
-        # parent has already been parsed ("poor man's topological sort")
-        while d_roles_pending:
-            for i in reversed(xrange(len(d_roles_pending))):
-                d_role = d_roles_pending[i]
-                if 'parent' not in d_role or d_role['parent'] in self.roles:
-                        self.parse_role(d_role)
-                del d_roles_pending[i]
+        """(Re-)Initialize role model with a description of all roles. Invalid
+        descriptions raise ValueError and leave the current model in place."""
+        ordered = role_order(d_roles)
+        roles, descriptions = self.parse_roles(ordered)
+        self.roles, self.role_descriptions = roles, descriptions
+        self.role_order = tuple(d_role['name'] for d_role in ordered)
+        self.changed()
+
+    def parse_roles(self, ordered):
+        """Parses role descriptions (parents first) into new dicts of roles and
+        descriptions by name, with fresh target and permission caches. If one
+        is invalid, the caches of the current model are kept."""
+        previous = self.targets, self.permissions
+        self.targets, self.permissions = {}, {}
+        roles, descriptions = {}, {}
+        try:
+            for d_role in ordered:
+                self.parse_role(d_role, roles, descriptions)
+        except Exception:
+            self.targets, self.permissions = previous
+            raise
+        return roles, descriptions
 
     def update_role(self, d_role):
-        """Updates or puts a new role in place. Subjects do not update automatically!"""
-        new_role = self.parse_role(self, d_role)
-        self.update_references_to(new_role)
+        """Updates or puts a new role in place. Subjects update on their next check."""
+        d_roles = dict(self.role_descriptions)
+        d_roles[d_role['name']] = d_role
+        return self.reload(d_roles.values())
+
+    def descendants(self, names):
+        """The named roles and all roles inheriting from them"""
+        children = {}
+        for name, d_role in self.role_descriptions.iteritems():
+            if 'parent' in d_role:
+                children.setdefault(d_role['parent'], []).append(name)
+        result = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name not in result:
+                result.add(name)
+                pending.extend(children.get(name, ()))
+        return result
 
-    def update_references_to(self, new_role):
-        for role in self.roles.itervalues():
-            if role.parent.name == new_role.name:
-                role.parent = new_role
+    def reload(self, d_roles, d_ops_hierarchy=None):
+        """Brings the role model up to date with a description of all roles.
+        Only changed roles and the roles inheriting from them are parsed again,
+        and only compiled permissions of role sets containing them are dropped.
+        The new roles replace the old ones at once. Returns the affected names."""
+        if d_ops_hierarchy is not None and d_ops_hierarchy != self.ops_hierarchy:
+            # parse everything before changing anything
+            ops_closure = operations_closure(d_ops_hierarchy)
+            ordered = role_order(d_roles)
+            roles, descriptions = self.parse_roles(ordered)
+            self.ops_hierarchy, self.ops_closure = d_ops_hierarchy, ops_closure
+            self.roles, self.role_descriptions = roles, descriptions
+            self.role_order = tuple(d_role['name'] for d_role in ordered)
+            self.changed()
+            return set(roles)
+
+        ordered = role_order(d_roles)
+        d_roles = dict((d_role['name'], d_role) for d_role in ordered)
+        changed = set(name for name, d_role in d_roles.iteritems()
+                       if self.role_descriptions.get(name) != d_role)
+        removed = set(self.role_descriptions) - set(d_roles)
+        affected = self.descendants(changed | removed) | changed
+        if not affected:
+            return affected
+
+        roles = dict((name, role) for name, role in self.roles.iteritems()
+                     if name not in affected)
+        descriptions = dict((name, d_role) for name, d_role in self.role_descriptions.iteritems()
+                            if name not in affected)
+        for d_role in ordered:
+            if d_role['name'] in affected:
+                self.parse_role(d_role, roles, descriptions)
+
+        self.roles, self.role_descriptions = roles, descriptions
+        self.role_order = tuple(d_role['name'] for d_role in ordered)
+        self.changed(affected)
+        return affected
 
     def update_operations_hierarchy(self, d_ops_hierarchy):
         """Updates the hypernyms dictionary.
         It takes the form { 'operation_hypernym': ['op1', 'op2', ...], .. }"""
+        self.ops_closure = operations_closure(d_ops_hierarchy)
         self.ops_hierarchy = d_ops_hierarchy
+        self.changed()
+
+    def changed(self, affected=None):
+        """Starts a new generation of the role model. Compiled permissions of role
+        sets containing affected roles (by default: all) are dropped, subjects
+        refresh on their next check."""
+        if affected is None:
+            self.closures = {}
+        else:
+            # items() is a snapshot: request threads add tables meanwhile
+            self.closures = dict((key, table) for key, table in self.closures.items()
+                                 if not key & affected)
+        self.generation += 1
+        self.version = sha1(dumps([self.ops_hierarchy, sorted(self.role_descriptions.items())],
+                                  sort_keys=True, default=repr)).hexdigest()
+
+    def resources_changed(self):
+        """Attributes inspected by permissions were changed (e.g. the tags of
+        photos): all subjects of this process drop their cached decisions
+        before their next check."""
+        self.generation += 1
+        self.decisions_generation = self.generation
+
+    def compile_roles(self, roles):
+        """Compiles the permissions of a role set into a decision table"""
+        return PermissionTable.from_roles(roles, self.ops_closure)
+
+    def closure(self, role_names):
+        """Returns the compiled permissions of the named roles. Tables are
+        memoized per role set and shared read-only by all subjects."""
+        key = frozenset(role_names)
+        closures = self.closures
+        table = closures.get(key)
+        if table is None:
+            generation = self.generation
+            table = self.compile_roles([self.roles[name] for name in key])
+            if generation == self.generation:   # not reloaded in the meantime
+                closures[key] = table           # dropped if replaced meanwhile
+        return table
 
     def create_subject(self, descriptor):
         """Generates a subject from the description (containing a 'roles' field).
-        Subjects can be seen as access tokens created at login time"""
-        roles = [self.roles[role_name] for role_name in descriptor['roles']]
-        id = sha1(repr(descriptor)).hexdigest()
-        subject = Subject(id, roles, self.ops_hierarchy, self.cache_id_field, descriptor)
-        self.subject_cache[id] = subject
+        Subjects can be seen as access tokens created at login time: the
+        subject's id is a signed token which recreates it in any process."""
+        return self.subject_from_token(self.issue_token(descriptor))
+
+    def issue_token(self, descriptor):
+        """Signs the subject's attributes (including its roles), the role model
+        version and an expiry date. Fields in token_exclude are left out."""
+        claims = {'sub': dict((key, value) for key, value in descriptor.iteritems()
+                              if key not in self.token_exclude),
+                  'ver': self.version,
+                  'exp': int(time()) + self.token_lifetime}
+        payload = urlsafe_b64encode(self.token_codec[0](claims))
+        return '%s.%s' % (payload, self._signature(payload))
+
+    def verify_token(self, token):
+        """Returns the claims of a valid token, None otherwise"""
+        try:
+            payload, signature = str(token).split('.')
+        except (ValueError, UnicodeError):
+            return None
+        if not hmac.compare_digest(signature, self._signature(payload)):
+            return None
+        claims = self.token_codec[1](urlsafe_b64decode(payload))
+        if claims['exp'] < time():
+            return None
+        return claims
+
+    def _signature(self, payload):
+        return urlsafe_b64encode(hmac.new(self.secret, payload, sha256).digest()).rstrip('=')
+
+    def subject_from_token(self, token):
+        """Returns the subject of a valid token, rebuilt if it is not cached.
+        Tokens issued against another role model version get the current
+        permissions of their roles. Returns None for invalid tokens."""
+        subject = self.subject_cache.get(token)
+        if subject is not None and subject.expires >= time():
+            return subject
+
+        claims = self.verify_token(token)
+        if claims is None:
+            return None
+        descriptor = claims['sub']
+        try:
+            table = self.closure(descriptor['roles'])
+        except KeyError:
+            return None             # role was removed
+        subject = Subject(token, table.roles, self.ops_closure, self.cache_id_field, descriptor,
+                          table, self.decision_cache(), self)
+        subject.expires = claims['exp']
+        self.subject_cache.put(token, subject)
         return subject
-        
+
     def get_subject_by_id(self, subject_id):
-        """Retrieve an already generated subject by its ID during a session."""
-        return self.subject_cache[subject_id]
+        """Retrieve the subject of a token during a session."""
+        return self.subject_from_token(subject_id)
 
     def forget_subject(self, subject_id):
-        """Delete a subject from the cache at logout."""
-        del self.subject_cache[subject_id]
+        """Drop a subject from the cache at logout. The token itself stays
+        valid until it expires, so it must not be kept by the client."""
+        self.subject_cache.discard(subject_id)
 
     def validate_subject(self, subject_id):
-        """Checks whether the given subject ID is valid"""
-        return subject_id in self.subject_cache
+        """Checks whether the given subject ID is a valid token"""
+        return self.verify_token(subject_id) is not None
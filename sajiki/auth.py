@@ -0,0 +1,94 @@
+#
+#   Password Verification
+#
+
+import hmac
+from hashlib import sha256
+from multiprocessing import Pool, TimeoutError
+from os import urandom
+from threading import BoundedSemaphore, Lock
+
+from beaker.crypto.pbkdf2 import crypt
+
+from access import DecisionCache
+
+WORK_FACTOR = 20000         # PBKDF2 iterations for new and upgraded hashes
+DEFAULT_ITERATIONS = 400    # used by crypt() for hashes without iteration count
+
+
+class Overloaded(Exception):
+    """Raised when too many verifications are pending"""
+
+
+def iterations_of(password_hash):
+    """PBKDF2 iterations of a '$p5k2$<iterations in hex>$<salt>$<hash>' string"""
+    try:
+        iterations = password_hash.split('$')[2]
+    except IndexError:
+        return 0
+    return int(iterations, 16) if iterations else DEFAULT_ITERATIONS
+
+
+def check_password(password, password_hash, work_factor):
+    """Returns (valid, new hash). A new hash with the given work factor is computed
+       for valid passwords with a weaker hash. Runs in a worker process."""
+    try:
+        valid = hmac.compare_digest(crypt(password, password_hash), str(password_hash))
+        if valid and iterations_of(password_hash) < work_factor:
+            return True, crypt(password, iterations=work_factor)
+        return valid, None
+    except Exception:       # a malformed hash is never valid; the result must arrive
+        return False, None
+
+
+class PasswordVerifier(object):
+    """Verifies passwords in worker processes, so hashing neither blocks nor
+       holds the interpreter lock of request threads. If more than 'concurrency'
+       verifications are pending, further logins are rejected at once.
+       Successful verifications are remembered under a keyed digest of hash and
+       password for 'ttl' seconds. Failures are never cached, so guessing always
+       pays the full hashing cost."""
+
+    def __init__(self, workers=2, concurrency=None, timeout=30, work_factor=WORK_FACTOR, ttl=300):
+        self.workers = workers
+        self.timeout = timeout
+        self.work_factor = work_factor
+        self.slots = BoundedSemaphore(concurrency or 4 * workers)
+        self.key = urandom(32)
+        self.verified = DecisionCache(maxsize=10000, ttl=ttl)
+        self.pool = None
+        self.pool_lock = Lock()
+
+    def _pool(self):
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = Pool(self.workers)
+            return self.pool
+
+    def verify(self, password, password_hash):
+        """Returns (valid, new hash). The new hash replaces stored hashes below
+           the work factor, otherwise it is None."""
+        password = password.encode('utf-8') if isinstance(password, unicode) else password
+        password_hash = str(password_hash)
+        key = hmac.new(self.key, '%s\0%s' % (password_hash, password), sha256).digest()
+        if self.verified.get(key):
+            return True, None
+
+        if not self.slots.acquire(False):
+            raise Overloaded("Too many logins at once")
+        # the slot is held until the hash is computed, even if we stop waiting
+        try:
+            result = self._pool().apply_async(check_password,
+                                              (password, password_hash, self.work_factor),
+                                              callback=lambda result: self.slots.release())
+        except Exception:
+            self.slots.release()
+            raise
+        try:
+            valid, new_hash = result.get(self.timeout)
+        except TimeoutError:
+            raise Overloaded("Password verification timed out")
+
+        if valid and new_hash is None:
+            self.verified.put(key, True)
+        return valid, new_hash
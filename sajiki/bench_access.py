@@ -0,0 +1,385 @@
+#
+#   Access Control Microbenchmarks
+#
+#   Usage: python bench_access.py [--roles N] [--depth D] [--targets M] [--json FILE] ...
+#
+#   Measures the seeded role model, then a synthetic one: N roles in
+#   inheritance chains of depth D with M attribute targets, a population of
+#   subjects with random role sets and a stream of photo descriptors.
+#   Reports checks/s, cache hit rates, model and subject build times and the
+#   memory held by each subject and by the domain. With --json, all results are also written
+#   as one JSON document (to compare runs over time); with '--json -' it goes to
+#   stdout and the summary to stderr.
+#
+
+import gc
+import json
+import platform
+import random
+import sys
+from collections import defaultdict
+from timeit import default_timer as timer
+from access import AccessControlDomain, AttributeEqualityTarget, AttributeInclusionTarget, \
+    AttributeTarget, ResourceTarget
+
+# role model as seeded by data.init_users
+bench_roles = [
+    {'name': 'admin',
+     'can': [['crud', ['users', 'roles', 'photos', 'comments']]]},
+    {'name': 'photographer',
+     'can': [['crud', ['photos', 'galleries']],
+             ['delete', ['comments']]]},
+    {'name': 'press',
+     'parent': 'reviewer',
+     'can': [['read', [['if-contains', 'photos', 'tags', 'press'],
+                       ['if-contains', 'galleries', 'tags', 'press']]]]},
+    {'name': 'reviewer',
+     'can': [['create', ['comments', 'vetos']],
+             ['read', [['if-contains', 'photos', 'tags', 'public']]],
+             ['read', [['if-contains', 'galleries', 'tags', 'public']]],
+             ['crud', [['if-equals', 'comments', 'user_id', '_id']]]]},
+    ]
+
+bench_ops = {'crud': ['create', 'read', 'update', 'delete']}
+
+TAG_SETS = [['public'], ['press'], ['internal'], ['public', 'press'], []]
+
+
+def photos(count):
+    """Synthetic photo descriptors with rotating tag sets"""
+    return [{'_id': i, 'tags': TAG_SETS[i % len(TAG_SETS)]} for i in xrange(count)]
+
+
+class LegacyTarget(object):
+    """ResourceTarget.check as before compilation"""
+
+    def __init__(self, target):
+        self.resource = target.resource
+
+    def check(self, subject, resource_class, resource_descriptor, op):
+        return self.resource == resource_class if self.resource else True
+
+
+class LegacyAttributeTarget(LegacyTarget):
+    """Attribute target checks as before compilation. They ignored the resource
+    class; missing attributes are looked up with get (they raised KeyError)."""
+
+    def __init__(self, target):
+        LegacyTarget.__init__(self, target)
+        self.attribute = target.attribute
+        self.value = target.value
+
+    def check(self, subject, resource_class, resource_descriptor, op):
+        LegacyTarget.check(self, subject, resource_class, resource_descriptor, op)
+        return self.value == resource_descriptor.get(self.attribute)
+
+
+class LegacyInclusionTarget(LegacyAttributeTarget):
+
+    def check(self, subject, resource_class, resource_descriptor, op):
+        LegacyTarget.check(self, subject, resource_class, resource_descriptor, op)
+        return self.value in resource_descriptor.get(self.attribute, ())
+
+
+class LegacyEqualityTarget(LegacyAttributeTarget):
+
+    def check(self, subject, resource_class, resource_descriptor, op):
+        if not hasattr(resource_descriptor, '__getitem__'):
+            return False
+        LegacyTarget.check(self, subject, resource_class, resource_descriptor, op)
+        return subject.get(self.value) == resource_descriptor.get(self.attribute)
+
+
+def legacy_target(target):
+    for cls, legacy in ((AttributeEqualityTarget, LegacyEqualityTarget),
+                        (AttributeInclusionTarget, LegacyInclusionTarget),
+                        (AttributeTarget, LegacyAttributeTarget),
+                        (ResourceTarget, LegacyTarget)):
+        if isinstance(target, cls):
+            return legacy(target)
+    return target
+
+
+class LegacyPermission(object):
+
+    def __init__(self, permission):
+        self.operation = permission.operation
+        self.target = legacy_target(permission.target)
+
+    def check(self, subject, resource_class, resource_descriptor):
+        return self.target.check(subject, resource_class, resource_descriptor, self.operation)
+
+
+class LegacySubject(object):
+    """Subject.can as it was before compilation: a set of granted cache keys
+    and per operation the list of permissions, each asking its target"""
+
+    def __init__(self, subject, ops_closure):
+        self.permissions = defaultdict(lambda: [])
+        self.descriptor = subject.descriptor
+        self.cache = set()
+        self.cache_id_field = subject.cache_id_field
+        for role in subject.roles:
+            for permission in role.resolve(ops_closure):
+                self.permissions[permission.operation].append(LegacyPermission(permission))
+
+    def can(self, operation, resource_class=None, resource_descriptor=None):
+        cache_key = None
+
+        try:
+            if resource_descriptor:
+                cache_key = (operation, resource_class, resource_descriptor[self.cache_id_field])
+            else:
+                cache_key = (operation, resource_class)
+            if cache_key in self.cache:
+                return True
+        except KeyError:
+            pass
+
+        if operation in self.permissions:
+            for permission in self.permissions[operation]:
+                if permission.check(self.descriptor, resource_class, resource_descriptor):
+                    if cache_key:
+                        self.cache.add(cache_key)
+                    return True
+        return False
+
+
+def measure(subject, descriptors, rounds):
+    """Returns checks per second of the subject's can over all descriptors"""
+    start = timer()
+    for _ in xrange(rounds):
+        subject.cache.clear()
+        for descriptor in descriptors:
+            subject.can('read', 'photos', descriptor)
+            subject.can('update', 'photos', descriptor)
+    return 2 * rounds * len(descriptors) / (timer() - start)
+
+
+def measure_filter(subject, descriptors, rounds):
+    """Returns descriptors per second passed through Subject.filter"""
+    start = timer()
+    for _ in xrange(rounds):
+        subject.filter('read', 'photos', descriptors)
+        subject.filter('update', 'photos', descriptors)
+    return 2 * rounds * len(descriptors) / (timer() - start)
+
+
+def domain():
+    acd = AccessControlDomain()
+    acd.update_operations_hierarchy(bench_ops)
+    acd.init_role_model(bench_roles)
+    return acd
+
+
+def seeded(count=10000, rounds=5, out=sys.stdout):
+    """Legacy, compiled and batch checks against the seeded role model"""
+    acd = domain()
+    descriptors = photos(count)
+    subjects = [('photographer', {'_id': 'p', 'roles': ['photographer', 'reviewer']}),
+                ('press', {'_id': 'x', 'roles': ['press', 'reviewer']})]
+
+    results = {}
+    for name, descriptor in subjects:
+        subject = acd.create_subject(descriptor)
+        legacy = measure(LegacySubject(subject, acd.ops_closure), descriptors, rounds)
+        compiled = measure(subject, descriptors, rounds)
+        batch = measure_filter(subject, descriptors, rounds)
+        print >> out, "%-14s legacy: %10.0f checks/s  compiled: %10.0f checks/s  (x%.1f)  " \
+              "filter: %10.0f checks/s" % (name, legacy, compiled, compiled / legacy, batch)
+        results[name] = {'legacy_checks_per_s': legacy, 'checks_per_s': compiled,
+                         'filter_per_s': batch}
+    return results
+
+
+# synthetic role models
+
+OPERATIONS = ['create', 'read', 'update', 'delete']
+SYNTHETIC_OPS = {'write': ['create', 'update', 'delete'], 'crud': ['read', 'write']}
+RESOURCE_CLASSES = ['photos', 'galleries', 'comments', 'vetos', 'users']
+TAGS = ['public', 'press', 'internal', 'review', 'archive', 'staff', 'print', 'web']
+
+
+def synthetic_roles(rng, count, depth, targets):
+    """'count' roles in inheritance chains of length 'depth', with 'targets'
+    attribute targets spread over them (plus one plain grant per role)"""
+    roles = []
+    for i in xrange(count):
+        role = {'name': 'role%d' % i,
+                'can': [[rng.choice(OPERATIONS + ['crud']), [rng.choice(RESOURCE_CLASSES)]]]}
+        if i % depth:
+            role['parent'] = 'role%d' % (i - 1)
+        roles.append(role)
+    for i in xrange(targets):
+        role = roles[rng.randrange(count)]
+        if rng.random() < 0.7:
+            target = ['if-contains', rng.choice(RESOURCE_CLASSES), 'tags', rng.choice(TAGS)]
+        else:
+            target = ['if-equals', rng.choice(RESOURCE_CLASSES), 'owner', '_id']
+        role['can'].append([rng.choice(OPERATIONS + ['write']), [target]])
+    rng.shuffle(roles)          # parents do not necessarily come first
+    return roles
+
+
+def synthetic_subjects(rng, count, role_names, roles_per_subject=3, distinct=None):
+    """Subject descriptors with random role sets; 'distinct' bounds the number
+    of different role sets (real populations share few)"""
+    role_sets = [rng.sample(role_names, rng.randint(1, roles_per_subject))
+                 for _ in xrange(distinct or count)]
+    return [{'_id': 'user%d' % i, 'login': 'user%d' % i, 'password': '***',
+             'roles': role_sets[i % len(role_sets)]}
+            for i in xrange(count)]
+
+
+def synthetic_stream(rng, count, owners, distinct=None):
+    """(resource class, descriptor) pairs. Descriptors repeat if 'distinct' is
+    smaller than 'count', popular ones more often (like recent gallery pages)."""
+    resources = []
+    for i in xrange(distinct or count):
+        descriptor = {'_id': i, 'owner': rng.choice(owners),
+                      'tags': rng.sample(TAGS, rng.randint(0, 3))}
+        resources.append((rng.choice(RESOURCE_CLASSES), descriptor))
+    return [resources[int(len(resources) * rng.random() ** 3)] for _ in xrange(count)]
+
+
+def deep_size(obj, exclude=()):
+    """Bytes held by an object and everything it references, except for the
+    objects in 'exclude' (and what only they reference)"""
+    seen = set(id(o) for o in exclude)
+    pending = [obj]
+    size = 0
+    while pending:
+        o = pending.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            pending.extend(o.iterkeys())
+            pending.extend(o.itervalues())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            pending.extend(o)
+        if hasattr(o, '__dict__'):
+            pending.append(o.__dict__)
+        for cls in type(o).__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                if hasattr(o, slot):
+                    pending.append(getattr(o, slot))
+    return size
+
+
+def subject_size(acd, subject):
+    """Memory of a subject, without the domain and the tables it shares"""
+    return deep_size(subject, [acd, subject.table, type(subject)] + acd.roles.values())
+
+
+def synthetic(roles=200, depth=5, targets=400, subjects=2000, role_sets=200,
+              checks=200000, resources=5000, seed=1, out=sys.stdout):
+    rng = random.Random(seed)
+    d_roles = synthetic_roles(rng, roles, depth, targets)
+    descriptors = synthetic_subjects(rng, subjects, [role['name'] for role in d_roles],
+                                     distinct=role_sets)
+    stream = synthetic_stream(rng, checks, [d['_id'] for d in descriptors], resources)
+    ops = [rng.choice(OPERATIONS) for _ in xrange(len(stream))]
+    results = {'parameters': {'roles': roles, 'depth': depth, 'targets': targets,
+                              'subjects': subjects, 'role_sets': role_sets, 'checks': checks,
+                              'resources': resources, 'seed': seed}}
+
+    acd = AccessControlDomain()
+    acd.update_operations_hierarchy(SYNTHETIC_OPS)
+    start = timer()
+    acd.init_role_model(d_roles)
+    results['init_role_model_s'] = timer() - start
+
+    # subject construction: the first subject of a role set compiles it
+    gc.collect()
+    start = timer()
+    population = [acd.create_subject(descriptor) for descriptor in descriptors]
+    elapsed = timer() - start
+    results['create_subject_us'] = elapsed / len(population) * 1e6
+    results['compiled_role_sets'] = len(acd.closures)
+    # warm: role sets are compiled, but subjects are not cached by token
+    subject_cache = acd.subject_cache
+    start = timer()
+    for descriptor in descriptors:
+        subject_cache.clear()
+        acd.create_subject(descriptor)
+    results['create_subject_warm_us'] = (timer() - start) / len(descriptors) * 1e6
+    sizes = [subject_size(acd, subject) for subject in population[:100]]
+    results['subject_bytes'] = sum(sizes) / len(sizes)
+    results['domain_bytes'] = deep_size(acd, [acd.subject_cache])
+
+    # checks, spread over the population
+    def run(clear):
+        for subject in population:
+            subject.cache.clear()
+        start = timer()
+        for i, (resource_class, descriptor) in enumerate(stream):
+            subject = population[i // 100 % len(population)]     # a page of checks each
+            if clear:
+                subject.cache.clear()
+            subject.can(ops[i], resource_class, descriptor)
+        return len(stream) / (timer() - start)
+
+    results['checks_per_s_uncached'] = run(True)
+    for subject in population:
+        subject.cache.hits = subject.cache.misses = subject.cache.evictions = 0
+    results['checks_per_s'] = run(False)
+    hits = sum(subject.cache.hits for subject in population)
+    misses = sum(subject.cache.misses for subject in population)
+    results['cache_hit_rate'] = hits / float(hits + misses) if hits + misses else 0.0
+    results['cache_evictions'] = sum(subject.cache.evictions for subject in population)
+
+    # batch filtering of one page of resources per subject
+    page = [descriptor for resource_class, descriptor in stream[:60]]
+    start = timer()
+    for subject in population:
+        subject.filter('read', 'photos', page)
+    results['filter_per_s'] = len(page) * len(population) / (timer() - start)
+
+    print >> out, "synthetic: %d roles (depth %d, %d targets), %d subjects, %d role sets" % \
+          (roles, depth, targets, subjects, role_sets)
+    print >> out, "  init_role_model %8.1f ms   create_subject %7.1f us (warm %5.1f us)" % \
+          (results['init_role_model_s'] * 1000, results['create_subject_us'],
+           results['create_subject_warm_us'])
+    print >> out, "  memory: %d bytes/subject, %d KiB domain (incl. compiled role sets)" % \
+          (results['subject_bytes'], results['domain_bytes'] / 1024)
+    print >> out, "  uncached %10.0f checks/s   cached %10.0f checks/s (hit rate %.1f%%)   filter %10.0f/s" % \
+          (results['checks_per_s_uncached'], results['checks_per_s'],
+           results['cache_hit_rate'] * 100, results['filter_per_s'])
+    return results
+
+
+def main(argv=None):
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Benchmark the access control system.')
+    parser.add_argument('--photos', type=int, default=10000, help='descriptors of the seeded model')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--roles', type=int, default=200)
+    parser.add_argument('--depth', type=int, default=5, help='length of inheritance chains')
+    parser.add_argument('--targets', type=int, default=400, help='attribute targets in all roles')
+    parser.add_argument('--subjects', type=int, default=2000)
+    parser.add_argument('--role-sets', type=int, default=200, help='distinct role sets of subjects')
+    parser.add_argument('--checks', type=int, default=200000)
+    parser.add_argument('--resources', type=int, default=5000, help='distinct descriptors checked')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', metavar='FILE', help="write results as JSON ('-' for stdout)")
+    args = parser.parse_args(argv)
+
+    out = sys.stderr if args.json == '-' else sys.stdout    # keep stdout parseable
+    results = {'python': platform.python_version(),
+               'seeded': seeded(args.photos, args.rounds, out),
+               'synthetic': synthetic(args.roles, args.depth, args.targets, args.subjects,
+                                      args.role_sets, args.checks, args.resources, args.seed,
+                                      out)}
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return results
+
+
+if __name__ == '__main__':
+    main()
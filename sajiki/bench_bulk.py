@@ -0,0 +1,85 @@
+#
+#   Bulk Write Benchmark
+#
+#   Usage: python bench_bulk.py [documents] [batch size] [--mongo]
+#
+#   Compares one round trip per document with data.BulkWriter. Without --mongo,
+#   an in-process stand-in charges a fixed latency per round trip instead of
+#   talking to a local mongod.
+#
+
+import sys
+import time
+from timeit import default_timer as timer
+
+LATENCY = 0.0005        # seconds per simulated round trip
+
+
+class LatencyCollection(object):
+    """Stand-in for a collection on a remote server"""
+
+    def __init__(self, latency=LATENCY):
+        self.latency = latency
+        self.requests = self.operations = 0
+
+    def _round_trip(self, operations):
+        self.requests += 1
+        self.operations += operations
+        time.sleep(self.latency)
+
+    def update_one(self, key, update, upsert=False):
+        self._round_trip(1)
+
+    def bulk_write(self, requests, ordered=True):
+        self._round_trip(len(requests))
+
+    def drop(self):
+        self.requests = self.operations = 0
+
+
+def documents(count):
+    return [{'location': '/photos/%06d.jpg' % i,
+             'width': 4000, 'height': 3000, 'size': 5 << 20, 'mtime': 1400000000.0 + i}
+            for i in xrange(count)]
+
+
+def one_by_one(collection, docs):
+    for doc in docs:
+        collection.update_one({'location': doc['location']},
+                              {'$set': doc, '$setOnInsert': {'tags': []}}, upsert=True)
+
+
+def buffered(collection, docs, batch_size):
+    from data import BulkWriter
+    with BulkWriter(collection, batch_size) as writer:
+        for doc in docs:
+            writer.upsert({'location': doc['location']}, doc, on_insert={'tags': []})
+    return writer.requests
+
+
+def measure(name, func, count):
+    start = timer()
+    requests = func()
+    elapsed = timer() - start
+    print "%-12s %6d docs in %7.3fs  %9.0f docs/s  %6s round trips" % \
+          (name, count, elapsed, count / elapsed, requests if requests is not None else count)
+
+
+def main(count=10000, batch_size=1000, mongo=False):
+    if mongo:
+        import data
+        collection = data.db.bench_bulk
+    else:
+        collection = LatencyCollection()
+    docs = documents(count)
+
+    collection.drop()
+    measure('one-by-one', lambda: one_by_one(collection, docs), count)
+    collection.drop()
+    measure('bulk', lambda: buffered(collection, docs, batch_size), count)
+    collection.drop()
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if arg != '--mongo']
+    main(*map(int, args[:2]), mongo='--mongo' in sys.argv)
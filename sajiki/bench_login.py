@@ -0,0 +1,86 @@
+#
+#   Login Load Test
+#
+#   Usage: python bench_login.py [base url] [login threads] [static threads] [seconds]
+#
+#   Runs logins of the seeded test users against a running server while other
+#   threads fetch a static file. Reports logins/s and the latency distribution
+#   of the static requests, which should not suffer from concurrent logins.
+#   Every login uses a new wrong password: failures are never cached, so each
+#   one costs a full PBKDF2 verification, and logins beyond the concurrency
+#   limit of the server are rejected (counted as 'overloaded').
+#
+
+import sys
+import threading
+from itertools import count, cycle
+from httplib import HTTPConnection
+from timeit import default_timer as timer
+from urllib import urlencode
+from urlparse import urlparse
+
+TEST_USERS = [('photographer', 'canon'), ('student', 'stud'), ('staff', 'staff'),
+              ('press', 'press'), ('anonymous', 'anon')]
+STATIC_PATH = '/bootstrap.css'
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else 0.0
+
+
+def login_paths(thread):
+    """Logins of the test users in turn, each with a password never used before"""
+    for i in count():
+        login, password = TEST_USERS[i % len(TEST_USERS)]
+        yield '/login?' + urlencode({'login': login, 'password': '%s-%d-%d' % (password, thread, i)})
+
+
+def worker(netloc, paths, latencies, errors, deadline, overloaded=None):
+    """Requests the paths in turn until the deadline, recording latencies"""
+    connection = HTTPConnection(netloc)
+    while timer() < deadline:
+        path = next(paths)
+        start = timer()
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            body = response.read()
+        except Exception:
+            errors.append(path)
+            connection = HTTPConnection(netloc)
+            continue
+        if response.status >= 400:
+            errors.append(path)
+        elif overloaded is not None and 'Too many logins' in body:
+            overloaded.append(path)
+            continue
+        latencies.append(timer() - start)
+
+
+def run(base='http://localhost:8080', login_threads=4, static_threads=4, seconds=10):
+    netloc = urlparse(base).netloc
+    deadline = timer() + seconds
+    logins, statics, errors, overloaded = [], [], [], []
+
+    threads = [threading.Thread(target=worker, args=(netloc, login_paths(i), logins, errors,
+                                                     deadline, overloaded))
+               for i in xrange(login_threads)]
+    threads += [threading.Thread(target=worker, args=(netloc, cycle([STATIC_PATH]), statics,
+                                                      errors, deadline))
+                for _ in xrange(static_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print "logins:  %8.1f /s   p50 %7.1f ms   p99 %7.1f ms" % \
+          (len(logins) / float(seconds), percentile(logins, 0.5) * 1000, percentile(logins, 0.99) * 1000)
+    print "static:  %8.1f /s   p50 %7.1f ms   p99 %7.1f ms" % \
+          (len(statics) / float(seconds), percentile(statics, 0.5) * 1000, percentile(statics, 0.99) * 1000)
+    print "overloaded: %d   errors: %d" % (len(overloaded), len(errors))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    run(*(args[:1] + map(int, args[1:4])))
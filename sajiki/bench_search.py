@@ -0,0 +1,142 @@
+#
+#   Search Benchmark
+#
+#   Usage: python bench_search.py [number of photos] [queries] [--find]
+#
+#   Builds the inverted index over synthetic photos (tags drawn with a skewed
+#   distribution from a taxonomy of 2000 tags, dates over ten years) and
+#   reports the latency of finding the first page of matches, as the search
+#   page does before fetching the records.
+#
+#   With --find, the photos are written to a scratch collection and the whole
+#   Search.find is timed for a reviewer who may only read photos tagged
+#   'public' or 'press', including the permitted fetch from the database.
+#
+
+import random
+import sys
+from itertools import islice
+from timeit import default_timer as timer
+
+from search import InvertedIndex, Search, Taxonomy, parse_query, SEARCH_PAGE
+
+TAGS = ['tag%d' % i for i in xrange(2000)]
+YEAR = 365 * 24 * 3600.0
+START = 1262304000.0        # 2010-01-01
+
+
+def taxonomy():
+    """Every tag below 100 has 19 hyponyms, every tag below 1000 a synonym"""
+    hyponyms = dict(('tag%d' % i, ['tag%d' % (100 + 19 * i + j) for j in xrange(19)])
+                    for i in xrange(100))
+    synonyms = dict(('tag%d' % i, ['alias%d' % i]) for i in xrange(1000))
+    return Taxonomy(hyponyms, synonyms)
+
+
+def photos(rng, count):
+    for i in xrange(count):
+        tags = set(TAGS[int(len(TAGS) * rng.random() ** 3)] for _ in xrange(rng.randint(1, 8)))
+        if rng.random() < 0.6:
+            tags.add('public')
+        elif rng.random() < 0.05:
+            tags.add('press')
+        yield {'_id': i, 'date': START + rng.random() * 10 * YEAR, 'tags': list(tags)}
+
+
+def queries(rng, count):
+    result = []
+    for _ in xrange(count):
+        words = [TAGS[int(len(TAGS) * rng.random() ** 2)] for _ in xrange(rng.randint(1, 3))]
+        if rng.random() < 0.3:
+            words.append('-' + TAGS[rng.randrange(len(TAGS))])
+        if rng.random() < 0.3:
+            words.append('from:%d' % rng.randint(2010, 2019))
+        if rng.random() < 0.2:
+            words.append('public')
+        result.append(' '.join(words))
+    return result
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else 0.0
+
+
+def main(count=1000000, query_count=1000):
+    rng = random.Random(1)
+    start = timer()
+    index = InvertedIndex(photos(rng, count))
+    print "index of %d photos built in %.1f s, %d tags" % \
+          (len(index), timer() - start, len(index.postings))
+
+    tax = taxonomy()
+    latencies = []
+    found = 0
+    for text in queries(rng, query_count):
+        start = timer()
+        query = parse_query(text, tax)
+        page = list(islice(index.positions(query), SEARCH_PAGE))
+        latencies.append(timer() - start)
+        found += len(page)
+
+    print "%d queries, %.1f matches per page" % (len(latencies), found / float(len(latencies)))
+    print "latency: p50 %6.2f ms   p95 %6.2f ms   p99 %6.2f ms   max %6.2f ms" % \
+          tuple(percentile(latencies, f) * 1000 for f in (0.5, 0.95, 0.99, 1.0))
+
+
+def permitted_find(collection, subject):
+    """Like helpers.readable_images, for a subject outside of a request"""
+    from data import conjunction
+    acl, exact = subject.query('read', 'photos')
+
+    def find(spec, fields, **kwargs):
+        cursor = collection.find(conjunction(spec, acl), fields, **kwargs)
+        return cursor if exact else subject.ifilter('read', 'photos', cursor)
+    return find
+
+
+def main_find(count=100000, query_count=300):
+    from access import AccessControlDomain
+    from data import db, GALLERY_FIELDS, BulkWriter, GALLERY_ORDER
+
+    rng = random.Random(1)
+    collection = db.bench_images
+    collection.drop()
+    with BulkWriter(collection) as writer:
+        for photo in photos(rng, count):
+            writer.insert(photo)
+    collection.create_index(GALLERY_ORDER)
+    collection.create_index([('tags', 1)] + GALLERY_ORDER)
+
+    domain = AccessControlDomain()
+    domain.init_role_model([{'name': 'reviewer',
+                             'can': [['read', [['if-contains', 'photos', 'tags', 'public'],
+                                               ['if-contains', 'photos', 'tags', 'press']]]]}])
+    subject = domain.create_subject({'id': 1, 'roles': ['reviewer']})
+    find = permitted_find(collection, subject)
+    acl = subject.query('read', 'photos')
+
+    try:
+        search = Search(collection, taxonomy(), in_memory=True)
+        search.rebuild()
+        for name, index in (('database', None), ('in-memory index', search.index)):
+            search.index, search.in_memory = index, index is not None
+            latencies = []
+            found = 0
+            for text in queries(random.Random(2), query_count):
+                start = timer()
+                found += len(list(search.find(search.parse(text), find, GALLERY_FIELDS, acl=acl)))
+                latencies.append(timer() - start)
+            print "%-16s %.1f matches per page   p50 %6.2f ms   p95 %6.2f ms   max %6.2f ms" % \
+                  ((name, found / float(len(latencies))) +
+                   tuple(percentile(latencies, f) * 1000 for f in (0.5, 0.95, 1.0)))
+    finally:
+        collection.drop()
+
+
+if __name__ == '__main__':
+    if '--find' in sys.argv:
+        sys.argv.remove('--find')
+        main_find(*map(int, sys.argv[1:3]))
+    else:
+        main(*map(int, sys.argv[1:3]))
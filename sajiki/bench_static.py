@@ -0,0 +1,106 @@
+#
+#   Static File Benchmark
+#
+#   Usage: python bench_static.py [requests]
+#
+#   Calls the WSGI application in-process with preview requests of a logged
+#   in user, as a gallery page with its thumbnails causes them. Compares the
+#   former stack (Beaker file sessions saved on every request and the
+#   before_request hook in front of every route) with the fast path which
+#   serves static files without sessions. Requires the database like the
+#   server does, and Beaker.
+#
+
+import os
+import shutil
+import sys
+import tempfile
+from io import BytesIO
+from timeit import default_timer as timer
+
+from bottle import Bottle
+
+import server
+from helpers import setup_request
+
+DIGEST = '0' * 40
+SESSION_ID = 'b' * 32
+
+
+def token():
+    return server.access_control.create_subject(
+        {'_id': 'bench', 'login': 'bench', 'roles': ['reviewer']}).id
+
+
+def legacy_app(session_dir):
+    """Static routes behind Beaker file sessions, with the request hook, as
+       the server was set up before the fast path"""
+    from beaker.middleware import SessionMiddleware
+    from beaker.session import Session
+
+    session = Session({}, id=SESSION_ID, type='file', data_dir=session_dir)
+    session['token'] = token()
+    session.save()
+
+    app = Bottle()
+    app.merge(server.assets)
+    app.add_hook('before_request', lambda: setup_request(server.access_control, server.search,
+                                                         server.preview_signer))
+    options = {'session.type': 'file', 'session.data_dir': session_dir, 'session.auto': True}
+    return SessionMiddleware(app, options, environ_key='sajiki.session')
+
+
+def logged_in_cookie():
+    server.session_store.save(SESSION_ID, {'token': token()}, 3600)
+    return 'beaker.session.id=%s; sajiki.session=%s' % (SESSION_ID, SESSION_ID)
+
+
+def environ(url, cookie):
+    path, _, query = url.partition('?')
+    return {'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'SCRIPT_NAME': '',
+            'QUERY_STRING': query, 'SERVER_NAME': 'localhost', 'SERVER_PORT': '8080',
+            'SERVER_PROTOCOL': 'HTTP/1.1', 'HTTP_COOKIE': cookie,
+            'wsgi.url_scheme': 'http', 'wsgi.input': BytesIO(), 'wsgi.errors': sys.stderr}
+
+
+def measure(app, path, cookie, count):
+    """Requests per second of app for the path"""
+    statuses = []
+
+    def start_response(status, headers, exc_info=None):
+        statuses.append(status)
+
+    start = timer()
+    for _ in xrange(count):
+        body = app(environ(path, cookie), start_response)
+        for chunk in body:
+            pass
+        if hasattr(body, 'close'):
+            body.close()
+    elapsed = timer() - start
+    if not statuses[-1].startswith('200'):
+        raise SystemExit("%s: %s" % (path, statuses[-1]))
+    return count / elapsed
+
+
+def main(count=5000):
+    store = server.preview_store
+    path = store.path(DIGEST, 'small')
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write('\xff\xd8' + 'x' * 8000 + '\xff\xd9')     # a typical small preview
+
+    cookie = logged_in_cookie()
+    url = server.preview_signer.sign(store.url(DIGEST, 'small'))
+    session_dir = tempfile.mkdtemp()
+    try:
+        for name, app in (('beaker + hooks', legacy_app(session_dir)), ('fast path', server.app)):
+            print "%-16s %8.0f requests/s  %s" % (name, measure(app, url, cookie, count), url)
+    finally:
+        os.remove(path)
+        shutil.rmtree(session_dir)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
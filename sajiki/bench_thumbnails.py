@@ -0,0 +1,87 @@
+#
+#   Thumbnail Benchmark
+#
+#   Usage: python bench_thumbnails.py [image files...]
+#
+#   Renders previews with the former full-resolution decode and with the
+#   draft-mode ladder of thumbnails.py. Each run happens in a fresh process
+#   to report its peak RSS. Without arguments, a synthetic 24 megapixel
+#   JPEG is generated.
+#
+
+import os
+import sys
+import resource
+import tempfile
+from multiprocessing import Process, Pipe
+from timeit import default_timer as timer
+
+import thumbnails
+
+
+def full_decode(path, outdir):
+    """Preview rendering as previously done by data.index_image"""
+    from PIL import Image
+    im = Image.open(path)
+    w, h = im.size
+    im.resize((160, 160 * h / w)).save(os.path.join(outdir, 'small.jpg'))
+
+
+def ladder(path, outdir):
+    from PIL import Image
+    thumbnails.render_previews(
+        Image.open(path),
+        dict((name, os.path.join(outdir, '%s.jpg' % name))
+             for name, width in thumbnails.PREVIEW_SIZES))
+
+
+def idle(path, outdir):
+    """Baseline: interpreter and PIL without decoding anything"""
+    from PIL import Image
+
+
+def _child(func, path, outdir, conn):
+    start = timer()
+    func(path, outdir)
+    elapsed = timer() - start
+    conn.send((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    conn.close()
+
+
+def run(func, path, outdir):
+    """Returns (seconds, peak RSS in KiB) of func in a separate process"""
+    parent, child = Pipe()
+    process = Process(target=_child, args=(func, path, outdir, child))
+    process.start()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def synthetic_image(directory, size=(6000, 4000)):
+    from PIL import Image, ImageDraw
+    path = os.path.join(directory, 'synthetic.jpg')
+    im = Image.new('RGB', size, (90, 120, 150))
+    draw = ImageDraw.Draw(im)
+    for x in xrange(0, size[0], 40):
+        draw.line((x, 0, size[0] - x, size[1]), fill=(x % 256, 200, 40), width=3)
+    im.save(path, quality=90)
+    return path
+
+
+def main(paths):
+    outdir = tempfile.mkdtemp()
+    if not paths:
+        paths = [synthetic_image(outdir)]
+
+    base_time, base_rss = run(idle, None, outdir)
+    print "baseline RSS: %d KiB" % base_rss
+    for path in paths:
+        for name, func in (('full decode', full_decode), ('draft ladder', ladder)):
+            elapsed, rss = run(func, path, outdir)
+            print "%-40s %-14s %8.1f ms  peak RSS +%7d KiB" % \
+                  (os.path.basename(path), name, elapsed * 1000, rss - base_rss)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -2,15 +2,105 @@
 #   Database Operations
 #
 
-from pymongo import MongoClient
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import MongoClient, InsertOne, UpdateOne, ASCENDING, DESCENDING, GEOSPHERE
 from beaker.crypto.pbkdf2 import crypt
 
+import variants
+
 db = MongoClient('localhost').sajiki
 
 users = db.users
 roles = db.roles
 operations = db.operations
 images = db.images
+meta = db.meta
+taxonomy = db.taxonomy
+
+# user fields needed to log in, also available to attribute-based permissions
+LOGIN_FIELDS = {'login': 1, 'name': 1, 'password': 1, 'roles': 1}
+
+# gallery listings: newest first, only the fields the gallery displays
+GALLERY_ORDER = [('date', DESCENDING), ('_id', DESCENDING)]
+GALLERY_FIELDS = {'previews.small': 1, 'hash': 1, 'width': 1, 'height': 1, 'date': 1}
+GALLERY_PAGE = 60
+
+def refers_to(spec, fields):
+    """Whether a filter document tests any of the fields"""
+    if isinstance(spec, dict):
+        return any(key in fields or refers_to(value, fields) for key, value in spec.iteritems())
+    if isinstance(spec, list):
+        return any(refers_to(item, fields) for item in spec)
+    return False
+
+
+def tag_updates(add=(), remove=()):
+    """Update documents which add and remove tags. A single update cannot
+    both add to and pull from the same array, so there may be two."""
+    remove = [tag for tag in remove if tag not in add]
+    updates = []
+    if add:
+        updates.append({'$addToSet': {'tags': {'$each': list(add)}}})
+    if remove:
+        updates.append({'$pull': {'tags': {'$in': remove}}})
+    return updates
+
+
+def conjunction(*specs):
+    """Combines query filter documents, skipping empty ones"""
+    specs = [spec for spec in specs if spec]
+    if len(specs) > 1:
+        return {'$and': specs}
+    return specs[0] if specs else {}
+
+
+class BulkWriter(object):
+    """Buffers write operations on a collection and sends them as unordered
+    bulk requests of 'batch_size' operations. Flushes when used as a context manager."""
+
+    def __init__(self, collection, batch_size=1000, ordered=False):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.ordered = ordered
+        self.pending = []
+        self.requests = 0           # round trips so far
+        self.operations = 0
+
+    def insert(self, document):
+        self.add(InsertOne(document))
+
+    def upsert(self, key, document, on_insert=None, add_to_set=None):
+        """Sets the document's fields on the record matching 'key' or creates it.
+        Fields in 'on_insert' are only set on new records, the values listed
+        in 'add_to_set' are added to the arrays of new and existing records."""
+        update = {'$set': document}
+        if on_insert:
+            update['$setOnInsert'] = on_insert
+        if add_to_set:
+            update['$addToSet'] = dict((field, {'$each': values})
+                                       for field, values in add_to_set.iteritems())
+        self.add(UpdateOne(key, update, upsert=True))
+
+    def add(self, operation):
+        self.pending.append(operation)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            pending, self.pending = self.pending, []
+            self.collection.bulk_write(pending, ordered=self.ordered)
+            self.requests += 1
+            self.operations += len(pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
 
 class DataObject(object):
     def __init__(self, record):
@@ -21,10 +111,50 @@ class DataObject(object):
         return self._id
 
 class DataImage(DataObject):
+    """An image record. Preview URLs are passed through 'sign', which
+    authorizes them for a while (see previews.UrlSigner)."""
+
+    def __init__(self, record, sign=None):
+        DataObject.__init__(self, record)
+        self.sign = sign or (lambda url: url)
 
     @property
     def small_preview(self):
-        return self.previews['small']
+        return self.sign(self.previews['small'])
+
+    @property
+    def medium_preview(self):
+        return self.sign(self.previews.get('medium', self.previews['small']))
+
+    @property
+    def large_preview(self):
+        previews = self.previews
+        return self.sign(previews.get('large', previews.get('medium', previews['small'])))
+
+    def variant(self, width, height, fmt='jpg'):
+        """URL of the image fitted into width x height pixels"""
+        return self.sign(variants.url(self.hash, width, height, fmt))
+
+class GalleryPage(object):
+    """Images of a gallery page, converted while iterating (which may happen only
+    once). Afterwards, next_key tells where the following page starts."""
+
+    def __init__(self, records, size=GALLERY_PAGE, sign=None):
+        self.records = records
+        self.size = size
+        self.sign = sign
+        self.count = 0
+        self.last = None
+
+    def __iter__(self):
+        for record in self.records:
+            self.count += 1
+            self.last = record
+            yield DataImage(record, self.sign)
+
+    @property
+    def next_key(self):
+        return page_key(self.last) if self.count == self.size else None
 
 class GuestUser(DataObject):
     def __init__(self):
@@ -35,39 +165,86 @@ Guest = GuestUser()  # Singleton :P
 
 
 
-def init_images(base='./test-images'):
-    print "Indexing images..."
-    images.drop()
-    import os
+def role_model_stamp():
+    """Counter bumped on every change of roles or operations"""
+    record = meta.find_one({'_id': 'role_model'}, {'stamp': 1})
+    return record['stamp'] if record else 0
 
-    for f in os.listdir(base):
-        path = os.path.join(base, f)
-        if os.path.isdir(path):
-            init_images(path)
-        elif f.endswith('.jpg'):
-            index_image(path)
 
-def index_image(imgfile):
-    from PIL import Image
-    from hashlib import sha1
-    import os
+def role_model_changed():
+    """Tells all running servers to reload roles and operations"""
+    meta.update_one({'_id': 'role_model'}, {'$inc': {'stamp': 1}}, upsert=True)
+
+
+def ensure_indexes():
+    users.create_index('login', unique=True)
+    images.create_index('location', unique=True)
+    images.create_index('hash')
+    images.create_index(GALLERY_ORDER)
+    images.create_index([('tags', ASCENDING)] + GALLERY_ORDER)    # multikey, for search
+    images.create_index([('rating', DESCENDING)] + GALLERY_ORDER)
+    images.create_index([('geo', GEOSPHERE)])      # skips photos without coordinates
+
+
+def page_key(image):
+    """Position of an image in gallery order, as used in URLs"""
+    return '%r_%s' % (image['date'], image['_id'])
 
-    cachefile = './cache/%s.jpg' % sha1(imgfile).hexdigest()
-    im = Image.open(imgfile)
-    w, h = im.size
-    im.resize((160, 160 * h / w)).save(cachefile)
 
-    images.insert(
-        {'location' : imgfile,
-         'previews' : {
-             'small' : cachefile
-         },
-         'width' : w,
-         'height' : h,
-         'date' : os.path.getctime(imgfile),
-         'tags' : []
-        }
-    )
+def parse_page_key(key):
+    """The (date, id) pair of a page key, None if there is no valid key"""
+    if not key:
+        return None
+    try:
+        date, id = key.split('_')
+        return float(date), ObjectId(id)
+    except (ValueError, InvalidId):
+        return None
+
+
+def after_page_key(key):
+    """Filter for the images following the page key in gallery order (keyset
+    pagination: the database seeks in the index instead of skipping rows)"""
+    key = parse_page_key(key)
+    if key is None:
+        return {}
+    date, id = key
+    return {'$or': [{'date': {'$lt': date}},
+                    {'date': date, '_id': {'$lt': id}}]}
+
+
+def load_taxonomy():
+    from search import Taxonomy
+    return Taxonomy.from_records(taxonomy.find())
+
+
+def init_taxonomy():
+    taxonomy.drop()
+    with BulkWriter(taxonomy) as writer:
+        for record in [
+                {'name': 'animal', 'includes': ['dog', 'cat', 'bird', 'horse']},
+                {'name': 'dog', 'synonyms': ['hound'], 'includes': ['puppy']},
+                {'name': 'cat', 'synonyms': ['kitty']},
+                {'name': 'people', 'synonyms': ['person'], 'includes': ['portrait', 'crowd']},
+                {'name': 'event', 'includes': ['concert', 'lecture', 'graduation']},
+                {'name': 'landscape', 'synonyms': ['scenery'], 'includes': ['mountain', 'beach']}]:
+            writer.insert(record)
+
+
+def original_of(digest):
+    """Location of an original image by its content hash"""
+    doc = images.find_one({'hash': digest}, {'location': 1})
+    return doc['location'] if doc else None
+
+
+def init_images(base='./test-images'):
+    import indexer
+    print "Indexing images..."
+    indexer.index(base)
+
+def index_image(imgfile):
+    import indexer
+    indexer.store([indexer.render(indexer.job(imgfile))])
 
 
 
@@ -79,6 +256,10 @@ def init_users():
     roles.drop()
     operations.drop()
 
+    new_users = BulkWriter(users)
+    new_roles = BulkWriter(roles)
+    new_operations = BulkWriter(operations)
+
     #
     #   Example User Database:
     #       admin/admin         -> all permissions
@@ -88,61 +269,61 @@ def init_users():
     #       press/press         -> see press/public material, comment/vote/veto press-/public material
     #       anonymous/anon      -> see public material
 
-    users.insert({
+    new_users.insert({
         'login': 'admin',
         'name': 'Administrator',
         'password': crypt('admin'),
         'roles': ['admin']})
 
-    users.insert({
+    new_users.insert({
         'login': 'photographer',
         'name': 'Test Photographer',
         'password': crypt('canon'),
         'roles': ['photographer', 'reviewer'],
     })
 
-    users.insert({
+    new_users.insert({
         'login': 'student',
         'password': crypt('stud'),
         'name': 'Test Student',
         'roles': ['reviewer'],
     })
 
-    users.insert({
+    new_users.insert({
         'login': 'staff',
         'name': 'Test Staff Member',
         'password': crypt('staff'),
         'roles': ['reviewer'],
     })
 
-    users.insert({
+    new_users.insert({
         'login': 'press',
         'name': 'Test Press Member',
         'password': crypt('press'),
         'roles': ['press', 'reviewer'],
     })
 
-    users.insert({
+    new_users.insert({
         'login': 'anonymous',
         'name': 'Random Guest',
         'password': crypt('anon'),
         'roles': ['guest'],
     })
 
-    roles.insert({
+    new_roles.insert({
         'name': 'admin',
         'can': [
             ['crud', ['users', 'roles', 'photos', 'comments']]
         ]})
 
-    roles.insert({
+    new_roles.insert({
         'name': 'photographer',
         'can': [
             ['crud', ['photos', 'galleries']],
             ['delete', ['comments']]
         ]})
 
-    roles.insert({
+    new_roles.insert({
         'name': 'reviewer',
         'can': [
             ['create', ['comments', 'vetos']],
@@ -152,7 +333,7 @@ def init_users():
             ['crud', [['if-equals', 'comments', 'user_id', '_id']]]
         ]})
 
-    roles.insert({
+    new_roles.insert({
         'name': 'press',
         'parent' : 'reviewer',
         'can': [
@@ -160,8 +341,10 @@ def init_users():
                       ['if-contains', 'galleries', 'tags', 'press']]],
     ]})
 
-    operations.insert({
+    new_operations.insert({
         'name': 'crud',
         'includes': ['create', 'read', 'update', 'delete']})
 
-
+    for writer in (new_users, new_roles, new_operations):
+        writer.flush()
+    role_model_changed()
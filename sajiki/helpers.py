@@ -2,11 +2,19 @@
 #   Helpers/Decorators
 #
 
-from bottle import jinja2_view, request, HTTPError
+import logging
+from functools import wraps
+from itertools import islice
+from threading import Thread
+from time import sleep
+from bottle import jinja2_view, request, HTTPError, TEMPLATE_PATH, Jinja2Template
+from jinja2 import Environment, FileSystemLoader
 from access import AccessControlDomain, NullSubject
 import data
 from data import Guest, users, DataObject
-from beaker.crypto.pbkdf2 import crypt
+from auth import PasswordVerifier, Overloaded
+
+log = logging.getLogger('sajiki')
 
 # --- REQUEST HANDLING  ---
 
@@ -16,6 +24,35 @@ def view(name):
     return jinja2_view('%s.jinja2' % name)
 
 
+STREAM_BUFFER = 20      # template events per chunk sent to the client
+stream_environment = None
+
+
+def get_stream_environment():
+    """Template environment for streaming, created after TEMPLATE_PATH is configured"""
+    global stream_environment
+    if stream_environment is None:
+        stream_environment = Environment(loader=FileSystemLoader(TEMPLATE_PATH), autoescape=True)
+        stream_environment.globals.update(Jinja2Template.settings.get('globals', {}))
+    return stream_environment
+
+
+def stream_view(name):
+    """Like view, but the page is sent while it is rendered. Handlers may
+    return iterators (e.g. database cursors), which are consumed lazily."""
+    def stream_decorator(func):
+        @wraps(func)
+        def stream_wrapper(*args, **kwargs):
+            result = func(*args, **kwargs)
+            if not isinstance(result, dict):
+                return result
+            stream = get_stream_environment().get_template('%s.jinja2' % name).stream(**result)
+            stream.enable_buffering(STREAM_BUFFER)
+            return stream
+        return stream_wrapper
+    return stream_decorator
+
+
 def session(func):
     """Decorator which adds a bunch of session parameters to a handler's response.
     Only applicable to view-decorated handlers!"""
@@ -23,7 +60,7 @@ def session(func):
         result = func(*args, **kwargs)
 
         # Additional parameters sent to the template renderer:
-        result.update({'user': request.session['user'],
+        result.update({'user': request.session.get('user', Guest),
                        'subject': request.subject,
                        'logged_in': 'token' in request.session})
         return result
@@ -36,50 +73,159 @@ def can(action, resource_class=None, resource_desc=None):
     if not request.subject.can(action, resource_class, resource_desc):
         raise HTTPError(403, "This action requires '%s' privilege on '%s'" % (action, resource_class))
 
+def find_permitted(collection, action, resource_class, spec=None, fields=None, **kwargs):
+    """Finds documents on which the logged in user can perform 'action'.
+    Permissions are pushed down into the query wherever possible."""
+    subject = request.subject
+    acl, exact = subject.query(action, resource_class)
+    if acl is None:
+        return iter(())
+    spec = data.conjunction(spec, acl)
+    if exact:
+        return collection.find(spec, fields, **kwargs)
+
+    # the remaining checks need the attributes they inspect
+    if fields is not None:
+        attributes = subject.attributes(action, resource_class)
+        if attributes is None:
+            fields = None
+        elif isinstance(fields, dict):
+            fields = dict(fields, **dict.fromkeys(attributes, 1))
+        else:
+            fields = list(fields) + sorted(attributes.difference(fields))
+    # denied documents must not shorten the result: read on until 'limit'
+    limit = kwargs.pop('limit', 0)
+    if limit:
+        kwargs['batch_size'] = limit
+    permitted = subject.ifilter(action, resource_class, collection.find(spec, fields, **kwargs))
+    return islice(permitted, limit) if limit else permitted
+
+
+def update_permitted(collection, resource_class, spec, updates):
+    """Applies each update to all documents matching the spec which the logged
+    in user can update, as one update_many, whatever the number of documents.
+    Returns the UpdateResults."""
+    subject = request.subject
+    acl, exact = subject.query('update', resource_class)
+    if acl is None:
+        raise HTTPError(403, "This action requires 'update' privilege on '%s'" % resource_class)
+    spec = data.conjunction(spec, acl)
+    modified = set(field for update in updates for changes in update.itervalues()
+                   for field in changes)
+    if not exact:
+        # some permissions can only be checked here
+        cursor = collection.find(spec)
+        spec = {'_id': {'$in': [document['_id'] for document in
+                                subject.ifilter('update', resource_class, cursor)]}}
+    elif len(updates) > 1 and data.refers_to(spec, modified):
+        # later updates must not select by what earlier ones changed
+        spec = {'_id': {'$in': [document['_id'] for document in collection.find(spec, {'_id': 1})]}}
+    return [collection.update_many(spec, update) for update in updates]
+
+
+def sign_url(url):
+    """Authorizes a preview URL of an image the user can read (for listings)"""
+    return request.signer.sign(url) if request.signer else url
+
+def readable_images(spec, fields, **kwargs):
+    """Images matching the spec which the logged in user can see"""
+    return find_permitted(data.images, 'read', 'photos', spec, fields, **kwargs)
+
 # --- SETUP  ---
 
 
-def load_access_control():
-    """Load Access Control from Database"""
+def load_access_control(secret=None):
+    """Load Access Control from Database. All processes serving the
+    application must share the secret to accept each other's tokens."""
+    from bson import json_util
     access = AccessControlDomain()
-    ops = {}
-    for operation in data.operations.find():
-        ops[operation['name']] = operation['includes']
+    access.token_codec = (json_util.dumps, json_util.loads)    # ObjectIds in descriptors
+    if secret:
+        access.secret = secret
+    d_roles, ops = read_role_model()
     access.update_operations_hierarchy(ops)
-    access.init_role_model(list(data.roles.find()))
+    access.init_role_model(d_roles)
     return access
 
 
-def setup_request(access_control):
+def read_role_model():
+    """Role descriptions and operations hierarchy as stored in the database"""
+    ops = {}
+    for operation in data.operations.find():
+        ops[operation['name']] = operation['includes']
+    return list(data.roles.find()), ops
+
+
+class RoleModelWatcher(Thread):
+    """Polls the role model stamp and reloads changed roles into the domain.
+    (Change streams would require a replica set, polling works everywhere.)"""
+
+    def __init__(self, access_control, interval=5.0):
+        Thread.__init__(self, name='RoleModelWatcher')
+        self.daemon = True
+        self.access_control = access_control
+        self.interval = interval
+        self.stamp = data.role_model_stamp()
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            try:
+                stamp = data.role_model_stamp()
+                if stamp == self.stamp:
+                    continue
+                d_roles, ops = read_role_model()
+            except Exception:
+                log.exception("Role model could not be read")     # tried again
+                continue
+            try:
+                affected = self.access_control.reload(d_roles, ops)
+            except (ValueError, TypeError, KeyError, Warning):
+                log.exception("Role model is invalid, kept the current one")
+                self.stamp = stamp      # try again after the next change
+                continue
+            except Exception:
+                log.exception("Role model reload failed")
+                continue
+            self.stamp = stamp
+            log.info("Role model reloaded: %s", ', '.join(sorted(affected)) or 'no changes')
+
+
+def setup_request(access_control, search=None, signer=None):
     """Enrich current request with user and access control data"""
-    request.session = session = request.environ['beaker.session']
+    request.session = session = request.environ['sajiki.session']
     request.access_control = access_control
+    request.search = search
+    request.signer = signer
 
-    if not 'user' in session:
-        session['user'] = Guest
-
+    # guests are not stored, so they never create a session
+    request.subject = NullSubject
     if 'token' in session:
-        token = session['token']
-        if access_control.validate_subject(token):
-            request.subject = access_control.get_subject_by_id(token)
+        subject = access_control.subject_from_token(session['token'])
+        if subject is not None:
+            request.subject = subject
         else:
-            request.subject = NullSubject
-    else:
-        request.subject = NullSubject
+            # expired or no longer valid: log out
+            del session['token']
+            session.pop('user', None)
 
 
 # --- LOGIN & LOGOUT ---
 
+password_verifier = PasswordVerifier()
+
 def do_login(access_control, session, login, password):
     """Login user, establish privileges in session"""
-    db_users = list(users.find({'login': login}))
-    if db_users:
-        assert len(db_users) == 1, "Multiple users named %s!" % login
-
-        db_user = db_users[0]
-        passwd_hash = db_user['password']
-
-        if passwd_hash == crypt(password, passwd_hash):
+    db_user = users.find_one({'login': login}, data.LOGIN_FIELDS)     # unique index
+    if db_user:
+        try:
+            valid, new_hash = password_verifier.verify(password, db_user['password'])
+        except Overloaded:
+            return "Too many logins at the moment, please try again."
+        if new_hash:
+            users.update_one({'_id': db_user['_id']}, {'$set': {'password': new_hash}})
+
+        if valid:
             session['user'] = DataObject(db_user)                  # USER DATA
             session['token'] = access_control.create_subject(db_user).id   # ACCESS TOKEN
             session.save()
@@ -94,12 +240,10 @@ def do_login(access_control, session, login, password):
 def do_logout(access_control, session):
     """Logout user, retract privileges from session"""
     if 'token' in session:
-        token = session['token']
-        if access_control.validate_subject(token):
-            access_control.forget_subject(token)
+        access_control.forget_subject(session['token'])
         del session['token']
 
     if 'user' in request.session:
         print "Logout: ", session['user'].login
         del session['user']
-    session.save()
\ No newline at end of file
+    session.delete()
\ No newline at end of file
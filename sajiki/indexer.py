@@ -0,0 +1,195 @@
+#
+#   Image Indexer
+#
+#   Usage: python indexer.py [base directory] [--workers N] [--batch N]
+#
+#   Walks the photo share, decodes new or modified JPEGs in a process pool,
+#   reads their metadata, renders their previews and writes the results to
+#   the database in batches. Files whose (path, size, mtime) did not change
+#   since the last run are skipped, unless their metadata is outdated.
+#
+
+import os
+import sys
+from io import BytesIO
+from multiprocessing import Pool, cpu_count
+from timeit import default_timer as timer
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir     # backport for Python 2
+
+import data
+from metadata import read_metadata, METADATA_VERSION
+from previews import PreviewStore, PREVIEW_BUDGET, content_hash
+from search import normalize_tag
+
+EXTENSIONS = ('.jpg', '.jpeg')
+REPORT_INTERVAL = 5.0       # seconds between progress reports
+
+
+def scan(base):
+    """Yields (path, size, mtime) of all JPEG files below base"""
+    pending = [base]
+    while pending:
+        for entry in scandir(pending.pop()):
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+            elif entry.name.lower().endswith(EXTENSIONS):
+                stat = entry.stat()
+                yield entry.path, stat.st_size, stat.st_mtime
+
+
+def job(path):
+    """Describes a single file like scan() does"""
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime
+
+
+preview_store = PreviewStore('./cache', PREVIEW_BUDGET)
+
+
+def render(job):
+    """Reads the metadata of an image from its header, then decodes it and
+       writes its previews unless the same content has been rendered before.
+       Runs in a worker process. Returns (path, document, error)."""
+    from PIL import Image
+    from thumbnails import upright
+
+    path, size, mtime = job
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest = content_hash(content)
+        im = Image.open(BytesIO(content))
+        document = read_metadata(im, content)
+        orientation = document['orientation']
+        if preview_store.complete(digest):
+            w, h = upright(im.size, orientation)
+        else:
+            w, h = preview_store.render(im, digest, orientation)
+    except Exception as e:
+        return path, None, '%s: %s' % (type(e).__name__, e)
+
+    document.setdefault('date', mtime)      # not taken by a camera
+    document.update({
+        'location': path,
+        'hash': digest,
+        'previews': preview_store.urls(digest),
+        'width': w,
+        'height': h,
+        'size': size,
+        'mtime': mtime,
+        'metadata': METADATA_VERSION,
+    })
+    return path, document, None
+
+
+def store(results, batch_size=500):
+    """Upserts rendered documents keyed on the file path. Keywords become
+       tags, and tags which were assigned by users are kept. Returns the failures."""
+    failures = []
+    with data.BulkWriter(data.images, batch_size) as writer:
+        for path, document, error in results:
+            if error:
+                failures.append((path, error))
+                continue
+            tags = [tag for tag in (normalize_tag(keyword)
+                                    for keyword in document.get('keywords', ())) if tag]
+            if tags:
+                writer.upsert({'location': path}, document, add_to_set={'tags': tags})
+            else:
+                writer.upsert({'location': path}, document, on_insert={'tags': []})
+    return failures
+
+
+def known_files():
+    """(size, mtime) of all indexed files by path. Files indexed without
+       content hash or with outdated metadata are reported as unknown, so
+       they are read again (previews are only rendered if missing)."""
+    fields = {'location': 1, 'size': 1, 'mtime': 1, 'hash': 1, 'metadata': 1, '_id': 0}
+    return dict((doc['location'], (doc.get('size'), doc.get('mtime'))
+                 if 'hash' in doc and doc.get('metadata') == METADATA_VERSION else None)
+                for doc in data.images.find({}, fields))
+
+
+class Progress(object):
+    """Counts processed files and periodically reports the throughput"""
+
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.start = self.last_report = timer()
+        self.scanned = self.skipped = self.indexed = self.failed = 0
+
+    def rate(self):
+        return self.indexed / max(timer() - self.start, 1e-9)
+
+    def tick(self, result):
+        path, document, error = result
+        if error:
+            self.failed += 1
+        else:
+            self.indexed += 1
+        if timer() - self.last_report > REPORT_INTERVAL:
+            self.last_report = timer()
+            self.report()
+        return result
+
+    def report(self):
+        print >> self.out, "%d scanned, %d unchanged, %d indexed, %d failed, %.1f files/s" % \
+              (self.scanned, self.skipped, self.indexed, self.failed, self.rate())
+
+
+def index(base, workers=None, batch_size=500, out=sys.stdout):
+    """Incrementally (re-)indexes all images below base"""
+    data.ensure_indexes()
+
+    known = known_files()
+    seen = set()
+    progress = Progress(out)
+
+    def changed():
+        for path, size, mtime in scan(base):
+            progress.scanned += 1
+            seen.add(path)
+            if known.get(path) == (size, mtime):
+                progress.skipped += 1
+            else:
+                yield path, size, mtime
+
+    pool = Pool(workers or cpu_count())
+    try:
+        results = pool.imap_unordered(render, changed(), chunksize=8)
+        failures = store((progress.tick(result) for result in results), batch_size)
+        pool.close()
+    finally:
+        pool.terminate()        # after errors, workers would otherwise be left behind
+        pool.join()
+
+    # forget files which disappeared from below base
+    prefix = os.path.join(base, '')
+    gone = [path for path in known if path not in seen and path.startswith(prefix)]
+    if gone:
+        data.images.delete_many({'location': {'$in': gone}})
+
+    # rendering may have grown the cache far beyond its budget
+    preview_store.evict()
+
+    progress.report()
+    for path, error in failures:
+        print >> out, "Failed: %s (%s)" % (path, error)
+    return progress
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Index photos below a directory.')
+    parser.add_argument('base', nargs='?', default='./test-images')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='decoding processes (default: number of CPUs)')
+    parser.add_argument('--batch', type=int, default=500,
+                        help='documents per bulk write')
+    args = parser.parse_args()
+    index(args.base, args.workers, args.batch)
@@ -0,0 +1,216 @@
+#
+#   Image Metadata
+#
+#   Reads EXIF, IPTC and XMP from the header of an opened image (before it
+#   is decoded) and normalizes them into the fields stored with each photo:
+#
+#       date        capture time (seconds since the epoch)
+#       camera      make and model
+#       lens        lens model
+#       exposure    iso, aperture, shutter (seconds), focal_length (mm)
+#       geo         GeoJSON point (longitude, latitude)
+#       altitude    meters above sea level
+#       keywords    keywords of the photographer's export tool
+#       rating      0 to 5 stars
+#       title, caption
+#       orientation EXIF orientation (1 is upright), applied to previews
+#
+
+import re
+from calendar import timegm
+from time import mktime, strptime
+from xml.etree import ElementTree
+
+METADATA_VERSION = 1        # bump to re-read the metadata of all photos
+
+# EXIF tags
+ORIENTATION = 274
+MAKE, MODEL = 271, 272
+DATETIME, DATETIME_ORIGINAL, DATETIME_DIGITIZED = 306, 36867, 36868
+OFFSET_TIME_ORIGINAL = 36881
+EXPOSURE_TIME, F_NUMBER, ISO, FOCAL_LENGTH = 33434, 33437, 34855, 37386
+LENS_MODEL = 42036
+RATING = 18246
+GPS_INFO = 34853
+GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF, GPS_LONGITUDE = 1, 2, 3, 4
+GPS_ALTITUDE_REF, GPS_ALTITUDE = 5, 6
+
+# IPTC records (application record 2)
+IPTC_TITLE, IPTC_KEYWORDS, IPTC_CAPTION = (2, 5), (2, 25), (2, 120)
+
+XMP_PACKET = re.compile(r'<x:xmpmeta.*?</x:xmpmeta>', re.DOTALL)
+RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+DC = '{http://purl.org/dc/elements/1.1/}'
+XMP = '{http://ns.adobe.com/xap/1.0/}'
+
+
+def number(value):
+    """Float of an EXIF rational, which is a (numerator, denominator) pair in
+       older PIL versions. None for undefined values."""
+    try:
+        if isinstance(value, tuple):
+            return float(value[0]) / value[1]
+        return float(value)
+    except (TypeError, ValueError, ZeroDivisionError, IndexError):
+        return None
+
+
+def text(value):
+    """Unicode of an EXIF/IPTC string, without padding"""
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    return value.strip(u'\x00 ') if isinstance(value, unicode) else None
+
+
+def exif_date(value, offset=None):
+    """Timestamp of an EXIF date 'YYYY:MM:DD HH:MM:SS'. Without an offset
+       like '+02:00', it is taken as local time (like dates in searches)."""
+    try:
+        parsed = strptime(text(value)[:19], '%Y:%m:%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+    offset = text(offset)
+    if offset and re.match(r'^[+-]\d\d:\d\d$', offset):
+        sign = -1 if offset[0] == '-' else 1
+        return timegm(parsed) - sign * (int(offset[1:3]) * 3600 + int(offset[4:6]) * 60)
+    return mktime(parsed)
+
+
+def degrees(value, ref):
+    """Decimal degrees of a GPS (degrees, minutes, seconds) triple"""
+    try:
+        d, m, s = [number(part) for part in value]
+    except (TypeError, ValueError):
+        return None
+    if None in (d, m, s):
+        return None
+    result = d + m / 60 + s / 3600
+    return -result if text(ref) in (u'S', u'W') else result
+
+
+def geo(gps):
+    """GeoJSON point of the GPS info, None if incomplete or invalid"""
+    latitude = degrees(gps.get(GPS_LATITUDE), gps.get(GPS_LATITUDE_REF))
+    longitude = degrees(gps.get(GPS_LONGITUDE), gps.get(GPS_LONGITUDE_REF))
+    if latitude is None or longitude is None or \
+            not (-90 <= latitude <= 90 and -180 <= longitude <= 180) or \
+            (latitude, longitude) == (0, 0):
+        return None
+    return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+
+def parse_xmp(content):
+    """Keywords, rating, title and caption of the first XMP packet"""
+    match = XMP_PACKET.search(content)
+    if not match:
+        return {}
+    try:
+        root = ElementTree.fromstring(match.group(0))
+    except ElementTree.ParseError:
+        return {}
+
+    def items(name):
+        return [item.text.strip() for element in root.iter(name)
+                for item in element.iter(RDF + 'li') if item.text and item.text.strip()]
+
+    result = {}
+    keywords = items(DC + 'subject')
+    if keywords:
+        result['keywords'] = keywords
+    for name, key in ((DC + 'title', 'title'), (DC + 'description', 'caption')):
+        values = items(name)
+        if values:
+            result[key] = values[0]
+    for description in root.iter(RDF + 'Description'):
+        rating = description.get(XMP + 'Rating')
+        if rating is None:
+            element = description.find(XMP + 'Rating')
+            rating = element.text if element is not None else None
+        if rating is not None:
+            result['rating'] = rating
+    return result
+
+
+def normalize(exif, iptc=None, xmp=None):
+    """Typed photo fields from raw EXIF (by tag number), IPTC (by record) and
+       XMP (as returned by parse_xmp). Fields without a value are left out."""
+    iptc = iptc or {}
+    xmp = xmp or {}
+    result = {}
+
+    date = None
+    for tag in (DATETIME_ORIGINAL, DATETIME_DIGITIZED, DATETIME):
+        date = exif_date(exif.get(tag), exif.get(OFFSET_TIME_ORIGINAL)
+                         if tag == DATETIME_ORIGINAL else None)
+        if date is not None:
+            break
+    result['date'] = date
+
+    make, model = text(exif.get(MAKE)), text(exif.get(MODEL))
+    if model and make and not model.lower().startswith(make.split()[0].lower()):
+        model = u'%s %s' % (make, model)
+    result['camera'] = model or make
+    result['lens'] = text(exif.get(LENS_MODEL))
+
+    exposure = {'iso': exif.get(ISO),
+                'aperture': number(exif.get(F_NUMBER)),
+                'shutter': number(exif.get(EXPOSURE_TIME)),
+                'focal_length': number(exif.get(FOCAL_LENGTH))}
+    if isinstance(exposure['iso'], tuple):
+        exposure['iso'] = exposure['iso'][0] if exposure['iso'] else None
+    exposure = dict((key, value) for key, value in exposure.iteritems() if value)
+    result['exposure'] = exposure or None
+
+    gps = exif.get(GPS_INFO)
+    if isinstance(gps, dict):
+        result['geo'] = geo(gps)
+        altitude = number(gps.get(GPS_ALTITUDE))
+        if altitude is not None:
+            result['altitude'] = -altitude if gps.get(GPS_ALTITUDE_REF) in (1, '\x01') else altitude
+
+    keywords = iptc.get(IPTC_KEYWORDS) or []
+    if not isinstance(keywords, list):
+        keywords = [keywords]
+    keywords = [text(keyword) for keyword in keywords] + list(xmp.get('keywords', ()))
+    unique = []
+    for keyword in keywords:
+        if keyword and keyword not in unique:
+            unique.append(keyword)
+    result['keywords'] = unique or None
+
+    rating = number(xmp.get('rating', exif.get(RATING)))
+    if rating is not None and 0 <= rating <= 5:
+        result['rating'] = int(rating)
+
+    result['title'] = xmp.get('title') or text(iptc.get(IPTC_TITLE))
+    result['caption'] = xmp.get('caption') or text(iptc.get(IPTC_CAPTION))
+
+    orientation = exif.get(ORIENTATION)
+    result['orientation'] = orientation if orientation in xrange(1, 9) else 1
+
+    return dict((key, value) for key, value in result.iteritems() if value is not None)
+
+
+def orientation_of(im):
+    """EXIF orientation of an opened image, 1 (upright) if unknown"""
+    try:
+        orientation = (im._getexif() or {}).get(ORIENTATION)
+    except Exception:
+        return 1
+    return orientation if orientation in xrange(1, 9) else 1
+
+
+def read_metadata(im, content):
+    """Metadata of an opened image. Only reads headers: call it before the
+       image is decoded, e.g. while rendering previews in the same pass."""
+    from PIL import IptcImagePlugin
+
+    try:
+        exif = im._getexif() or {}
+    except Exception:       # corrupt EXIF must not fail the indexing
+        exif = {}
+    try:
+        iptc = IptcImagePlugin.getiptcinfo(im) or {}
+    except Exception:
+        iptc = {}
+    return normalize(exif, iptc, parse_xmp(content))
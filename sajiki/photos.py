@@ -0,0 +1,102 @@
+# --- PHOTOS CONTROLLER ---
+from bottle import get, post, request, HTTPError
+from bson import ObjectId
+from bson.errors import InvalidId
+from helpers import can, find_permitted, update_permitted
+from previews import SHARE_LIFETIME
+from search import QueryError
+from static import send_file
+import data
+
+
+def selection():
+    """Filter document for the photos selected by the request: a list of 'ids'
+    or a search 'query'. Returns (spec, number of explicitly selected photos)."""
+    params = request.json or {}
+    if 'ids' in params:
+        try:
+            ids = list(set(ObjectId(id) for id in params['ids']))
+        except (InvalidId, TypeError):
+            raise HTTPError(400, "Invalid photo id")
+        return {'_id': {'$in': ids}}, len(ids)
+    if 'query' in params:
+        try:
+            return request.search.parse(params['query']).spec(), None
+        except QueryError as e:
+            raise HTTPError(400, str(e))
+    raise HTTPError(400, "Select photos by 'ids' or 'query'")
+
+
+def tags_param(name):
+    """Canonical tags of a list of strings in the JSON request"""
+    tags = request.json.get(name, [])
+    if not isinstance(tags, list) or not all(isinstance(tag, basestring) for tag in tags):
+        raise HTTPError(400, "'%s' must be a list of tags" % name)
+    canonical_tag = request.search.taxonomy.canonical_tag
+    return set(filter(None, (canonical_tag(tag) for tag in tags)))
+
+
+@post('/photos/tags')
+def tag_photos():
+    """Adds and removes tags of many photos at once. Expects a JSON object
+    like { "ids": [...], "add": ["dog"], "remove": ["cat"] } or with a search
+    "query" instead of ids. Returns the counts of photos changed. Searches
+    of other processes find newly tagged photos once their index is rebuilt
+    (after Search.max_age)."""
+    spec, selected = selection()
+    add, remove = tags_param('add'), tags_param('remove')
+    remove -= add
+    if not add and not remove:
+        raise HTTPError(400, "Nothing to 'add' or 'remove'")
+
+    results = update_permitted(data.images, 'photos', spec,
+                               data.tag_updates(sorted(add), sorted(remove)))
+    request.access_control.resources_changed()     # permissions depend on tags
+    request.search.changed()
+
+    matched = results[0].matched_count
+    existing = data.images.count_documents(spec) if selected is not None else None
+    return {'selected': selected,
+            'matched': matched,
+            'denied': existing - matched if selected is not None else None,
+            'added': results.pop(0).modified_count if add else 0,
+            'removed': results.pop(0).modified_count if remove else 0}
+
+
+@get('/originals/<digest:re:[0-9a-f]{40}>.jpg')
+def original(digest):
+    """The original image, to users who can read the photo. Supports range
+    requests, so large originals can be resumed and viewed progressively."""
+    if data.images.find_one({'hash': digest}, {'_id': 1}) is None:
+        raise HTTPError(404, "Photo not found")
+    # duplicates share the content: any readable copy will do
+    docs = list(find_permitted(data.images, 'read', 'photos', {'hash': digest}, limit=1))
+    if not docs:
+        raise HTTPError(403, "This action requires 'read' privilege on 'photos'")
+    doc = docs[0]
+    return send_file(doc['location'], etag=digest, mimetype='image/jpeg', immutable=True,
+                     public=False, ranges=True)
+
+
+@post('/photos/<id>/share')
+def share(id):
+    """Public links to the previews of a photo the user can read. They need
+    no login and expire after 'days' (default 30, at most a year). Links
+    cannot be revoked: only changing SAJIKI_SECRET invalidates them (and
+    all other links and logins)."""
+    try:
+        doc = data.images.find_one({'_id': ObjectId(id)})
+    except InvalidId:
+        raise HTTPError(400, "Invalid photo id")
+    if doc is None:
+        raise HTTPError(404, "Photo not found")
+    can('read', 'photos', doc)
+    lifetime = SHARE_LIFETIME
+    if 'days' in request.params:
+        try:
+            lifetime = min(365, max(1, int(request.params['days']))) * 24 * 3600
+        except ValueError:
+            raise HTTPError(400, "Invalid number of days")
+    base = request.urlparts.scheme + '://' + request.urlparts.netloc
+    return {'links': dict((name, base + request.signer.sign(url, lifetime))
+                          for name, url in doc['previews'].iteritems())}
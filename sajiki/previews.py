@@ -0,0 +1,207 @@
+#
+#   Preview Store
+#
+
+import hmac
+import os
+from base64 import urlsafe_b64encode
+from hashlib import sha1, sha256
+from io import BytesIO
+from threading import Lock, Thread
+from time import time
+
+import metadata
+import thumbnails
+
+PREVIEW_BUDGET = 20 * 2**30     # bytes, shared by the server and the indexer
+EVICT_EVERY = 100           # files written between evictions
+TOUCH_INTERVAL = 3600       # seconds between access time updates of a file
+SHARE_LIFETIME = 30 * 24 * 3600     # default validity of public links
+
+
+def content_hash(content):
+    return sha1(content).hexdigest()
+
+
+def touch(path):
+    """Path of an existing file, marked as accessed; None if it is missing"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    if stat.st_atime < time() - TOUCH_INTERVAL:
+        os.utime(path, None)    # do not rely on atime updates of the mount
+    return path
+
+
+def evict_least_recent(root, budget, low_watermark=0.9):
+    """Removes the least recently accessed files below root until their total
+       size is below low_watermark * budget, if it exceeds the budget.
+       Returns the number of files removed."""
+    files = []
+    total = 0
+    for directory, subdirs, filenames in os.walk(root):
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_atime, stat.st_size, path))
+            total += stat.st_size
+    if total <= budget:
+        return 0
+
+    files.sort()
+    removed = 0
+    target = budget * low_watermark
+    for atime, size, path in files:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
+
+
+def make_directories(path):
+    """Creates the directory of a file about to be written, if missing"""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass        # created concurrently
+
+
+class BoundedStore(object):
+    """Files below a root directory. If a budget (in bytes) is given, the least
+       recently accessed ones are evicted in the background after every
+       EVICT_EVERY files written, to stay below it."""
+
+    def __init__(self, root, budget=None):
+        self.root = root
+        self.budget = budget
+        self.written = 0
+        self.eviction_lock = Lock()
+
+    def file_written(self):
+        self.written += 1
+        if self.budget and self.written % EVICT_EVERY == 0:
+            Thread(target=self.evict).start()
+
+    def evict(self, low_watermark=0.9):
+        """Removes least recently accessed files until below the budget"""
+        if not self.budget or not self.eviction_lock.acquire(False):
+            return 0
+        try:
+            return evict_least_recent(self.root, self.budget, low_watermark)
+        finally:
+            self.eviction_lock.release()
+
+
+class PreviewStore(BoundedStore):
+    """Previews keyed by the content hash of the original and the preview name.
+       Files are sharded into <root>/<hh>/<hh>/<hash>-<name>.jpg, so renamed or
+       duplicate originals share their previews. If a budget (in bytes) is given,
+       the least recently accessed files are evicted to stay below it.
+       Missing previews are regenerated from the original returned by 'locate'."""
+
+    def __init__(self, root='./cache', budget=None, locate=None, url_prefix='/cache'):
+        BoundedStore.__init__(self, root, budget)
+        self.locate = locate
+        self.url_prefix = url_prefix
+
+    def relative_path(self, digest, name):
+        return '%s/%s/%s-%s.jpg' % (digest[:2], digest[2:4], digest, name)
+
+    def path(self, digest, name):
+        return os.path.join(self.root, self.relative_path(digest, name))
+
+    def url(self, digest, name):
+        return '%s/%s/%s.jpg' % (self.url_prefix, digest, name)
+
+    def urls(self, digest):
+        return dict((name, self.url(digest, name))
+                    for name, width in thumbnails.PREVIEW_SIZES)
+
+    def complete(self, digest):
+        """Whether all previews of the content exist"""
+        return all(os.path.exists(self.path(digest, name))
+                   for name, width in thumbnails.PREVIEW_SIZES)
+
+    def render(self, im, digest, orientation=None):
+        """Writes all previews of an opened image, upright according to its
+        EXIF orientation. Returns the upright original size."""
+        if orientation is None:
+            orientation = metadata.orientation_of(im)
+        outputs = dict((name, self.path(digest, name))
+                       for name, width in thumbnails.PREVIEW_SIZES)
+        make_directories(outputs.values()[0])
+        return thumbnails.render_previews(im, outputs, orientation=orientation)
+
+    def fetch(self, digest, name):
+        """Path of an existing or regenerated preview, None if the original is gone"""
+        if name not in dict(thumbnails.PREVIEW_SIZES):
+            return None
+        path = self.path(digest, name)
+        return touch(path) or (self.regenerate(digest) and path)
+
+    def regenerate(self, digest):
+        location = self.locate(digest) if self.locate else None
+        if location is None:
+            return False
+        try:
+            with open(location, 'rb') as f:
+                content = f.read()
+        except IOError:
+            return False
+        if content_hash(content) != digest:
+            return False    # original changed, waiting for the indexer
+
+        from PIL import Image
+        self.render(Image.open(BytesIO(content)), digest)
+        self.file_written()
+        return True
+
+
+class UrlSigner(object):
+    """Signs URL paths with an expiry date, so a listing which has checked
+       the permissions can hand out links to previews. Verifying a link needs
+       neither a session nor the database. Expiry dates are rounded up to
+       'granularity', so links stay the same for a while and browsers can
+       reuse cached previews across page views."""
+
+    def __init__(self, secret, lifetime=6 * 3600, granularity=3600):
+        # a key of its own: preview links can never pass as access tokens
+        self.key = hmac.new(secret, 'preview-urls', sha256).digest()
+        self.lifetime = lifetime
+        self.granularity = granularity
+
+    def signature(self, path, expires):
+        mac = hmac.new(self.key, '%s?%d' % (path, expires), sha256).digest()
+        return urlsafe_b64encode(mac[:18])
+
+    def expiry(self, lifetime=None):
+        now = int(time())
+        expires = now + (self.lifetime if lifetime is None else lifetime)
+        return expires - expires % self.granularity + self.granularity
+
+    def sign(self, path, lifetime=None):
+        """The path with its expiry date and signature as query parameters"""
+        expires = self.expiry(lifetime)
+        return '%s?exp=%d&sig=%s' % (path, expires, self.signature(path, expires))
+
+    def verify(self, path, expires, signature):
+        """Seconds the link remains valid for, 0 if it is invalid or expired"""
+        try:
+            expires = int(expires)
+            signature = str(signature or '')
+        except (TypeError, ValueError, UnicodeError):
+            return 0
+        if not hmac.compare_digest(signature, self.signature(path, expires)):
+            return 0
+        return max(0, expires - int(time()))
@@ -0,0 +1,380 @@
+#
+#   Semantic Search
+#
+
+import re
+import unicodedata
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, timedelta
+from itertools import islice
+from threading import Lock, Thread
+from time import mktime, time
+
+from access import transitive_closure
+
+SEARCH_PAGE = 60
+REBUILD_AFTER = 300         # seconds until the inverted index is rebuilt
+
+TOKEN = re.compile(r'(-?)(?:(\w+):)?(?:"([^"]*)"|(\S+))', re.UNICODE)
+DATE = re.compile(r'^(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?$')
+
+TAG_FIELDS = ('', 'tag', 'person', 'people', 'event', 'place')
+FROM_FIELDS = ('from', 'since', 'after')
+TO_FIELDS = ('to', 'until', 'before')
+DATE_FIELDS = ('date', 'on', 'in')
+RATING_FIELDS = ('rating', 'stars')
+
+
+class QueryError(ValueError):
+    """Raised for search queries which cannot be understood"""
+
+
+def normalize_tag(tag):
+    """Canonical spelling of a tag: lower case without accents, words joined by '-'"""
+    if isinstance(tag, str):
+        tag = tag.decode('utf-8')
+    tag = u''.join(c for c in unicodedata.normalize('NFKD', tag)
+                   if not unicodedata.combining(c))
+    return u'-'.join(re.findall(r'\w+', tag.lower(), re.UNICODE))
+
+
+class Taxonomy(object):
+    """Synonyms and hypernyms of tags. A search for a tag also finds its
+       synonyms and all tags below it ('animal' finds 'dog' and 'puppy').
+       The hierarchy takes the form { 'hypernym': ['tag1', 'tag2', ...], .. }
+       like the operations hierarchy of the access control domain."""
+
+    def __init__(self, hyponyms=None, synonyms=None):
+        self.canonical = {}         # synonym -> canonical tag
+        self.spellings = {}         # canonical tag -> all its names
+        for tag, names in (synonyms or {}).iteritems():
+            tag = normalize_tag(tag)
+            for name in names:
+                self.canonical[normalize_tag(name)] = tag
+                self.spellings.setdefault(tag, set([tag])).add(normalize_tag(name))
+
+        graph = {}
+        for tag, narrower in (hyponyms or {}).iteritems():
+            graph.setdefault(self.canonical_tag(tag), []).extend(
+                self.canonical_tag(t) for t in narrower)
+        closure = transitive_closure(graph)     # ValueError on cycles
+
+        self.expansions = {}
+        for tag, narrower in closure.iteritems():
+            self.expansions[tag] = frozenset(name for t in narrower.union([tag])
+                                             for name in self.spellings.get(t, (t,)))
+
+    @classmethod
+    def from_records(cls, records):
+        """Taxonomy from records like { 'name': 'dog', 'synonyms': ['hound'],
+           'includes': ['puppy'] }"""
+        hyponyms, synonyms = {}, {}
+        for record in records:
+            if record.get('includes'):
+                hyponyms[record['name']] = record['includes']
+            if record.get('synonyms'):
+                synonyms[record['name']] = record['synonyms']
+        return cls(hyponyms, synonyms)
+
+    def canonical_tag(self, tag):
+        tag = normalize_tag(tag)
+        return self.canonical.get(tag, tag)
+
+    def expand(self, tag):
+        """All tags a search for the given tag matches"""
+        tag = self.canonical_tag(tag)
+        expansion = self.expansions.get(tag)
+        if expansion is None:
+            expansion = frozenset(self.spellings.get(tag, (tag,)))
+        return expansion
+
+
+def parse_date(text):
+    """Returns the [start, end) interval of a year, month or day as timestamps"""
+    match = DATE.match(text)
+    if not match:
+        raise QueryError("Not a date: %s (use YYYY, YYYY-MM or YYYY-MM-DD)" % text)
+    year, month, day = [int(part) if part else None for part in match.groups()]
+    try:
+        if day:
+            start = date(year, month, day)
+            end = start + timedelta(days=1)
+        elif month:
+            start = date(year, month, 1)
+            end = date(year + month // 12, month % 12 + 1, 1)
+        else:
+            start, end = date(year, 1, 1), date(year + 1, 1, 1)
+    except ValueError as e:
+        raise QueryError("Not a date: %s (%s)" % (text, e))
+    return mktime(start.timetuple()), mktime(end.timetuple())
+
+
+def parse_rating(text):
+    """Minimum rating of '4', '4+' or '>=4'"""
+    match = re.match(r'^(?:>=)?([0-5])\+?$', text)
+    if not match:
+        raise QueryError("Not a rating: %s (use 0 to 5)" % text)
+    return int(match.group(1))
+
+
+class Query(object):
+    """A parsed search. Every group must match (with any of its tags), none
+       of the excluded tags may match, the date lies in [start, end) and the
+       rating is at least min_rating."""
+
+    def __init__(self, groups=(), excluded=(), start=None, end=None, min_rating=None):
+        self.groups = tuple(groups)
+        self.excluded = frozenset(excluded)
+        self.start = start
+        self.end = end
+        self.min_rating = min_rating
+
+    def spec(self):
+        """MongoDB filter document, served by the multikey index on 'tags'"""
+        clauses = [{'tags': {'$in': sorted(group)}} if len(group) > 1
+                   else {'tags': iter(group).next()}
+                   for group in self.groups]
+        if self.excluded:
+            clauses.append({'tags': {'$nin': sorted(self.excluded)}})
+        dates = {}
+        if self.start is not None:
+            dates['$gte'] = self.start
+        if self.end is not None:
+            dates['$lt'] = self.end
+        if dates:
+            clauses.append({'date': dates})
+        if self.min_rating:
+            clauses.append({'rating': {'$gte': self.min_rating}})
+        if len(clauses) > 1:
+            return {'$and': clauses}
+        return clauses[0] if clauses else {}
+
+    def __repr__(self):
+        return "<Query %s without %s from %s to %s>" % \
+               ([sorted(group) for group in self.groups], sorted(self.excluded),
+                self.start, self.end)
+
+
+def parse_query(text, taxonomy=None):
+    """Parses queries like 'dog -cat "new york" from:2014-05 to:2014'.
+       Words are tags (also with prefixes like 'person:' or 'event:'), quoted
+       words a tag of several words. A leading '-' excludes a tag. Dates can be
+       given as year, month or day in 'from:', 'to:' and 'date:', the least
+       number of stars in 'rating:'."""
+    taxonomy = taxonomy or Taxonomy()
+    groups, excluded = [], set()
+    start = end = min_rating = None
+    for negated, field, quoted, word in TOKEN.findall(text):
+        value = quoted or word
+        field = field.lower()
+        if field in FROM_FIELDS:
+            start = max(start, parse_date(value)[0])
+        elif field in TO_FIELDS:
+            end = min(end or float('inf'), parse_date(value)[1])
+        elif field in DATE_FIELDS:
+            first, last = parse_date(value)
+            start, end = max(start, first), min(end or float('inf'), last)
+        elif field in RATING_FIELDS:
+            min_rating = max(min_rating, parse_rating(value))
+        else:
+            if field not in TAG_FIELDS:
+                value = field + ':' + value      # e.g. a time of day, not a field
+            if not normalize_tag(value):
+                continue
+            expansion = taxonomy.expand(value)
+            if negated:
+                excluded.update(expansion)
+            elif expansion not in groups:
+                groups.append(expansion)
+    return Query(groups, excluded, start, end, min_rating)
+
+
+class InvertedIndex(object):
+    """Posting lists of image positions by tag. Positions follow the gallery
+       order (newest first), so posting lists are sorted, date ranges are
+       ranges of positions, and the matches of a query are found in the order
+       in which they are displayed by intersecting the posting lists."""
+
+    def __init__(self, records):
+        records = sorted(records, key=lambda record: (record.get('date') or 0, record['_id']),
+                         reverse=True)
+        self.ids = [record['_id'] for record in records]
+        self.dates = array('d', [-(record.get('date') or 0) for record in records])  # ascending
+        self.ratings = array('b', [record.get('rating') or 0 for record in records])
+        self.postings = {}
+        for position, record in enumerate(records):
+            for tag in set(record.get('tags') or ()):
+                self.postings.setdefault(tag, array('l')).append(position)
+        self.built = time()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def date_range(self, start=None, end=None):
+        """Positions of images dated in [start, end)"""
+        lo = bisect_right(self.dates, -end) if end is not None else 0
+        hi = bisect_right(self.dates, -start) if start is not None else len(self.dates)
+        return lo, hi
+
+    def position_after(self, date, id):
+        """First position following the page key (date, id) in gallery order"""
+        position = bisect_left(self.dates, -date)
+        end = bisect_right(self.dates, -date, position)
+        while position < end and self.ids[position] >= id:
+            position += 1
+        return position
+
+    def positions(self, query, first=0):
+        """Yields the positions of the images matching the query, from 'first' on"""
+        lo, hi = self.date_range(query.start, query.end)
+        lo = max(lo, first)
+        groups = []
+        for group in query.groups:
+            postings = [self.postings[tag] for tag in group if tag in self.postings]
+            if not postings:
+                return
+            groups.append(postings)
+        excluded = [self.postings[tag] for tag in query.excluded if tag in self.postings]
+
+        # rarest group first: it proposes the candidates the others must agree on
+        groups.sort(key=lambda postings: sum(len(p) for p in postings))
+        candidate = lo
+        while candidate < hi:
+            moved = True
+            while moved:            # leapfrog until all groups contain the candidate
+                moved = False
+                for postings in groups:
+                    found = self._seek(postings, candidate)
+                    if found is None or found >= hi:
+                        return
+                    if found > candidate:
+                        candidate, moved = found, True
+            if not any(self._contains(postings, candidate) for postings in excluded) and \
+                    (not query.min_rating or self.ratings[candidate] >= query.min_rating):
+                yield candidate
+            candidate += 1
+
+    @staticmethod
+    def _seek(postings, position):
+        """Smallest position >= the given one in any of the posting lists"""
+        found = None
+        for posting in postings:
+            i = bisect_left(posting, position)
+            if i < len(posting) and (found is None or posting[i] < found):
+                found = posting[i]
+        return found
+
+    @staticmethod
+    def _contains(posting, position):
+        i = bisect_left(posting, position)
+        return i < len(posting) and posting[i] == position
+
+
+def acl_tags(acl):
+    """Tags of which a photo needs one to be readable, given the (spec, exact)
+       pair of Subject.query. None if all photos are readable, False if the
+       permissions are not only about tags."""
+    spec, exact = acl
+    if spec is None:
+        return frozenset()
+    if spec == {}:
+        return None if exact else False
+    if not exact or spec.keys() != ['tags']:
+        return False
+    value = spec['tags']
+    if isinstance(value, basestring):
+        return frozenset([value])
+    if isinstance(value, dict) and value.keys() == ['$in']:
+        return frozenset(value['$in'])
+    return False
+
+
+class Search(object):
+    """Runs queries against the image collection. With in_memory, candidates
+       come from an inverted index, which is rebuilt in the background when
+       it is older than 'max_age' seconds. Until then (or without it), the
+       database answers through the multikey index on 'tags'.
+       Results are always fetched through the given find function, which
+       applies read permissions, and rechecked against the query."""
+
+    def __init__(self, collection, taxonomy=None, in_memory=False, max_age=REBUILD_AFTER):
+        self.collection = collection
+        self.taxonomy = taxonomy or Taxonomy()
+        self.in_memory = in_memory
+        self.max_age = max_age
+        self.index = None
+        self.changed_at = 0         # time of the last change of tags
+        self.rebuild_lock = Lock()
+
+    def parse(self, text):
+        return parse_query(text, self.taxonomy)
+
+    def rebuild(self):
+        """Builds a new inverted index and replaces the old one at once"""
+        if not self.rebuild_lock.acquire(False):
+            return              # already rebuilding
+        self._rebuild_and_release()
+
+    def _rebuild_and_release(self):
+        try:
+            started = time()
+            index = InvertedIndex(self.collection.find({}, {'tags': 1, 'date': 1, 'rating': 1}))
+            index.built = started   # changes during the scan may be missing
+            self.index = index
+        finally:
+            self.rebuild_lock.release()
+
+    def changed(self):
+        """Tags were changed: rebuild the index at the next search. Until
+        then, photos whose tags were removed are filtered out when fetched,
+        but newly tagged photos are not found yet. Only marks the index of this
+        process: other processes rebuild theirs after max_age."""
+        self.changed_at = time()
+
+    def current_index(self):
+        index = self.index
+        if self.in_memory and (index is None or index.built < time() - self.max_age or
+                               index.built < self.changed_at):
+            if self.rebuild_lock.acquire(False):    # one rebuild at a time
+                Thread(target=self._rebuild_and_release).start()
+        return index
+
+    def find(self, query, find, fields, after=None, limit=SEARCH_PAGE, acl=({}, True)):
+        """Yields up to 'limit' records matching the query in gallery order.
+           'find(spec, fields, **options)' queries the collection, typically
+           with the subject's read permissions. 'after' is a page key. 'acl'
+           is the subject's query for reading photos: if it only asks for
+           tags, the index applies it, otherwise the database answers."""
+        from data import GALLERY_ORDER, after_page_key, parse_page_key, conjunction
+
+        permitted = acl_tags(acl)
+        if permitted == frozenset():
+            return              # nothing may be read
+        index = self.current_index() if permitted is not False else None
+        if index is None:
+            spec = conjunction(query.spec(), after_page_key(after))
+            for record in find(spec, fields, sort=GALLERY_ORDER, limit=limit):
+                yield record
+            return
+
+        key = parse_page_key(after)
+        candidates = query
+        if permitted is not None:   # the readable tags are one more group
+            candidates = Query(query.groups + (permitted,), query.excluded,
+                               query.start, query.end, query.min_rating)
+        positions = index.positions(candidates, index.position_after(*key) if key else 0)
+        found, batch = 0, limit
+        while found < limit:
+            chunk = [index.ids[position] for position in islice(positions, batch)]
+            if not chunk:
+                return
+            records = dict((record['_id'], record) for record in
+                           find(conjunction({'_id': {'$in': chunk}}, query.spec()), fields))
+            for id in chunk:
+                if id in records:
+                    yield records[id]
+                    found += 1
+                    if found == limit:
+                        return
+            batch = min(batch * 2, 8 * limit)   # most candidates were not permitted
@@ -1,67 +1,132 @@
-from bottle import hook, get, static_file, TEMPLATE_PATH, Jinja2Template
+import logging
+import os
+from bottle import Bottle, hook, abort, request, TEMPLATE_PATH, Jinja2Template
 from bottle import app as bottle_app
-from beaker.middleware import SessionMiddleware
 
 import data
-from helpers import load_access_control, setup_request
+from helpers import load_access_control, setup_request, RoleModelWatcher
+from previews import PreviewStore, UrlSigner, PREVIEW_BUDGET
+from search import Search
+from variants import VariantStore
+from sessions import SessionMiddleware, MemoryStore, MongoStore
+from static import FastPath, StaticFiles, send_file
 
 # TEST DATA!
 if __name__ == '__main__':
     #data.init_images()
     data.init_users()
+    data.init_taxonomy()
 
 
+# --- Prepare Database ---
+
+data.ensure_indexes()
+
 # --- Load User Roles and Privileges ---
 
-access_control = load_access_control()
+# Access tokens, preview and share links are signed with this secret. Set it
+# to the same value in all worker processes and nodes: otherwise each process
+# has a random key of its own, so links signed by one worker are rejected by
+# the others, and logins and links only last until a restart.
+SECRET = os.environ.get('SAJIKI_SECRET')
+if not SECRET:
+    logging.getLogger('sajiki').warning(
+        "SAJIKI_SECRET is not set: logins and links are only valid in this process")
+
+access_control = load_access_control(SECRET)
+RoleModelWatcher(access_control).start()      # picks up role changes of other processes
+
+# --- Configure Search ---
+
+# The inverted index holds tags and dates of all photos in memory (about
+# 100 bytes per photo and tag). Without it, searches use the database index.
+search = Search(data.images, data.load_taxonomy(), in_memory=True)
 
 # --- Configure Template Engine ---
 
+# Static files are linked with versioned URLs: {{ asset_url('app.css') }}
+static_files = StaticFiles({'.js': 'static/js', '.css': 'static/css', '.jpg': 'static/img',
+                            '.png': 'static/img', '.gif': 'static/img', '.ico': 'static/img'})
+
 TEMPLATE_PATH[:] = ['./templates']
-Jinja2Template.settings = {'autoescape': True}
+Jinja2Template.settings = {'autoescape': True, 'globals': {'asset_url': static_files.url}}
 
-# --- Configure Session management ---
+# --- Configure Preview Cache ---
+
+preview_store = PreviewStore('./cache', PREVIEW_BUDGET, locate=data.original_of)
 
-session_opts = {
-    'session.type': 'file',
-    'session.data_dir': './session/',
-    'session.auto': True,
-}
+# Variants in other sizes and formats, rendered from the previews on demand
+VARIANT_BUDGET = 5 * 2**30      # bytes
 
-app = SessionMiddleware(bottle_app(), session_opts)
+variant_store = VariantStore(preview_store, './variants', VARIANT_BUDGET)
+
+# Listings sign the preview URLs of the photos they show; the preview route
+# only checks signatures. Links stay valid for 6 to 7 hours.
+preview_signer = UrlSigner(access_control.secret)
+
+# --- Configure Session management ---
+
+# In-process sessions are fastest. Several worker processes need a shared store:
+#   session_store = MongoStore(data.db.sessions)
+session_store = MemoryStore()
 
 # --- Hooks ---
 
 
 @hook('before_request')
 def before_request():
-    setup_request(access_control)
+    setup_request(access_control, search, preview_signer)
 
 # --- CONTROLLERS ---
 # Import controllers which depend on the previous setup:
 
 from errors import *
 from users import *
+from photos import *
 
 
 # --- Static file handling ---
-
-@get('/cache/<filename:re:.*\.(jpg|png|gif|ico)>')
-def thumbnails(filename):
-    # TODO: Access control here?
-    return static_file(filename, root='cache')
-
-@get('/<filename:re:.*\.js>')
-def javascripts(filename):
-    return static_file(filename, root='static/js')
-
-@get('/<filename:re:.*\.css>')
-def stylesheets(filename):
-    return static_file(filename, root='static/css')
-
-@get('/<filename:re:.*\.(jpg|png|gif|ico)>')
-def images(filename):
-    return static_file(filename, root='static/img')
+# Static files and previews are served by a separate application in front of
+# the session middleware: no session is loaded and no subject is resolved.
+
+assets = Bottle()
+
+@assets.get('/cache/<digest:re:[0-9a-f]{40}>/<name:re:[a-z]+>.jpg')
+def thumbnails(digest, name):
+    remaining = preview_signer.verify(request.path, request.query.exp, request.query.sig)
+    if not remaining:
+        abort(403, "Invalid or expired preview link")
+    if not preview_store.fetch(digest, name):
+        abort(404, "Preview not found")
+    # a preview never changes (its URL contains the hash of the original), but
+    # may only be cached while the link is valid
+    return send_file(preview_store.path(digest, name), etag='%s-%s' % (digest, name),
+                     mimetype='image/jpeg', max_age=remaining, public=False)
+
+@assets.get('/img/<digest:re:[0-9a-f]{40}>/<width:int>x<height:int>.<fmt:re:[a-z]+>')
+def variant(digest, width, height, fmt):
+    remaining = preview_signer.verify(request.path, request.query.exp, request.query.sig)
+    if not remaining:
+        abort(403, "Invalid or expired image link")
+    try:
+        path = variant_store.fetch(digest, (width, height), fmt)
+    except ValueError as e:
+        abort(404, str(e))
+    if not path:
+        abort(404, "Image not found")
+    return send_file(path, etag='%s-%dx%d-%s' % (digest, width, height, fmt),
+                     mimetype=variant_store.mimetype(fmt), max_age=remaining, public=False)
+
+@assets.get('/v/<version:re:[0-9a-f]{12}>/<filename:path>')
+def versioned(version, filename):
+    return static_files.send(filename, version)
+
+# (originals are served by the session application, after an access check)
+@assets.get('/<filename:re:(?!originals/).*\.(js|css|jpg|png|gif|ico)>')
+def unversioned(filename):
+    return static_files.send(filename)
+
+app = FastPath(assets, SessionMiddleware(bottle_app(), session_store))
 
 # --- Standalone deployment ---
 
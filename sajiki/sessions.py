@@ -0,0 +1,193 @@
+#
+#   Session Management
+#
+
+import cPickle as pickle
+from binascii import hexlify
+from Cookie import SimpleCookie, CookieError
+from os import urandom
+from threading import Lock
+from time import time
+
+SESSION_TIMEOUT = 14 * 24 * 3600    # seconds since the last write
+SESSION_ID_LENGTH = 40              # hex digits
+
+
+class Session(object):
+    """Session data, loaded from the store on first access. Assignments mark the
+       session dirty, and only dirty sessions are written back. New sessions
+       get an id (and a cookie) only once something has been stored.
+       Changes inside stored objects require an explicit save()."""
+
+    def __init__(self, store, id=None):
+        self.store = store
+        self.id = id
+        self.dirty = False
+        self.deleted = False
+        self.expires = None
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            loaded = self.store.load(self.id) if self.id else None
+            if loaded is None:
+                self.id = None          # unknown or expired
+                self._data = {}
+            else:
+                self._data, self.expires = loaded
+        return self._data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.dirty = True
+
+    def __delitem__(self, key):
+        del self.data[key]
+        self.dirty = True
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def pop(self, key, default=None):
+        if key in self.data:
+            self.dirty = True
+        return self.data.pop(key, default)
+
+    def save(self):
+        self.dirty = True
+
+    def delete(self):
+        self._data = {}
+        self.deleted = True
+
+    def persist(self, timeout):
+        """Writes the session to the store if necessary. Returns whether the
+           session cookie has to be (re-)sent."""
+        if self.deleted:
+            if self.id:
+                self.store.delete(self.id)
+                return True
+            return False
+        if self._data is None:
+            return False                # never accessed
+        stale = self.expires is not None and self.expires - time() < timeout / 2
+        if not (self.dirty or stale) or not (self._data or self.id):
+            return False
+        new = self.id is None
+        if new:
+            self.id = hexlify(urandom(SESSION_ID_LENGTH // 2))
+        self.store.save(self.id, self._data, timeout)
+        return new or stale
+
+
+class MemoryStore(object):
+    """Sessions held in this process. Fastest, but not shared between workers."""
+
+    SWEEP_EVERY = 1000      # writes between removals of expired sessions
+
+    def __init__(self):
+        self.sessions = {}
+        self.lock = Lock()
+        self.writes = 0
+
+    def load(self, id):
+        entry = self.sessions.get(id)
+        if entry is None:
+            return None
+        data, expires = entry
+        if expires < time():
+            self.delete(id)
+            return None
+        return dict(data), expires
+
+    def save(self, id, data, timeout):
+        with self.lock:
+            self.sessions[id] = (dict(data), time() + timeout)
+            self.writes += 1
+            if self.writes % self.SWEEP_EVERY == 0:
+                now = time()
+                for key in [key for key, (data, expires) in self.sessions.iteritems()
+                            if expires < now]:
+                    del self.sessions[key]
+
+    def delete(self, id):
+        with self.lock:
+            self.sessions.pop(id, None)
+
+
+class MongoStore(object):
+    """Sessions in a MongoDB collection shared by all worker processes.
+       Expired sessions are removed by a TTL index."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        collection.create_index('expires', expireAfterSeconds=0)
+
+    def load(self, id):
+        from datetime import datetime
+        from calendar import timegm
+
+        record = self.collection.find_one({'_id': id, 'expires': {'$gt': datetime.utcnow()}})
+        if record is None:
+            return None
+        return pickle.loads(str(record['data'])), timegm(record['expires'].utctimetuple())
+
+    def save(self, id, data, timeout):
+        from datetime import datetime, timedelta
+        from bson.binary import Binary
+
+        self.collection.update_one(
+            {'_id': id},
+            {'$set': {'data': Binary(pickle.dumps(data, pickle.HIGHEST_PROTOCOL)),
+                      'expires': datetime.utcnow() + timedelta(seconds=timeout)}},
+            upsert=True)
+
+    def delete(self, id):
+        self.collection.delete_one({'_id': id})
+
+
+class SessionMiddleware(object):
+    """Provides a Session in environ[environ_key], identified by a cookie"""
+
+    def __init__(self, app, store, cookie_name='sajiki.session', environ_key='sajiki.session',
+                 timeout=SESSION_TIMEOUT, secure=False):
+        self.app = app
+        self.store = store
+        self.cookie_name = cookie_name
+        self.environ_key = environ_key
+        self.timeout = timeout
+        self.secure = secure
+
+    def session_id(self, environ):
+        try:
+            morsel = SimpleCookie(environ.get('HTTP_COOKIE', '')).get(self.cookie_name)
+        except CookieError:
+            return None
+        if morsel is None or len(morsel.value) != SESSION_ID_LENGTH:
+            return None
+        return morsel.value
+
+    def cookie(self, session):
+        if session.deleted:
+            value, max_age = '', 0
+        else:
+            value, max_age = session.id, self.timeout
+        return '%s=%s; Max-Age=%d; Path=/; HttpOnly%s' % \
+               (self.cookie_name, value, max_age, '; Secure' if self.secure else '')
+
+    def __call__(self, environ, start_response):
+        session = environ[self.environ_key] = Session(self.store, self.session_id(environ))
+
+        def session_start_response(status, headers, exc_info=None):
+            if session.persist(self.timeout):
+                headers = list(headers) + [('Set-Cookie', self.cookie(session))]
+            return start_response(status, headers, exc_info)
+
+        return self.app(environ, session_start_response)
@@ -0,0 +1,254 @@
+#
+#   Static Files
+#
+#   Usage: python static.py [directories...]
+#
+#   Writes precompressed .gz (and with the brotli module, .br) variants of
+#   the stylesheets and scripts below the given directories (default: static).
+#
+
+import gzip
+import mimetypes
+import os
+import re
+import sys
+from email.utils import formatdate
+from hashlib import sha1
+
+from bottle import HTTPError, HTTPResponse, request, parse_date
+
+YEAR = 365 * 24 * 3600
+CHUNK_SIZE = 64 * 1024
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))   # preferred first
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.html')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class FastPath(object):
+    """Serves requests matching a route of 'assets' directly and passes all
+       others on to 'app'. Static files and previews need neither a session
+       nor a subject, so their application sits in front of the session
+       middleware and has no request hooks."""
+
+    def __init__(self, assets, app):
+        self.assets = assets
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        try:
+            self.assets.router.match(environ)
+        except HTTPError:           # not found or method not allowed
+            return self.app(environ, start_response)
+        return self.assets(environ, start_response)
+
+
+def accepts(accept_encoding, coding):
+    """Whether an Accept-Encoding header allows the content coding. The
+       coding's own entry takes precedence over '*'."""
+    allowed = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        allowed[name.strip().lower()] = not re.match(r'^\s*q\s*=\s*0(\.0*)?\s*$', params)
+    return allowed.get(coding, allowed.get('*', False))
+
+
+def etag_matches(header, etag):
+    """Whether an If-None-Match header lists the (strong) entity tag"""
+    if header.strip() == '*':
+        return True
+    return any(tag.strip().lstrip('W/') == '"%s"' % etag for tag in header.split(','))
+
+
+def parse_range(header, size):
+    """(first, last) byte of a single range, None if the header is invalid
+       and must be ignored. first >= size if the range cannot be satisfied."""
+    match = RANGE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:                   # the last bytes
+        length = int(last)
+        return (max(0, size - length) if length else size), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def file_range(path, start, length):
+    """Yields 'length' bytes of the file from 'start' on"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+def send_file(path, etag=None, mimetype=None, immutable=False, max_age=3600, public=True,
+              ranges=False, precompressed=False):
+    """Response for a file, honoring conditional and range requests.
+       'etag' should identify the content (e.g. a content hash), it defaults
+       to one derived from modification time and size. Immutable files may be
+       cached for a year. With 'precompressed', a .br or .gz variant next to
+       the file is sent to clients accepting it. Full responses hand the open
+       file to the server (wsgi.file_wrapper, i.e. sendfile where available)."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        raise HTTPError(404, "File not found")
+    if not os.path.isfile(path):
+        raise HTTPError(404, "File not found")
+
+    headers = {}
+    mimetype = mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if mimetype.startswith('text/') or mimetype == 'application/javascript':
+        mimetype += '; charset=UTF-8'
+    headers['Content-Type'] = mimetype
+
+    encoding = None
+    if precompressed:
+        headers['Vary'] = 'Accept-Encoding'
+        accept_encoding = request.environ.get('HTTP_ACCEPT_ENCODING', '')
+        for coding, suffix in ENCODINGS:
+            if accepts(accept_encoding, coding):
+                try:
+                    variant = os.stat(path + suffix)
+                except OSError:
+                    continue
+                if variant.st_mtime >= stat.st_mtime:      # not outdated
+                    path, stat, encoding = path + suffix, variant, coding
+                    headers['Content-Encoding'] = coding
+                    break
+
+    etag = etag or '%x-%x' % (int(stat.st_mtime), stat.st_size)
+    if encoding:
+        etag = '%s-%s' % (etag, encoding)     # each representation has its own tag
+    headers['ETag'] = '"%s"' % etag
+    headers['Last-Modified'] = formatdate(stat.st_mtime, usegmt=True)
+    if immutable:
+        headers['Cache-Control'] = '%s, max-age=%d, immutable' % \
+                                   ('public' if public else 'private', YEAR)
+    else:
+        headers['Cache-Control'] = '%s, max-age=%d' % ('public' if public else 'private', max_age)
+    if ranges and not encoding:
+        headers['Accept-Ranges'] = 'bytes'
+
+    if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        if etag_matches(if_none_match, etag):
+            return HTTPResponse(status=304, headers=headers)
+    else:
+        if_modified_since = request.environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since and parse_date(if_modified_since.split(';')[0]) >= int(stat.st_mtime):
+            return HTTPResponse(status=304, headers=headers)
+
+    size = stat.st_size
+    byte_range = request.environ.get('HTTP_RANGE') if 'Accept-Ranges' in headers else None
+    if_range = request.environ.get('HTTP_IF_RANGE')
+    if byte_range and (not if_range or if_range.strip() == headers['ETag']):
+        span = parse_range(byte_range, size)
+        if span is not None:
+            start, end = span
+            if start >= size:
+                headers['Content-Range'] = 'bytes */%d' % size
+                return HTTPResponse(status=416, headers=headers)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            headers['Content-Length'] = str(end - start + 1)
+            body = '' if request.method == 'HEAD' else file_range(path, start, end - start + 1)
+            return HTTPResponse(body, status=206, headers=headers)
+        # invalid or several ranges (which are rare): answer with the whole file
+
+    headers['Content-Length'] = str(size)
+    body = '' if request.method == 'HEAD' else open(path, 'rb')
+    return HTTPResponse(body, headers=headers)
+
+
+class StaticFiles(object):
+    """Static files below root directories by file extension. URLs carry a
+       version derived from the content, so they can be cached forever and
+       change whenever the file does."""
+
+    def __init__(self, roots, prefix='/v'):
+        self.roots = dict((extension, os.path.abspath(root))
+                          for extension, root in roots.iteritems())
+        self.prefix = prefix
+        self.versions = {}      # path -> (mtime, size, version)
+
+    def locate(self, filename):
+        """Path of a static file, None if it is not below its root"""
+        root = self.roots.get(os.path.splitext(filename)[1].lower())
+        if root is None:
+            return None
+        path = os.path.abspath(os.path.join(root, filename))
+        if not path.startswith(os.path.join(root, '')) or not os.path.isfile(path):
+            return None
+        return path
+
+    def version(self, filename):
+        path = self.locate(filename)
+        if path is None:
+            return None
+        stat = os.stat(path)
+        known = self.versions.get(path)
+        if known and known[:2] == (stat.st_mtime, stat.st_size):
+            return known[2]
+        with open(path, 'rb') as f:
+            version = sha1(f.read()).hexdigest()[:12]
+        self.versions[path] = (stat.st_mtime, stat.st_size, version)
+        return version
+
+    def url(self, filename):
+        """Versioned URL of a static file (for templates)"""
+        version = self.version(filename)
+        if version is None:
+            return '/' + filename
+        return '%s/%s/%s' % (self.prefix, version, filename)
+
+    def send(self, filename, version=None):
+        """Sends a static file, for a long time if the URL's version is current"""
+        path = self.locate(filename)
+        if path is None:
+            raise HTTPError(404, "File not found")
+        current = self.version(filename)
+        return send_file(path, etag=current, immutable=(version == current), max_age=600,
+                         precompressed=filename.lower().endswith(COMPRESSIBLE))
+
+
+def precompress(directory):
+    """Writes .gz and .br variants of compressible files which are missing or
+       older than the file. Returns the number of files written."""
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    written = 0
+    for base, subdirs, filenames in os.walk(directory):
+        for filename in filenames:
+            if not filename.lower().endswith(COMPRESSIBLE):
+                continue
+            path = os.path.join(base, filename)
+            mtime = os.stat(path).st_mtime
+            with open(path, 'rb') as f:
+                content = f.read()
+            variants = [('.gz', None)] + ([('.br', brotli)] if brotli else [])
+            for suffix, module in variants:
+                target = path + suffix
+                if os.path.exists(target) and os.stat(target).st_mtime >= mtime:
+                    continue
+                if module is None:
+                    with gzip.GzipFile(target, 'wb', 9, mtime=mtime) as f:
+                        f.write(content)
+                else:
+                    with open(target, 'wb') as f:
+                        f.write(module.compress(content))
+                written += 1
+    return written
+
+
+if __name__ == '__main__':
+    for directory in sys.argv[1:] or ['static']:
+        print "%s: %d files compressed" % (directory, precompress(directory))
@@ -1,4 +1,4 @@
-from access import AccessControlDomain
+from access import AccessControlDomain, DecisionCache, operations_closure, role_order
 import unittest
 
 # resources in question:
@@ -64,43 +64,306 @@ class AccessControlTest(unittest.TestCase):
         acd.init_role_model(test_roles)
 
     def test_subject_retrieval(self):
-        subj = self.acd.get_subject(test_mod)
+        subj = self.acd.create_subject(test_mod)
 
     def test_mod_can_modify_posts(self):
-        subj = self.acd.get_subject(test_mod)
+        subj = self.acd.create_subject(test_mod)
         self.assertTrue(subj.can('update', 'posts'))
 
     def test_mod_cannot_modify_comments(self):
-        subj = self.acd.get_subject(test_mod)
+        subj = self.acd.create_subject(test_mod)
         self.assertFalse(subj.can('update', 'comments'))
 
     def test_mod_can_delete_comments(self):
-        subj = self.acd.get_subject(test_mod)
+        subj = self.acd.create_subject(test_mod)
         self.assertTrue(subj.can('delete', 'comments'))
 
     def test_user_cannot_modify_all_posts(self):
-        subj = self.acd.get_subject(test_user)
+        subj = self.acd.create_subject(test_user)
         self.assertFalse(subj.can('modify', 'posts'))
 
     def test_user_can_modify_own_posts(self):
-        subj = self.acd.get_subject(test_user)
+        subj = self.acd.create_subject(test_user)
         self.assertTrue(subj.can('update', 'posts', {'user_id': 2}))
 
     def test_user_cannot_modify_other_posts(self):
-        subj = self.acd.get_subject(test_user)
+        subj = self.acd.create_subject(test_user)
         self.assertFalse(subj.can('update', 'posts', {'user_id': 3}))
         print subj.debug()
 
     def test_user_sees_users(self):
-        subj = self.acd.get_subject(test_user)
+        subj = self.acd.create_subject(test_user)
         self.assertTrue(subj.can('read', 'users'))
 
     def test_guest_sees_no_users_but_posts_and_comments(self):
-        subj = self.acd.get_subject(test_guest)
+        subj = self.acd.create_subject(test_guest)
         self.assertFalse(subj.can('read', 'users'))
         self.assertTrue(subj.can('read', 'posts'))
         self.assertTrue(subj.can('read', 'comments'))
 
+    def test_table_grants_resource_level_checks_unconditionally(self):
+        subj = self.acd.create_subject(test_mod)
+        self.assertEqual(subj.table.lookup('update', 'posts'), (True, ()))
+
+    def test_table_defers_attribute_checks_to_predicates(self):
+        subj = self.acd.create_subject(test_user)
+        granted, predicates = subj.table.lookup('update', 'posts')
+        self.assertFalse(granted)
+        self.assertEqual(len(predicates), 1)
+
+    def test_attribute_check_respects_resource_class(self):
+        subj = self.acd.create_subject(test_user)
+        self.assertFalse(subj.can('update', 'comments', {'user_id': 2}))
+
+    def test_attribute_check_without_descriptor_is_denied(self):
+        subj = self.acd.create_subject(test_user)
+        self.assertFalse(subj.can('update', 'posts'))
+        self.assertFalse(subj.can('update', 'posts', {}))
+
+    def test_filter_keeps_permitted_descriptors(self):
+        subj = self.acd.create_subject(test_user)
+        posts = [{'_id': i, 'user_id': i % 3} for i in range(9)]
+        self.assertEqual([post['_id'] for post in subj.filter('update', 'posts', posts)],
+                         [2, 5, 8])
+
+    def test_filter_checks_each_distinct_value_once(self):
+        subj = self.acd.create_subject(test_user)
+        granted, (target,) = subj.table.lookup('update', 'posts')
+        calls = []
+        cls = type(target)          # targets are immutable, instrument the class
+        check = cls.__dict__['check']
+        self.addCleanup(setattr, cls, 'check', check)
+        cls.check = lambda *args: calls.append(args) or check(*args)
+        posts = [{'_id': i, 'user_id': i % 3} for i in range(100)]
+        self.assertEqual(len(subj.filter('update', 'posts', posts)), 33)
+        self.assertEqual(len(calls), 3)
+
+    def test_role_model_objects_are_immutable_and_shared(self):
+        subj = self.acd.create_subject(test_user)
+        granted, (target,) = subj.table.lookup('update', 'posts')
+        with self.assertRaises(AttributeError):
+            target.value = 'login'
+        self.assertFalse(hasattr(subj, '__dict__'))
+        self.assertIs(self.acd.parse_target(['if-equals', 'posts', 'user_id', 'id']), target)
+        self.assertEqual(subj.permissions.get('publish', ()), ())
+
+    def test_filter_passes_unconditional_grants_through(self):
+        subj = self.acd.create_subject(test_mod)
+        posts = [{'_id': i} for i in range(5)]
+        self.assertEqual(subj.filter('delete', 'posts', posts), posts)
+        self.assertEqual(subj.filter('delete', 'users', posts), [])
+
+    def test_query_for_unconditional_grant_is_empty(self):
+        subj = self.acd.create_subject(test_mod)
+        self.assertEqual(subj.query('update', 'posts'), ({}, True))
+        self.assertEqual(subj.query('update', 'users'), (None, True))
+
+    def test_query_uses_subject_attributes(self):
+        subj = self.acd.create_subject(test_user)
+        self.assertEqual(subj.query('update', 'posts'),
+                         ({'user_id': {'$eq': 2, '$not': {'$type': 'array'}}}, True))
+
+    def test_query_merges_attribute_values(self):
+        acd = AccessControlDomain()
+        acd.init_role_model([
+            {'name': 'reviewer',
+             'can': [['read', [['if-contains', 'photos', 'tags', 'public'],
+                               ['if-contains', 'photos', 'tags', 'press'],
+                               ['if-equals', 'photos', 'user_id', 'id']]]]}])
+        subj = acd.create_subject({'id': 7, 'roles': ['reviewer']})
+        self.assertEqual(subj.query('read', 'photos'),
+                         ({'$or': [{'tags': {'$in': ['press', 'public']}},
+                                   {'user_id': {'$eq': 7, '$not': {'$type': 'array'}}}]}, True))
+
+    def test_invalid_role_model_keeps_the_current_one(self):
+        roles = set(self.acd.roles)
+        self.assertRaises(ValueError, self.acd.init_role_model,
+                          [{'name': 'orphan', 'parent': 'missing', 'can': []}])
+        self.assertEqual(set(self.acd.roles), roles)
+        self.assertEqual(set(self.acd.role_descriptions), roles)
+
+    def test_invalid_reload_keeps_the_operations_hierarchy(self):
+        subj = self.acd.create_subject(test_user)
+        ops, generation = self.acd.ops_hierarchy, self.acd.generation
+        self.assertRaises(Warning, self.acd.reload,
+                          [{'name': 'guest', 'can': [['read', [['no-such-target']]]]}],
+                          {'crud': ['read']})
+        self.assertIs(self.acd.ops_hierarchy, ops)
+        self.assertEqual(self.acd.generation, generation)
+        self.assertTrue(subj.can('update', 'posts', {'user_id': 2}))
+
+    def test_attributes_inspected_by_checks(self):
+        acd = AccessControlDomain()
+
+        @acd.permission('if-odd')
+        def odd(subject, resource_class, resource, op):
+            return resource['_id'] % 2
+
+        acd.init_role_model([
+            {'name': 'reviewer', 'can': [['read', [['if-contains', 'photos', 'tags', 'public'],
+                                                   ['if-equals', 'photos', 'user_id', 'id']]]]},
+            {'name': 'odd', 'can': [['read', [['if-odd']]]]}])
+        reviewer = acd.create_subject({'id': 7, 'roles': ['reviewer']})
+        self.assertEqual(reviewer.attributes('read', 'photos'), {'tags', 'user_id'})
+        self.assertEqual(reviewer.attributes('update', 'photos'), set())
+        self.assertIsNone(acd.create_subject({'roles': ['odd']}).attributes('read', 'photos'))
+
+    def test_changed_resources_are_checked_again(self):
+        subj = self.acd.create_subject(test_user)
+        self.assertTrue(subj.can('update', 'posts', {'_id': 1, 'user_id': 2}))
+        self.acd.resources_changed()
+        self.assertFalse(subj.can('update', 'posts', {'_id': 1, 'user_id': 3}))
+
+    def test_query_falls_back_for_user_defined_targets(self):
+        acd = AccessControlDomain()
+
+        @acd.permission('if-odd')
+        def odd(subject, resource_class, resource, op):
+            return resource['_id'] % 2
+
+        acd.init_role_model([{'name': 'odd', 'can': [['read', [['if-odd']]]]}])
+        subj = acd.create_subject({'roles': ['odd']})
+        self.assertEqual(subj.query('read', 'photos'), ({}, False))
+        self.assertEqual(subj.filter('read', 'photos', [{'_id': i} for i in range(4)]),
+                         [{'_id': 1}, {'_id': 3}])
+
+    def test_decisions_are_cached_both_ways(self):
+        subj = self.acd.create_subject(test_user)
+        self.assertTrue(subj.can('update', 'posts', {'_id': 1, 'user_id': 2}))
+        self.assertFalse(subj.can('update', 'posts', {'_id': 2, 'user_id': 3}))
+        self.assertTrue(subj.can('update', 'posts', {'_id': 1, 'user_id': 2}))
+        self.assertFalse(subj.can('update', 'posts', {'_id': 2, 'user_id': 3}))
+        self.assertEqual(subj.cache.stats(),
+                         {'size': 2, 'hits': 2, 'misses': 2, 'evictions': 0})
+
+    def test_decision_cache_is_invalidated_by_role_model_changes(self):
+        subj = self.acd.create_subject(test_user)
+        subj.can('update', 'posts', {'_id': 1, 'user_id': 2})
+        self.acd.update_operations_hierarchy(self.acd.ops_hierarchy)
+        subj.can('update', 'posts', {'_id': 1, 'user_id': 2})
+        self.assertEqual(subj.cache.hits, 0)
+        self.assertEqual(len(subj.cache), 1)
+
+    def test_subjects_with_equal_role_sets_share_permissions(self):
+        other = dict(test_user, id=4, roles=list(reversed(test_user['roles'])))
+        subj = self.acd.create_subject(test_user)
+        self.assertIs(self.acd.create_subject(other).table, subj.table)
+        self.assertIsNot(self.acd.create_subject(test_mod).table, subj.table)
+
+    def test_role_model_changes_recompile_permissions(self):
+        subj = self.acd.create_subject(test_user)
+        table = subj.table
+        self.acd.update_operations_hierarchy(self.acd.ops_hierarchy)
+        subj.can('read', 'posts')
+        self.assertIsNot(subj.table, table)
+
+    def test_role_updates_reach_existing_subjects(self):
+        subj = self.acd.create_subject(test_guest)
+        self.assertFalse(subj.can('read', 'users'))
+        self.acd.update_role({'name': 'guest', 'can': [['read', ['comments', 'posts', 'users']]]})
+        self.assertTrue(subj.can('read', 'users'))
+
+    def test_role_updates_reach_inheriting_roles(self):
+        subj = self.acd.create_subject(test_mod)
+        self.acd.update_role({'name': 'guest', 'can': [['read', ['users']]]})
+        self.assertTrue(subj.can('read', 'users'))
+        self.assertTrue(subj.can('delete', 'comments'))
+
+    def test_reload_only_drops_affected_permissions(self):
+        user = self.acd.create_subject(test_user)
+        mod = self.acd.create_subject(test_mod)
+        user_table, mod_table = user.table, mod.table
+        changed = dict(test_roles[2], can=[['read', ['users', 'comments']]])
+        self.assertEqual(self.acd.reload(test_roles[:2] + [changed] + test_roles[3:]),
+                         set(['community_member']))
+        self.assertTrue(user.can('read', 'comments'))
+        self.assertIsNot(user.table, user_table)
+        mod.can('read', 'posts')
+        self.assertIs(mod.table, mod_table)
+
+    def test_removed_roles_grant_nothing(self):
+        subj = self.acd.create_subject(test_user)
+        self.acd.reload([role for role in test_roles if role['name'] != 'community_member'])
+        self.assertFalse(subj.can('read', 'users'))
+
+    def test_tokens_recreate_subjects_in_other_processes(self):
+        token = self.acd.create_subject(test_user).id
+        other = AccessControlDomain()
+        other.secret = self.acd.secret
+        other.init_role_model(test_roles)
+        subj = other.subject_from_token(token)
+        self.assertTrue(subj.can('update', 'posts', {'user_id': 2}))
+        self.assertFalse(subj.can('update', 'posts', {'user_id': 3}))
+
+    def test_tokens_do_not_carry_passwords(self):
+        subj = self.acd.create_subject(test_user)
+        self.assertNotIn('password', self.acd.verify_token(subj.id)['sub'])
+
+    def test_tampered_tokens_are_rejected(self):
+        payload, signature = self.acd.create_subject(test_user).id.split('.')
+        forged = self.acd.issue_token(test_mod).split('.')[0] + '.' + signature
+        self.assertFalse(self.acd.validate_subject(forged))
+        self.assertIsNone(self.acd.subject_from_token(forged))
+        self.assertIsNone(self.acd.subject_from_token('garbage'))
+
+    def test_tokens_expire(self):
+        self.acd.token_lifetime = -1
+        self.assertIsNone(self.acd.subject_from_token(self.acd.issue_token(test_user)))
+
+    def test_tokens_of_removed_roles_are_rejected(self):
+        token = self.acd.issue_token(test_user)
+        self.acd.init_role_model([role for role in test_roles if role['name'] != 'community_member'])
+        self.assertIsNone(self.acd.subject_from_token(token))
+
+    def test_roles_are_parsed_after_their_parents(self):
+        acd = AccessControlDomain()
+        acd.init_role_model(list(reversed(test_roles)))
+        self.assertEqual(set(acd.roles), set(role['name'] for role in test_roles))
+        subj = acd.create_subject(test_mod)
+        self.assertTrue(subj.can('update', 'posts'))
+
+    def test_cyclic_inheritance_is_rejected(self):
+        with self.assertRaises(ValueError):
+            role_order([{'name': 'a', 'parent': 'b', 'can': []},
+                        {'name': 'b', 'parent': 'a', 'can': []}])
+
+    def test_unknown_parents_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.acd.init_role_model([{'name': 'a', 'parent': 'b', 'can': []}])
+
+    def test_operations_closure_contains_basic_operations(self):
+        closure = operations_closure({'write': ['create', 'update', 'delete'],
+                                      'crud': ['read', 'write']})
+        self.assertEqual(closure['crud'], {'read', 'create', 'update', 'delete'})
+        self.assertEqual(closure['write'], {'create', 'update', 'delete'})
+
+    def test_cyclic_operations_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.acd.update_operations_hierarchy({'a': ['b'], 'b': ['c', 'a']})
+
+
+class DecisionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = DecisionCache(maxsize=4, ttl=10, clock=lambda: self.now)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.put('a', True)
+        self.cache.put('b', False)
+        self.cache.get('a')
+        self.cache.put('c', True)
+        self.assertTrue(len(self.cache) <= 4)
+        self.assertEqual(self.cache.get('a'), True)
+        self.assertEqual(self.cache.get('b'), None)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_entries_expire(self):
+        self.cache.put('a', True)
+        self.now = 11
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(len(self.cache), 0)
+
 
 if __name__ == '__main__':
     unittest.main(exit=False)
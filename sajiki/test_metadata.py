@@ -0,0 +1,60 @@
+from metadata import normalize, parse_xmp, exif_date, geo
+from time import mktime
+import unittest
+
+XMP_PACKET = '''<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about="" xmlns:xmp="http://ns.adobe.com/xap/1.0/"
+      xmlns:dc="http://purl.org/dc/elements/1.1/" xmp:Rating="4">
+   <dc:subject><rdf:Bag><rdf:li>Graduation</rdf:li><rdf:li>Main Hall</rdf:li></rdf:Bag></dc:subject>
+   <dc:title><rdf:Alt><rdf:li xml:lang="x-default">Ceremony</rdf:li></rdf:Alt></dc:title>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>'''
+
+
+class MetadataTest(unittest.TestCase):
+
+    def test_capture_date_is_preferred(self):
+        exif = {306: '2015:01:01 00:00:00', 36867: '2014:05:17 14:30:00'}
+        self.assertEqual(normalize(exif)['date'], mktime((2014, 5, 17, 14, 30, 0, 0, 0, -1)))
+
+    def test_date_with_offset_is_absolute(self):
+        self.assertEqual(exif_date('2014:05:17 14:30:00', '+02:00'), 1400329800)
+        self.assertIsNone(exif_date('0000:00:00 00:00:00'))
+
+    def test_gps_coordinates_become_geojson(self):
+        gps = {1: 'N', 2: ((52, 1), (30, 1), (0, 1)), 3: 'W', 4: ((13, 1), (15, 1), (36, 10))}
+        point = geo(gps)
+        self.assertEqual(point['type'], 'Point')
+        self.assertAlmostEqual(point['coordinates'][0], -13.251)
+        self.assertAlmostEqual(point['coordinates'][1], 52.5)
+        self.assertIsNone(geo({1: 'N', 2: ((52, 1), (30, 0), (0, 1))}))
+
+    def test_camera_and_exposure(self):
+        result = normalize({271: 'Canon', 272: 'Canon EOS 5D\x00', 33437: (28, 10),
+                            33434: (1, 250), 34855: 400, 274: 6})
+        self.assertEqual(result['camera'], u'Canon EOS 5D')
+        self.assertEqual(result['exposure'], {'aperture': 2.8, 'shutter': 0.004, 'iso': 400})
+        self.assertEqual(result['orientation'], 6)
+        self.assertEqual(normalize({271: 'NIKON', 272: 'D700'})['camera'], u'NIKON D700')
+
+    def test_xmp_keywords_rating_and_title(self):
+        self.assertEqual(parse_xmp('\xff\xd8' + XMP_PACKET + '\xff\xd9'),
+                         {'keywords': ['Graduation', 'Main Hall'], 'rating': '4',
+                          'title': 'Ceremony'})
+        self.assertEqual(parse_xmp('no metadata'), {})
+
+    def test_keywords_are_merged_without_duplicates(self):
+        result = normalize({}, {(2, 25): ['Graduation', 'Campus']}, parse_xmp(XMP_PACKET))
+        self.assertEqual(result['keywords'], [u'Graduation', u'Campus', 'Main Hall'])
+        self.assertEqual(result['rating'], 4)
+
+    def test_missing_fields_are_left_out(self):
+        self.assertEqual(normalize({}), {'orientation': 1})
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,169 @@
+from access import AccessControlDomain, NullSubject
+from bottle import request, HTTPError
+from bson import ObjectId
+from search import Search, Taxonomy
+from StringIO import StringIO
+import data
+import json
+import photos
+import unittest
+
+
+def matches(document, spec):
+    """Whether the document matches the filter (the operators used here)"""
+    for key, condition in spec.iteritems():
+        if key == '$and':
+            if not all(matches(document, clause) for clause in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(document, clause) for clause in condition):
+                return False
+        elif not matches_value(document.get(key), condition):
+            return False
+    return True
+
+
+def matches_value(value, condition):
+    values = value if isinstance(value, list) else [value]
+    if not isinstance(condition, dict):
+        return condition in values
+    for operator, operand in condition.iteritems():
+        if operator == '$in' and not any(item in values for item in operand):
+            return False
+        if operator == '$nin' and any(item in values for item in operand):
+            return False
+        if operator == '$eq' and operand not in values:
+            return False
+        if operator == '$not' and isinstance(value, list):     # {'$type': 'array'}
+            return False
+    return True
+
+
+class UpdateResult(object):
+
+    def __init__(self, matched_count, modified_count):
+        self.matched_count = matched_count
+        self.modified_count = modified_count
+
+
+class Collection(object):
+    """Documents in memory, recording the filters of update_many"""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.updates = []
+
+    def find(self, spec, fields=None):
+        return [dict(document) for document in self.documents if matches(document, spec)]
+
+    def count_documents(self, spec):
+        return len(self.find(spec))
+
+    def update_many(self, spec, update):
+        self.updates.append(spec)
+        matched = modified = 0
+        for document in self.documents:
+            if not matches(document, spec):
+                continue
+            matched += 1
+            tags = list(document['tags'])
+            if '$addToSet' in update:
+                tags += [tag for tag in update['$addToSet']['tags']['$each'] if tag not in tags]
+            if '$pull' in update:
+                tags = [tag for tag in tags if tag not in update['$pull']['tags']['$in']]
+            if tags != document['tags']:
+                document['tags'] = tags
+                modified += 1
+        return UpdateResult(matched, modified)
+
+
+class TagPhotosTest(unittest.TestCase):
+
+    def setUp(self):
+        self.acd = AccessControlDomain()
+
+        @self.acd.permission('if-odd')
+        def odd(subject, resource_class, resource, op):
+            return resource['_id'] % 2
+
+        self.acd.init_role_model([
+            {'name': 'editor', 'can': [['update', ['photos']]]},
+            {'name': 'tagger', 'can': [['update', [['if-contains', 'photos', 'tags', 'public']]]]},
+            {'name': 'odd', 'can': [['update', [['if-odd']]]]}])
+        self.images = Collection([{'_id': 1, 'tags': ['dog', 'public']},
+                                  {'_id': 2, 'tags': ['dog']},
+                                  {'_id': 3, 'tags': ['cat', 'public']},
+                                  {'_id': 4, 'tags': ['cat']}])
+        images = data.images
+        data.images = self.images
+        self.addCleanup(setattr, data, 'images', images)
+
+    def tag(self, role, params):
+        body = json.dumps(params)
+        request.bind({'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': 'application/json',
+                      'CONTENT_LENGTH': str(len(body)), 'wsgi.input': StringIO(body)})
+        request.subject = self.acd.create_subject({'id': 7, 'roles': [role]}) if role \
+            else NullSubject
+        request.access_control = self.acd
+        request.search = Search(self.images, Taxonomy())
+        return photos.tag_photos()
+
+    def tags(self):
+        return dict((document['_id'], document['tags']) for document in self.images.documents)
+
+    def test_unconditional_grant_updates_in_the_database(self):
+        result = self.tag('editor', {'query': 'dog', 'add': ['pet']})
+        self.assertEqual(self.images.updates, [{'tags': 'dog'}])
+        self.assertEqual(result, {'selected': None, 'matched': 2, 'denied': None,
+                                  'added': 2, 'removed': 0})
+
+    def test_tag_permissions_are_part_of_the_filter(self):
+        result = self.tag('tagger', {'query': 'dog', 'add': ['pet']})
+        self.assertEqual(self.images.updates, [{'$and': [{'tags': 'dog'}, {'tags': 'public'}]}])
+        self.assertEqual(result['added'], 1)
+        self.assertEqual(self.tags()[2], ['dog'])
+
+    def test_checked_permissions_select_by_id(self):
+        result = self.tag('odd', {'query': 'cat', 'remove': ['cat']})
+        self.assertEqual(self.images.updates, [{'_id': {'$in': [3]}}])
+        self.assertEqual(result, {'selected': None, 'matched': 1, 'denied': None,
+                                  'added': 0, 'removed': 1})
+        self.assertEqual(self.tags()[4], ['cat'])
+
+    def test_removing_a_searched_tag_keeps_the_selection(self):
+        result = self.tag('tagger', {'query': 'dog', 'add': ['pet'], 'remove': ['dog']})
+        self.assertEqual(self.images.updates, [{'_id': {'$in': [1]}}] * 2)
+        self.assertEqual(result, {'selected': None, 'matched': 1, 'denied': None,
+                                  'added': 1, 'removed': 1})
+        self.assertEqual(self.tags(), {1: ['public', 'pet'], 2: ['dog'],
+                                       3: ['cat', 'public'], 4: ['cat']})
+
+    def test_denied_photos_are_counted(self):
+        ids = ['0' * 24, '1' * 24]
+        self.images.documents = [{'_id': ObjectId(ids[0]), 'tags': ['public']},
+                                 {'_id': ObjectId(ids[1]), 'tags': []}]
+        result = self.tag('tagger', {'ids': ids + ['2' * 24], 'add': ['pet']})
+        self.assertEqual(result, {'selected': 3, 'matched': 1, 'denied': 1,
+                                  'added': 1, 'removed': 0})
+
+    def test_guests_cannot_tag(self):
+        self.assertRaises(HTTPError, self.tag, None, {'query': 'dog', 'add': ['pet']})
+
+
+class TagUpdatesTest(unittest.TestCase):
+
+    def test_tags_are_added_and_removed_separately(self):
+        self.assertEqual(data.tag_updates(['pet'], ['dog', 'pet']),
+                         [{'$addToSet': {'tags': {'$each': ['pet']}}},
+                          {'$pull': {'tags': {'$in': ['dog']}}}])
+        self.assertEqual(data.tag_updates(remove=['dog']), [{'$pull': {'tags': {'$in': ['dog']}}}])
+
+    def test_fields_are_found_in_nested_filters(self):
+        spec = {'$and': [{'_id': {'$in': [1]}}, {'$or': [{'tags': 'dog'}, {'user_id': 7}]}]}
+        self.assertTrue(data.refers_to(spec, {'tags'}))
+        self.assertTrue(data.refers_to(spec, {'user_id'}))
+        self.assertFalse(data.refers_to(spec, {'rating'}))
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
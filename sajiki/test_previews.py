@@ -0,0 +1,85 @@
+from previews import PreviewStore, UrlSigner
+import os
+import shutil
+import tempfile
+import unittest
+
+DIGEST = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+
+
+class PreviewStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = PreviewStore(self.root, budget=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, digest, name, size, atime):
+        path = self.store.path(digest, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write('x' * size)
+        os.utime(path, (atime, atime))
+        return path
+
+    def test_previews_are_sharded_by_content_hash(self):
+        self.assertEqual(self.store.relative_path(DIGEST, 'small'),
+                         'da/39/%s-small.jpg' % DIGEST)
+        self.assertEqual(self.store.url(DIGEST, 'small'), '/cache/%s/small.jpg' % DIGEST)
+
+    def test_existing_preview_is_fetched(self):
+        path = self.write(DIGEST, 'small', 10, 0)
+        self.assertEqual(self.store.fetch(DIGEST, 'small'), path)
+        self.assertTrue(os.stat(path).st_atime > 0)
+
+    def test_unknown_previews_are_not_fetched(self):
+        self.assertFalse(self.store.fetch(DIGEST, 'small'))
+        self.assertFalse(self.store.fetch(DIGEST, 'huge'))
+
+    def test_least_recently_accessed_previews_are_evicted(self):
+        old = self.write(DIGEST, 'large', 600, 100)
+        new = self.write(DIGEST, 'medium', 600, 200)
+        self.assertEqual(self.store.evict(), 1)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(new))
+
+    def test_nothing_is_evicted_within_budget(self):
+        self.write(DIGEST, 'large', 600, 100)
+        self.assertEqual(self.store.evict(), 0)
+
+
+class UrlSignerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.signer = UrlSigner('secret', lifetime=600, granularity=60)
+        self.path = '/cache/%s/small.jpg' % DIGEST
+
+    def verify(self, url, path=None):
+        query = dict(item.split('=', 1) for item in url.split('?', 1)[1].split('&'))
+        return self.signer.verify(path or self.path, query['exp'], query['sig'])
+
+    def test_signed_url_is_valid_until_it_expires(self):
+        remaining = self.verify(self.signer.sign(self.path))
+        self.assertTrue(600 <= remaining <= 660)
+        self.assertEqual(self.verify(self.signer.sign(self.path, -120)), 0)
+
+    def test_urls_are_stable_within_granularity(self):
+        signer = UrlSigner('secret', granularity=10 ** 9)
+        self.assertEqual(signer.sign(self.path), signer.sign(self.path))
+
+    def test_tampered_urls_are_rejected(self):
+        url = self.signer.sign(self.path)
+        self.assertEqual(self.verify(url, self.path.replace('small', 'large')), 0)
+        self.assertEqual(self.verify(url.replace('exp=', 'exp=1')), 0)
+        self.assertEqual(UrlSigner('other').verify(self.path, url.split('exp=')[1].split('&')[0],
+                                                   url.split('sig=')[1]), 0)
+        self.assertEqual(self.signer.verify(self.path, 'x', 'y'), 0)
+        self.assertEqual(self.signer.verify(self.path, None, None), 0)
+        self.assertEqual(self.signer.verify(self.path, '1', u'\xe9'), 0)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,156 @@
+from search import InvertedIndex, Query, QueryError, Search, Taxonomy, acl_tags, normalize_tag, \
+    parse_query, parse_date
+from threading import Event
+import unittest
+
+taxonomy = Taxonomy({'animal': ['dog', 'cat'], 'dog': ['puppy']},
+                    {'dog': ['hound'], 'cat': ['kitty']})
+
+
+def images(*tag_lists):
+    """Records dated 1, 2, 3, ... so the last one is the newest"""
+    return [{'_id': i, 'date': float(i + 1), 'tags': tags} for i, tags in enumerate(tag_lists)]
+
+
+class SearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = InvertedIndex(images(['dog'], ['cat', 'public'], ['puppy', 'public'],
+                                          ['beach'], ['hound', 'beach', 'public'], ['kitty']))
+
+    def search(self, text, first=0):
+        return [self.index.ids[position]
+                for position in self.index.positions(parse_query(text, taxonomy), first)]
+
+    def test_tags_are_normalized(self):
+        self.assertEqual(normalize_tag(u' New  York '), u'new-york')
+        self.assertEqual(normalize_tag('Caf\xc3\xa9'), u'cafe')
+
+    def test_synonyms_and_hyponyms_are_expanded(self):
+        self.assertEqual(taxonomy.expand('Hound'), {'dog', 'hound', 'puppy'})
+        self.assertEqual(taxonomy.expand('animal'),
+                         {'animal', 'dog', 'hound', 'puppy', 'cat', 'kitty'})
+        self.assertEqual(taxonomy.expand('beach'), {'beach'})
+
+    def test_cyclic_taxonomy_is_rejected(self):
+        with self.assertRaises(ValueError):
+            Taxonomy({'a': ['b'], 'b': ['a']})
+
+    def test_query_is_parsed(self):
+        query = parse_query(u'dog -kitty "New York" from:2014-05 to:2014', taxonomy)
+        self.assertEqual(query.groups, (taxonomy.expand('dog'), frozenset([u'new-york'])))
+        self.assertEqual(query.excluded, taxonomy.expand('cat'))
+        self.assertEqual((query.start, query.end),
+                         (parse_date('2014-05')[0], parse_date('2014')[1]))
+
+    def test_invalid_dates_are_reported(self):
+        self.assertRaises(QueryError, parse_query, 'from:yesterday')
+        self.assertRaises(QueryError, parse_query, 'date:2014-13')
+
+    def test_query_spec(self):
+        self.assertEqual(Query([frozenset(['dog', 'hound'])], ['cat'], 10.0).spec(),
+                         {'$and': [{'tags': {'$in': ['dog', 'hound']}},
+                                   {'tags': {'$nin': ['cat']}},
+                                   {'date': {'$gte': 10.0}}]})
+        self.assertEqual(Query().spec(), {})
+
+    def test_matches_come_newest_first(self):
+        self.assertEqual(self.search('dog'), [4, 2, 0])
+        self.assertEqual(self.search('animal'), [5, 4, 2, 1, 0])
+
+    def test_groups_are_intersected(self):
+        self.assertEqual(self.search('animal public'), [4, 2, 1])
+        self.assertEqual(self.search('dog beach'), [4])
+        self.assertEqual(self.search('dog unknown'), [])
+
+    def test_excluded_tags_do_not_match(self):
+        self.assertEqual(self.search('public -dog'), [1])
+        self.assertEqual(self.search('-animal'), [3])
+
+    def test_date_range_limits_matches(self):
+        index = self.index
+        self.assertEqual(index.date_range(2.0, 5.0), (2, 5))
+        self.assertEqual([index.ids[p] for p in index.positions(Query([taxonomy.expand('dog')],
+                                                                      start=2.0, end=5.0))],
+                         [2])
+
+    def test_minimum_rating(self):
+        index = InvertedIndex([{'_id': 0, 'date': 1.0, 'tags': ['dog'], 'rating': 5},
+                               {'_id': 1, 'date': 2.0, 'tags': ['dog'], 'rating': 2},
+                               {'_id': 2, 'date': 3.0, 'tags': ['dog']}])
+        query = parse_query('dog rating:>=3')
+        self.assertEqual(query.spec(), {'$and': [{'tags': 'dog'}, {'rating': {'$gte': 3}}]})
+        self.assertEqual(list(index.positions(query)), [2])
+        self.assertRaises(QueryError, parse_query, 'rating:9')
+
+    def test_pages_continue_after_the_page_key(self):
+        first = self.index.position_after(5.0, 4)
+        self.assertEqual(self.search('animal', first), [2, 1, 0])
+
+    def test_readable_tags_are_taken_from_the_acl(self):
+        self.assertEqual(acl_tags(({}, True)), None)
+        self.assertEqual(acl_tags((None, True)), frozenset())
+        self.assertEqual(acl_tags(({'tags': 'public'}, True)), frozenset(['public']))
+        self.assertEqual(acl_tags(({'tags': {'$in': ['press', 'public']}}, True)),
+                         frozenset(['press', 'public']))
+        self.assertIs(acl_tags(({'user_id': 7}, True)), False)
+        self.assertIs(acl_tags(({'tags': 'public'}, False)), False)
+        self.assertIs(acl_tags(({}, False)), False)
+
+    def test_readable_tags_restrict_matches(self):
+        query = parse_query('animal', taxonomy)
+        restricted = Query(query.groups + (acl_tags(({'tags': 'public'}, True)),))
+        self.assertEqual([self.index.ids[p] for p in self.index.positions(restricted)], [4, 2, 1])
+
+    def find_with_acl(self, acl):
+        """Runs a search with an up-to-date index, returns the records found
+           and the specs passed to the find function"""
+        specs = []
+
+        def find(spec, fields, **options):
+            specs.append(spec)
+            return [{'_id': 4}]
+
+        search = Search(None, taxonomy, in_memory=True)
+        search.index = self.index
+        found = list(search.find(parse_query('animal', taxonomy), find, {}, acl=acl))
+        return found, specs
+
+    def test_unreadable_photos_are_not_searched(self):
+        self.assertEqual(self.find_with_acl((None, True)), ([], []))
+
+    def test_readable_tags_are_applied_by_the_index(self):
+        found, specs = self.find_with_acl(({'tags': 'public'}, True))
+        self.assertEqual(found, [{'_id': 4}])
+        self.assertEqual(specs[0]['$and'][0], {'_id': {'$in': [4, 2, 1]}})
+
+    def test_other_permissions_are_left_to_the_database(self):
+        for acl in (({'$or': [{'tags': 'public'}, {'user_id': 7}]}, True), ({}, False)):
+            found, specs = self.find_with_acl(acl)
+            self.assertEqual(found, [{'_id': 4}])
+            self.assertEqual(len(specs), 1)
+            self.assertNotIn('_id', str(specs[0]))
+
+    def test_stale_index_is_rebuilt_once(self):
+        release = Event()
+
+        class Collection(object):
+            scans = 0
+
+            def find(self, spec, fields):
+                Collection.scans += 1
+                release.wait()
+                return images(['dog'])
+
+        search = Search(Collection(), in_memory=True)
+        self.assertIsNone(search.current_index())
+        self.assertIsNone(search.current_index())
+        release.set()
+        search.rebuild_lock.acquire()       # wait for the rebuild
+        search.rebuild_lock.release()
+        self.assertEqual(Collection.scans, 1)
+        self.assertEqual(len(search.current_index()), 1)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
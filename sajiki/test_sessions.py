@@ -0,0 +1,76 @@
+from sessions import SessionMiddleware, MemoryStore
+import unittest
+
+
+class CountingStore(MemoryStore):
+
+    def __init__(self):
+        MemoryStore.__init__(self)
+        self.loads = self.saves = 0
+
+    def load(self, id):
+        self.loads += 1
+        return MemoryStore.load(self, id)
+
+    def save(self, id, data, timeout):
+        self.saves += 1
+        MemoryStore.save(self, id, data, timeout)
+
+
+class SessionMiddlewareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = CountingStore()
+        self.handler = lambda session: None
+        self.app = SessionMiddleware(self.application, self.store)
+
+    def application(self, environ, start_response):
+        self.handler(environ['sajiki.session'])
+        start_response('200 OK', [])
+        return ['']
+
+    def request(self, handler, cookie=None):
+        """Returns the Set-Cookie header of the response, if any"""
+        self.handler = handler
+        headers = []
+        environ = {'HTTP_COOKIE': cookie} if cookie else {}
+        self.app(environ, lambda status, response_headers, exc_info=None:
+                 headers.extend(response_headers))
+        cookies = [value for name, value in headers if name == 'Set-Cookie']
+        return cookies[0].split(';')[0] if cookies else None
+
+    def test_guests_do_not_touch_the_store(self):
+        self.assertEqual(self.request(lambda session: session.get('user')), None)
+        self.assertEqual((self.store.loads, self.store.saves), (0, 0))
+
+    def test_sessions_are_created_on_first_write(self):
+        cookie = self.request(lambda session: session.__setitem__('user', 'mod'))
+        self.assertTrue(cookie.startswith('sajiki.session='))
+        self.assertEqual(self.store.saves, 1)
+
+        users = []
+        self.assertEqual(self.request(lambda session: users.append(session['user']), cookie), None)
+        self.assertEqual(users, ['mod'])
+
+    def test_only_dirty_sessions_are_written(self):
+        cookie = self.request(lambda session: session.__setitem__('user', 'mod'))
+        self.request(lambda session: session.get('user'), cookie)
+        self.request(lambda session: session.get('user'), cookie)
+        self.assertEqual(self.store.saves, 1)
+        self.request(lambda session: session.__setitem__('user', 'admin'), cookie)
+        self.assertEqual(self.store.saves, 2)
+
+    def test_deleted_sessions_expire_their_cookie(self):
+        cookie = self.request(lambda session: session.__setitem__('user', 'mod'))
+        self.assertEqual(self.request(lambda session: session.delete(), cookie),
+                         'sajiki.session=')
+        self.assertEqual(self.store.sessions, {})
+
+    def test_unknown_session_ids_are_replaced(self):
+        cookie = self.request(lambda session: session.__setitem__('user', 'mod'),
+                              'sajiki.session=' + '0' * 40)
+        self.assertNotEqual(cookie, 'sajiki.session=' + '0' * 40)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,134 @@
+from bottle import request, HTTPError
+from static import accepts, etag_matches, parse_range, send_file
+import os
+import shutil
+import tempfile
+import unittest
+
+CONTENT = ''.join(chr(i) for i in range(100))
+
+
+class StaticTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.path = os.path.join(self.root, 'app.js')
+        with open(self.path, 'wb') as f:
+            f.write(CONTENT)
+
+    def send(self, headers=None, **options):
+        environ = {'REQUEST_METHOD': 'GET'}
+        environ.update(headers or {})
+        request.bind(environ)
+        response = send_file(self.path, **options)
+        body = response.body
+        if hasattr(body, 'read'):
+            with body:
+                body = body.read()
+        elif not isinstance(body, str):
+            body = ''.join(body)
+        return response.status_code, response.headers, body
+
+    def test_ranges_are_parsed(self):
+        self.assertEqual(parse_range('bytes=10-19', 100), (10, 19))
+        self.assertEqual(parse_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=90-200', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(parse_range('bytes=-200', 100), (0, 99))
+
+    def test_unsatisfiable_ranges_start_after_the_end(self):
+        self.assertEqual(parse_range('bytes=100-', 100)[0], 100)
+        self.assertEqual(parse_range('bytes=-0', 100)[0], 100)
+
+    def test_invalid_ranges_are_ignored(self):
+        for header in ('bytes=20-10', 'bytes=-', 'bytes=0-1,5-6', 'items=0-1', 'bytes=a-b'):
+            self.assertIsNone(parse_range(header, 100), header)
+
+    def test_entity_tags_match(self):
+        self.assertTrue(etag_matches('"abc"', 'abc'))
+        self.assertTrue(etag_matches('"x", W/"abc"', 'abc'))
+        self.assertTrue(etag_matches(' * ', 'abc'))
+        self.assertFalse(etag_matches('"abcd"', 'abc'))
+
+    def test_accepted_encodings(self):
+        self.assertTrue(accepts('gzip, deflate, br', 'br'))
+        self.assertTrue(accepts('GZIP;q=0.5', 'gzip'))
+        self.assertFalse(accepts('gzip;q=0, br', 'gzip'))
+        self.assertFalse(accepts('gzip;q=0.000', 'gzip'))
+        self.assertTrue(accepts('*', 'br'))
+        self.assertFalse(accepts('*, br;q=0', 'br'))
+        self.assertTrue(accepts('*;q=0, gzip', 'gzip'))
+        self.assertFalse(accepts('', 'gzip'))
+
+    def test_whole_file(self):
+        status, headers, body = self.send(etag='v1', immutable=True)
+        self.assertEqual(status, 200)
+        self.assertEqual(body, CONTENT)
+        self.assertEqual(headers['ETag'], '"v1"')
+        self.assertEqual(headers['Content-Length'], '100')
+        self.assertIn('immutable', headers['Cache-Control'])
+        self.assertNotIn('Accept-Ranges', headers)
+
+    def test_missing_files_are_not_found(self):
+        self.path += '.missing'
+        self.assertRaises(HTTPError, self.send)
+
+    def test_unchanged_files_are_not_sent(self):
+        self.assertEqual(self.send({'HTTP_IF_NONE_MATCH': 'W/"v1"'}, etag='v1')[0], 304)
+        self.assertEqual(self.send({'HTTP_IF_NONE_MATCH': '"v0"'}, etag='v1')[0], 200)
+        modified = self.send()[1]['Last-Modified']
+        self.assertEqual(self.send({'HTTP_IF_MODIFIED_SINCE': modified})[0], 304)
+
+    def test_ranges_are_sent(self):
+        status, headers, body = self.send({'HTTP_RANGE': 'bytes=-10'}, ranges=True)
+        self.assertEqual(status, 206)
+        self.assertEqual(body, CONTENT[90:])
+        self.assertEqual(headers['Content-Range'], 'bytes 90-99/100')
+        self.assertEqual(headers['Content-Length'], '10')
+
+    def test_ranges_need_support(self):
+        self.assertEqual(self.send({'HTTP_RANGE': 'bytes=0-9'})[0], 200)
+
+    def test_unsatisfiable_ranges_are_rejected(self):
+        for header in ('bytes=100-', 'bytes=-0'):
+            status, headers, body = self.send({'HTTP_RANGE': header}, ranges=True)
+            self.assertEqual(status, 416)
+            self.assertEqual(headers['Content-Range'], 'bytes */100')
+
+    def test_invalid_ranges_get_the_whole_file(self):
+        status, headers, body = self.send({'HTTP_RANGE': 'bytes=50-10'}, ranges=True)
+        self.assertEqual((status, body), (200, CONTENT))
+
+    def test_ranges_of_changed_files_get_the_whole_file(self):
+        headers = {'HTTP_RANGE': 'bytes=0-9', 'HTTP_IF_RANGE': '"v0"'}
+        self.assertEqual(self.send(headers, etag='v1', ranges=True)[0], 200)
+        headers['HTTP_IF_RANGE'] = '"v1"'
+        self.assertEqual(self.send(headers, etag='v1', ranges=True)[0], 206)
+
+    def test_precompressed_files_are_preferred(self):
+        with open(self.path + '.gz', 'wb') as f:
+            f.write('compressed')
+        status, headers, body = self.send({'HTTP_ACCEPT_ENCODING': 'gzip, br'}, etag='v1',
+                                          ranges=True, precompressed=True)
+        self.assertEqual(body, 'compressed')
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['ETag'], '"v1-gzip"')
+        self.assertEqual(headers['Vary'], 'Accept-Encoding')
+        self.assertNotIn('Accept-Ranges', headers)
+        status, headers, body = self.send({'HTTP_ACCEPT_ENCODING': 'gzip;q=0'}, etag='v1',
+                                          precompressed=True)
+        self.assertEqual(body, CONTENT)
+        self.assertNotIn('Content-Encoding', headers)
+
+    def test_outdated_precompressed_files_are_not_sent(self):
+        with open(self.path + '.gz', 'wb') as f:
+            f.write('compressed')
+        mtime = os.stat(self.path).st_mtime
+        os.utime(self.path + '.gz', (mtime - 10, mtime - 10))
+        body = self.send({'HTTP_ACCEPT_ENCODING': 'gzip'}, precompressed=True)[2]
+        self.assertEqual(body, CONTENT)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
@@ -0,0 +1,79 @@
+from variants import SingleFlight, VariantStore, fit, url
+from threading import Event, Thread
+from time import sleep
+import unittest
+import variants
+
+DIGEST = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+
+
+class VariantTest(unittest.TestCase):
+
+    def test_images_fit_into_the_box(self):
+        self.assertEqual(fit((1280, 853), (320, 960)), (320, 213))
+        self.assertEqual(fit((853, 1280), (320, 320)), (213, 320))
+        self.assertEqual(fit((160, 107), (320, 320)), (160, 107))     # never upscaled
+
+    def test_variants_are_sharded_by_content_hash(self):
+        store = VariantStore(None, '/tmp/variants')
+        self.assertEqual(store.relative_path(DIGEST, (320, 240), 'webp'),
+                         'da/39/%s-320x240.webp' % DIGEST)
+        self.assertEqual(url(DIGEST, 320, 240, 'webp'), '/img/%s/320x240.webp' % DIGEST)
+
+    def test_invalid_requests_are_rejected(self):
+        store = VariantStore(None, '/tmp/variants')
+        store.formats = frozenset(['jpg'])
+        self.assertRaises(ValueError, store.validate, (320, 240), 'webp')
+        self.assertRaises(ValueError, store.validate, (320, 4000), 'jpg')
+        self.assertRaises(ValueError, store.validate, (321, 240), 'jpg')
+        store.validate((320, 240), 'jpg')
+        store.validate((320, 960), 'jpg')      # as the gallery asks for
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_concurrent_calls_are_coalesced(self):
+        waiting = []
+
+        def counting_event():
+            event = Event()
+            wait = event.wait
+            event.wait = lambda *args: waiting.append(1) or wait(*args)
+            return event
+
+        flight = SingleFlight()
+        started, release = Event(), Event()
+        calls, results = [], []
+        variants.Event = counting_event
+        self.addCleanup(setattr, variants, 'Event', Event)
+
+        def render():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'variant'
+
+        leader = Thread(target=lambda: results.append(flight.do('key', render)))
+        leader.start()
+        started.wait()
+        followers = [Thread(target=lambda: results.append(flight.do('key', render)))
+                     for _ in xrange(5)]
+        for thread in followers:
+            thread.start()
+        while len(waiting) < len(followers):
+            sleep(0.001)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(results, ['variant'] * 6)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.calls, {})
+
+    def test_errors_are_raised_and_not_kept(self):
+        flight = SingleFlight()
+        self.assertRaises(IOError, flight.do, 'key', lambda: open('/nonexistent'))
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False)
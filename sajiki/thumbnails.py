@@ -0,0 +1,63 @@
+#
+#   Preview Rendering
+#
+
+import os
+from thread import get_ident
+
+# preview ladder: name and width in pixels, largest first
+PREVIEW_SIZES = (('large', 1280), ('medium', 640), ('small', 160))
+
+QUALITY = 85
+
+# EXIF orientations: PIL transposition which makes the image upright
+TRANSPOSITIONS = {2: 'FLIP_LEFT_RIGHT', 3: 'ROTATE_180', 4: 'FLIP_TOP_BOTTOM',
+                  5: 'TRANSPOSE', 6: 'ROTATE_270', 7: 'TRANSVERSE', 8: 'ROTATE_90'}
+
+
+def upright(size, orientation=1):
+    """Size of the image as displayed, after applying the EXIF orientation"""
+    return (size[1], size[0]) if orientation in (5, 6, 7, 8) else size
+
+
+def scaled(size, width):
+    """(width, height) scaled to the given width, never upscaled"""
+    w, h = size
+    if width >= w:
+        return w, h
+    return width, max(1, h * width // w)
+
+
+def save_atomic(im, path, format='JPEG', **options):
+    """Saves an image so that readers never see a partially written file"""
+    tmpfile = '%s.%d.%d.tmp' % (path, os.getpid(), get_ident())
+    try:
+        im.save(tmpfile, format, **options)
+        os.rename(tmpfile, path)
+    finally:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+
+
+def render_previews(im, outputs, sizes=PREVIEW_SIZES, quality=QUALITY, orientation=1):
+    """Writes the preview ladder of an opened, not yet decoded image.
+       'outputs' maps preview names to file names. The JPEG decoder scales
+       down by DCT while decoding (draft mode), then each preview is
+       resized from the next larger one. Previews are turned upright
+       according to the EXIF orientation. Returns the upright original size."""
+    from PIL import Image
+
+    original = upright(im.size, orientation)
+    largest = max(width for name, width in sizes)
+    im.draft('RGB', upright(scaled(original, largest), orientation))
+    if im.mode not in ('RGB', 'L'):
+        im = im.convert('RGB')
+    if orientation in TRANSPOSITIONS:
+        im = im.transpose(getattr(Image, TRANSPOSITIONS[orientation]))
+
+    for name, width in sorted(sizes, key=lambda size: -size[1]):
+        target = scaled(original, width)
+        if target[0] < im.size[0]:
+            im = im.resize(target, Image.LANCZOS)
+        save_atomic(im, outputs[name], quality=quality)
+    return original
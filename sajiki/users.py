@@ -1,16 +1,40 @@
 # --- USERS CONTROLLER ---
 from bottle import get, request, redirect
-from helpers import view, session, can, do_login, do_logout
+from helpers import view, stream_view, session, can, find_permitted, readable_images, sign_url
+from helpers import do_login, do_logout
+from search import QueryError
+from urllib import urlencode
 import data
 
 @get('/')
-@view('gallery')
+@stream_view('gallery')
 @session
 def index():
+    photos = find_permitted(data.images, 'read', 'photos',
+                            data.after_page_key(request.params.get('after')),
+                            data.GALLERY_FIELDS,
+                            sort=data.GALLERY_ORDER, limit=data.GALLERY_PAGE)
     return {'gallery': 'Newest photos',
-            'photos': map(data.DataImage, data.images.find())}
+            'photos': data.GalleryPage(photos, sign=sign_url)}
 
 
+@get('/search')
+@stream_view('gallery')
+@session
+def search():
+    text = request.params.getunicode('q', u'')
+    try:
+        query = request.search.parse(text)
+    except QueryError as e:
+        return {'gallery': 'Search', 'query': text, 'error': str(e), 'photos': []}
+    photos = request.search.find(query, readable_images, data.GALLERY_FIELDS,
+                                 request.params.get('after'), data.GALLERY_PAGE,
+                                 request.subject.query('read', 'photos'))
+    return {'gallery': u'Photos of \u201c%s\u201d' % text if text else 'All photos',
+            'query': text,
+            'pager': '/search?%s&' % urlencode({'q': text.encode('utf-8')}),
+            'photos': data.GalleryPage(photos, sign=sign_url)}
+
 
 @get('/restricted')
 def restricted():
@@ -0,0 +1,156 @@
+#
+#   Image Variants
+#
+#   Resized versions of previews in other sizes and formats, generated on
+#   demand (e.g. for high-DPI screens or the lightbox) and kept in a cache
+#   of bounded size. Variants are rendered from the smallest preview that is
+#   at least as large, never from the original.
+#
+
+import os
+from threading import Event, Lock
+
+import thumbnails
+from previews import BoundedStore, make_directories, touch
+
+URL_PREFIX = '/img'
+# box sides which are served, so each image has at most 49 variants per format
+STEPS = (160, 240, 320, 480, 640, 960, 1280)
+
+# format extension: PIL format, MIME type, encoder options
+FORMATS = {'jpg': ('JPEG', 'image/jpeg', {'quality': 85, 'progressive': True, 'optimize': True}),
+           'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+           'avif': ('AVIF', 'image/avif', {'quality': 60, 'speed': 8})}
+
+
+def url(digest, width, height, fmt='jpg'):
+    """URL of the variant fitting into width x height pixels"""
+    return '%s/%s/%dx%d.%s' % (URL_PREFIX, digest, width, height, fmt)
+
+
+def fit(size, box):
+    """Size scaled to fit into the box, keeping the aspect ratio. Never upscaled."""
+    w, h = size
+    scale = min(1.0, float(box[0]) / w, float(box[1]) / h)
+    return max(1, int(round(w * scale))), max(1, int(round(h * scale)))
+
+
+def supported_formats():
+    """Format extensions which the installed PIL can encode. AVIF needs
+       a recent Pillow or the pillow-avif-plugin package."""
+    from PIL import Image
+    try:
+        import pillow_avif
+    except ImportError:
+        pass
+    Image.init()
+    return frozenset(fmt for fmt, (name, mimetype, options) in FORMATS.iteritems()
+                     if name in Image.SAVE)
+
+
+class SingleFlight(object):
+    """Runs a function once per key at a time. Callers asking for a key
+       which is in progress wait for its result (or exception) instead of
+       running the function again."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = {}         # key -> [event, result, exception]
+
+    def do(self, key, function, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = [Event(), None, None]
+        if leader:
+            try:
+                call[1] = function(*args)
+            except Exception as e:
+                call[2] = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call[0].set()
+        else:
+            call[0].wait()
+        if call[2] is not None:
+            raise call[2]
+        return call[1]
+
+
+class VariantStore(BoundedStore):
+    """Variants keyed by the content hash of the original, the box size and
+       the format, in <root>/<hh>/<hh>/<hash>-<w>x<h>.<fmt>. The least recently
+       accessed variants are evicted to stay below the budget (in bytes).
+       Concurrent requests for a missing variant render it only once."""
+
+    def __init__(self, previews, root='./variants', budget=None):
+        BoundedStore.__init__(self, root, budget)
+        self.previews = previews
+        self.largest = max(width for name, width in thumbnails.PREVIEW_SIZES)
+        self.formats = None
+        self.flight = SingleFlight()
+
+    def relative_path(self, digest, size, fmt):
+        return '%s/%s/%s-%dx%d.%s' % (digest[:2], digest[2:4], digest, size[0], size[1], fmt)
+
+    def path(self, digest, size, fmt):
+        return os.path.join(self.root, self.relative_path(digest, size, fmt))
+
+    def mimetype(self, fmt):
+        return FORMATS[fmt][1]
+
+    def validate(self, size, fmt):
+        """Raises ValueError for sizes or formats which are not served. Box
+           sides are one of STEPS, so the number of variants of an image is
+           bounded as well."""
+        if self.formats is None:
+            self.formats = supported_formats()
+        if fmt not in self.formats:
+            raise ValueError("Unsupported format '%s'" % fmt)
+        if not all(length in STEPS for length in size):
+            raise ValueError("Box sides must be one of %s pixels" % ', '.join(map(str, STEPS)))
+
+    def fetch(self, digest, size, fmt='jpg'):
+        """Path of an existing or newly rendered variant, None if there is no
+           preview to render it from. Raises ValueError for invalid requests."""
+        self.validate(size, fmt)
+        path = self.path(digest, size, fmt)
+        return touch(path) or self.flight.do(path, self.render, digest, size, fmt, path)
+
+    def source(self, digest, size):
+        """The smallest preview which the box does not enlarge, opened. Previews
+           as wide as the box are chosen by their width; narrower ones are
+           opened to see whether they are high enough."""
+        from PIL import Image
+
+        for name, width in sorted(thumbnails.PREVIEW_SIZES, key=lambda size: size[1]):
+            preview = self.previews.fetch(digest, name)
+            if preview is None:
+                return None
+            im = Image.open(preview)    # reads the header only
+            if width >= size[0] or im.size[1] >= size[1] or width == self.largest:
+                return im
+            im.close()
+
+    def render(self, digest, size, fmt, path):
+        from PIL import Image
+
+        source = self.source(digest, size)
+        if source is None:
+            return None
+        try:
+            target = fit(source.size, size)
+            source.draft('RGB', target)     # JPEG previews are scaled down while decoding
+            im = source if source.mode in ('RGB', 'L') else source.convert('RGB')
+            # a new image either way: closing the source discards its data
+            im = im.resize(target, Image.LANCZOS) if target != im.size else im.copy()
+        finally:
+            source.close()
+
+        make_directories(path)
+        name, mimetype, options = FORMATS[fmt]
+        thumbnails.save_atomic(im, path, name, **options)
+        self.file_written()
+        return path